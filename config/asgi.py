@@ -0,0 +1,18 @@
+"""
+ASGI config for Khmer speech to text API project.
+
+It exposes the ASGI callable as a module-level variable named ``application``.
+Run with USE_ASYNC_VIEWS=true so the transcription endpoints use the async views (see transcription/async_views.py).
+Uses the ASGI handler from transcription/asgi.py, so status-stream can stream before Django 4.2.
+
+For more information on this file, see
+https://docs.djangoproject.com/en/3.1/howto/deployment/asgi/
+"""
+
+import os
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "config.settings")
+
+from transcription.asgi import get_asgi_application
+
+application = get_asgi_application()
@@ -0,0 +1,54 @@
+"""
+Gunicorn config, see Procfile
+
+Docs: https://docs.gunicorn.org/en/stable/settings.html
+"""
+import os
+import glob
+
+
+def on_starting(server):
+    """
+    metrics from workers of the last run would otherwise be added to this run's (see transcription/metrics.py)
+    """
+    path = os.environ.get("PROMETHEUS_MULTIPROC_DIR")
+    if not path:
+        return
+
+    os.makedirs(path, exist_ok=True)
+    for db_file in glob.glob(os.path.join(path, "*.db")):
+        os.remove(db_file)
+
+
+def child_exit(server, worker):
+    """
+    so a worker that exited (e.g., got restarted) doesn't keep counting in gauges. Its counters and histograms are kept
+    """
+    if not os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        return
+
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
+
+
+def post_fork(server, worker):
+    """
+    create the google clients right after the worker forks, so the first request doesn't have to wait on it
+    (grpc channels can't be shared across a fork, so has to happen in each worker, not in the master)
+    set PREWARM_SERVICES=false to skip
+    """
+    if os.environ.get("PREWARM_SERVICES", "true") == "false":
+        return
+
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "config.settings")
+    import django
+    django.setup()
+
+    from transcription.helpers import services
+
+    try:
+        services.prewarm()
+        server.log.info(f"worker {worker.pid} pre-warmed services: {', '.join(services.initialized())}")
+    except Exception as error:
+        # not fatal, will just get created on first use instead
+        server.log.error(f"worker {worker.pid} failed to pre-warm services: {error}")
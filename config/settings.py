@@ -44,6 +44,8 @@ INSTALLED_APPS = [
 MIDDLEWARE = [
     # make sure is first on list
     "corsheaders.middleware.CorsMiddleware",
+    # times every view (see transcription/metrics.py)
+    "transcription.metrics.metrics_middleware",
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
@@ -72,6 +74,10 @@ TEMPLATES = [
 ]
 
 WSGI_APPLICATION = "config.wsgi.application"
+ASGI_APPLICATION = "config.asgi.application"
+
+# route the transcription endpoints to the async views (for when running under ASGI, see config/asgi.py)
+USE_ASYNC_VIEWS = os.environ.get('USE_ASYNC_VIEWS') == "true"
 
 
 # Database
@@ -151,6 +157,96 @@ LOGGING = {
     }
 }
 
+# background poller (see transcription/poller.py)
+# if true, check-status endpoint just reads what the poller has persisted, instead of asking Google itself
+BACKGROUND_POLLING = os.environ.get('BACKGROUND_POLLING') == "true"
+# seconds. Each operation starts at POLLER_INTERVAL and backs off up to POLLER_MAX_INTERVAL while progress isn't changing
+POLLER_INTERVAL = float(os.environ.get('POLLER_INTERVAL', 5))
+POLLER_MAX_INTERVAL = float(os.environ.get('POLLER_MAX_INTERVAL', 60))
+POLLER_BATCH_SIZE = int(os.environ.get('POLLER_BATCH_SIZE', 10))
+
+# /status-stream/ (async views only). Seconds between keep-alives, and how long to hold a connection before making the client reconnect
+STATUS_STREAM_HEARTBEAT_SECONDS = float(os.environ.get('STATUS_STREAM_HEARTBEAT_SECONDS', 15))
+STATUS_STREAM_MAX_SECONDS = float(os.environ.get('STATUS_STREAM_MAX_SECONDS', 300))
+
+# shared firestore listeners for transcribe request docs (see transcription/snapshot_hub.py), so refresh_from_db reads a local copy
+# listeners are kept SNAPSHOT_HUB_IDLE_SECONDS after last use, and copies older than SNAPSHOT_HUB_MAX_AGE get read again
+SNAPSHOT_HUB = os.environ.get('SNAPSHOT_HUB') == "true"
+SNAPSHOT_HUB_IDLE_SECONDS = float(os.environ.get('SNAPSHOT_HUB_IDLE_SECONDS', 60))
+SNAPSHOT_HUB_MAX_AGE = float(os.environ.get('SNAPSHOT_HUB_MAX_AGE', 300))
+
+# check_status responses are cached per transaction_id for this many seconds (finished ones are kept until evicted)
+CHECK_STATUS_CACHE_TTL = float(os.environ.get('CHECK_STATUS_CACHE_TTL', 3))
+CHECK_STATUS_CACHE_SIZE = int(os.environ.get('CHECK_STATUS_CACHE_SIZE', 1024))
+# check-status-bulk: most ids per call, and most operations looked up from Google at once (per process)
+CHECK_STATUS_BULK_MAX = int(os.environ.get('CHECK_STATUS_BULK_MAX', 100))
+CHECK_STATUS_BULK_WORKERS = int(os.environ.get('CHECK_STATUS_BULK_WORKERS', 8))
+
+# reuse transcripts of audio we've transcribed before (see transcription/transcript_cache.py)
+# entries are per user unless TRANSCRIPT_CACHE_SHARED. Kept TRANSCRIPT_CACHE_MAX_AGE_DAYS after last use (0 keeps them forever)
+# files without an md5/crc32c in storage are only hashed (downloaded) if TRANSCRIPT_CACHE_HASH_DOWNLOAD
+TRANSCRIPT_CACHE = os.environ.get('TRANSCRIPT_CACHE') == "true"
+TRANSCRIPT_CACHE_SHARED = os.environ.get('TRANSCRIPT_CACHE_SHARED') == "true"
+TRANSCRIPT_CACHE_MAX_AGE_DAYS = float(os.environ.get('TRANSCRIPT_CACHE_MAX_AGE_DAYS', 90))
+TRANSCRIPT_CACHE_HASH_DOWNLOAD = os.environ.get('TRANSCRIPT_CACHE_HASH_DOWNLOAD', "true") == "true"
+
+# retrying requests to Speech (see transcription/retries.py). Seconds, except for the counts
+# after SPEECH_BREAKER_THRESHOLD transient errors in a row, requests fail right away for SPEECH_BREAKER_RESET_SECONDS
+SPEECH_RETRY_MAX_ATTEMPTS = int(os.environ.get('SPEECH_RETRY_MAX_ATTEMPTS', 4))
+SPEECH_RETRY_DEADLINE = float(os.environ.get('SPEECH_RETRY_DEADLINE', 60))
+SPEECH_RETRY_INITIAL_DELAY = float(os.environ.get('SPEECH_RETRY_INITIAL_DELAY', 1))
+SPEECH_RETRY_MAX_DELAY = float(os.environ.get('SPEECH_RETRY_MAX_DELAY', 16))
+SPEECH_BREAKER_THRESHOLD = int(os.environ.get('SPEECH_BREAKER_THRESHOLD', 5))
+SPEECH_BREAKER_RESET_SECONDS = float(os.environ.get('SPEECH_BREAKER_RESET_SECONDS', 30))
+
+# admission control for request-transcribe and resume-request (see transcription/admission.py). State is kept in the Django db
+# token buckets: requests per minute, and how many can come in at once. Per user, and for everyone together. 0 for no limit
+# operations running at once, per user and overall. A slot counts until the request is processed or errors, or for ADMISSION_SLOT_SECONDS at most
+ADMISSION_CONTROL = os.environ.get('ADMISSION_CONTROL') == "true"
+ADMISSION_USER_PER_MINUTE = float(os.environ.get('ADMISSION_USER_PER_MINUTE', 6))
+ADMISSION_USER_BURST = float(os.environ.get('ADMISSION_USER_BURST', 10))
+ADMISSION_GLOBAL_PER_MINUTE = float(os.environ.get('ADMISSION_GLOBAL_PER_MINUTE', 60))
+ADMISSION_GLOBAL_BURST = float(os.environ.get('ADMISSION_GLOBAL_BURST', 60))
+ADMISSION_MAX_OPERATIONS = int(os.environ.get('ADMISSION_MAX_OPERATIONS', 100))
+ADMISSION_MAX_OPERATIONS_PER_USER = int(os.environ.get('ADMISSION_MAX_OPERATIONS_PER_USER', 5))
+ADMISSION_SLOT_SECONDS = float(os.environ.get('ADMISSION_SLOT_SECONDS', 8 * 60 * 60))
+# what to tell clients to wait when it's the operations cap that's full
+ADMISSION_BUSY_RETRY_SECONDS = float(os.environ.get('ADMISSION_BUSY_RETRY_SECONDS', 30))
+
+# job queue (see transcription/job_queue.py): if true, request-transcribe queues a job and a worker (run_jobs) asks Google, instead of the web request doing it
+# JOB_WORKERS jobs at a time per worker process, and no more than JOB_MAX_RUNNING at once across all of them
+JOB_QUEUE = os.environ.get('JOB_QUEUE') == "true"
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 2))
+JOB_MAX_RUNNING = int(os.environ.get('JOB_MAX_RUNNING', 8))
+JOB_MAX_ATTEMPTS = int(os.environ.get('JOB_MAX_ATTEMPTS', 3))
+# seconds. A job whose worker hasn't finished it within the lease gets picked up by another worker
+JOB_LEASE_SECONDS = float(os.environ.get('JOB_LEASE_SECONDS', 300))
+JOB_POLL_INTERVAL = float(os.environ.get('JOB_POLL_INTERVAL', 1))
+
+# delete uploaded audio in a background thread once the transcript is done, instead of making the request wait on it
+STORAGE_CLEANUP_IN_BACKGROUND = os.environ.get('STORAGE_CLEANUP_IN_BACKGROUND', "true") == "true"
+
+# converting other formats to flac (see transcription/transcoding.py). Each worker is a separate process running ffmpeg
+FFMPEG_PATH = os.environ.get('FFMPEG_PATH', "ffmpeg")
+TRANSCODE_WORKERS = int(os.environ.get('TRANSCODE_WORKERS', 1))
+# mp3s can go to Google as they are (we probe the sample rate), but converting them sometimes gives better results
+TRANSCODE_MP3 = os.environ.get('TRANSCODE_MP3', "false") == "true"
+
+# split mode (see transcription/splitting.py): long files get cut at silences and the segments transcribed at the same time
+# applies to files of at least SPLIT_MODE_MIN_MB, unless the client asks for split_mode on the request itself
+SPLIT_MODE = os.environ.get('SPLIT_MODE', "false") == "true"
+SPLIT_MODE_MIN_MB = float(os.environ.get('SPLIT_MODE_MIN_MB', 20))
+SPLIT_SEGMENT_SECONDS = float(os.environ.get('SPLIT_SEGMENT_SECONDS', 600))
+SPLIT_MAX_SEGMENTS = int(os.environ.get('SPLIT_MAX_SEGMENTS', 8))
+
+# prometheus metrics at /metrics (see transcription/metrics.py). Under gunicorn, also set PROMETHEUS_MULTIPROC_DIR
+METRICS = os.environ.get('METRICS', "true") == "true"
+# /metrics, /cache-stats/, /queue-stats/ and /admission-stats/ are only for staff users, or whoever sends "Authorization: Bearer <STATS_TOKEN>" (e.g., Prometheus)
+STATS_TOKEN = os.environ.get('STATS_TOKEN')
+
+# auto, orjson or json (see transcription/serialization.py). auto uses orjson if it's installed
+JSON_BACKEND = os.environ.get('JSON_BACKEND', "auto")
+
 if os.environ.get('DJANGO_ENV') != "PRODUCTION":
     DEBUG = True
     ENV = "DEVELOPMENT"
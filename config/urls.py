@@ -7,7 +7,12 @@ from django.contrib import admin
 
 admin.autodiscover()
 
+from django.conf import settings
 import transcription.views
+import transcription.async_views
+
+# transcribe, resume and check status have async versions, for running under ASGI
+transcription_views = transcription.async_views if settings.USE_ASYNC_VIEWS else transcription.views
 
 # To add a new path, first import the app:
 # import blog
@@ -18,10 +23,19 @@ import transcription.views
 # Learn more here: https://docs.djangoproject.com/en/2.1/topics/http/urls/
 
 urlpatterns = [
-    path("request-transcribe/", transcription.views.transcribe, name="transcribe"),
-    path("resume-request/", transcription.views.resume_request, name="resume-request"),
-    path("check-status/", transcription.views.check_status, name="check-status"),
+    path("request-transcribe/", transcription_views.transcribe, name="transcribe"),
+    path("resume-request/", transcription_views.resume_request, name="resume-request"),
+    path("check-status/", transcription_views.check_status, name="check-status"),
+    path("check-status-bulk/", transcription_views.check_status_bulk, name="check-status-bulk"),
+    path("cache-stats/", transcription.views.cache_stats, name="cache-stats"),
+    path("queue-stats/", transcription.views.queue_stats, name="queue-stats"),
+    path("admission-stats/", transcription.views.admission_stats, name="admission-stats"),
+    path("metrics", transcription.views.metrics_view, name="metrics"),
     # something to add for when using heroku hobby dynos
     path("wake-up/", csrf_exempt(lambda request: HttpResponse('transcription World! Waking up')), name="wake-up"),
     path("admin/", admin.site.urls),
 ]
+
+if settings.USE_ASYNC_VIEWS:
+    # holds the connection open, so only under ASGI
+    urlpatterns.append(path("status-stream/", transcription.async_views.status_stream, name="status-stream"))
@@ -0,0 +1,340 @@
+"""
+Admission control for transcription requests: how many each user (and everyone together) can start, and how many can be running at once
+
+- Token buckets: each user gets ADMISSION_USER_BURST requests at once, refilled at ADMISSION_USER_PER_MINUTE. There's also one bucket for everyone together (the Speech API quota is per project)
+- Caps on operations running at once, per user and overall. A request holds a slot from when it's let through until it gets to a final status (processed or an error). Slots expire after ADMISSION_SLOT_SECONDS, in case we never hear back
+- State is in the Django db (see models.AdmissionCounter), so it holds across dynos. Every change is a conditional update on a version number, so there's no locking, and it's a handful of single row queries per request no matter how many requests there are
+- A request that was let through before (e.g., a resume, or the job queue trying again) isn't charged again
+- Each process remembers which buckets were empty and until when, so those get turned away without touching the db
+- Turned away requests raise Throttled, with how long to wait. Views answer 429 with Retry-After, and the job queue puts the job back until then
+- MemoryStore is for tests (and local experiments), and does the same thing in memory
+"""
+import math
+import threading
+import time
+import logging
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import F
+
+from .models import AdmissionCounter, AdmissionSlot
+
+logger = logging.getLogger('testlogger')
+
+# how many times to retry a conditional update that lost a race before giving up
+_MAX_TRIES = 20
+
+
+class Throttled(Exception):
+    def __init__(self, retry_after, reason):
+        super().__init__(reason)
+        self.retry_after = retry_after
+        self.reason = reason
+
+    def retry_after_header(self):
+        return str(max(1, math.ceil(self.retry_after)))
+
+
+#########################################
+# Stores
+################################
+
+class DatabaseStore:
+    def get(self, key):
+        return AdmissionCounter.objects.filter(key=key).values("value", "updated_at", "version").first()
+
+    def create(self, key, value, updated_at):
+        try:
+            # own transaction, so on postgres a duplicate doesn't break whatever transaction we're in
+            with transaction.atomic():
+                AdmissionCounter.objects.create(key=key, value=value, updated_at=updated_at)
+            return True
+        except IntegrityError:
+            return False
+
+    def swap(self, key, version, value, updated_at):
+        """
+        only writes if no one else has since we read version
+        """
+        return bool(AdmissionCounter.objects.filter(key=key, version=version).update(value=value, updated_at=updated_at, version=F("version") + 1))
+
+    def get_slot(self, key):
+        return AdmissionSlot.objects.filter(key=key).values("key", "user_id", "expires_at").first()
+
+    def add_slot(self, key, user_id, expires_at):
+        try:
+            with transaction.atomic():
+                AdmissionSlot.objects.create(key=key, user_id=user_id or "", expires_at=expires_at)
+            return True
+        except IntegrityError:
+            return False
+
+    def remove_slot(self, key):
+        """
+        True if it was there (so only one caller gets to give back its counts)
+        """
+        return AdmissionSlot.objects.filter(key=key).delete()[0] > 0
+
+    def expired_slots(self, now, limit=100):
+        return list(AdmissionSlot.objects.filter(expires_at__lte=now).values("key", "user_id", "expires_at")[:limit])
+
+
+class MemoryStore:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {}
+        self.slots = {}
+
+    def get(self, key):
+        with self._lock:
+            row = self.counters.get(key)
+            return dict(row) if row else None
+
+    def create(self, key, value, updated_at):
+        with self._lock:
+            if key in self.counters:
+                return False
+            self.counters[key] = {"value": value, "updated_at": updated_at, "version": 0}
+            return True
+
+    def swap(self, key, version, value, updated_at):
+        with self._lock:
+            row = self.counters.get(key)
+            if row is None or row["version"] != version:
+                return False
+            self.counters[key] = {"value": value, "updated_at": updated_at, "version": version + 1}
+            return True
+
+    def get_slot(self, key):
+        with self._lock:
+            slot = self.slots.get(key)
+            return dict(slot) if slot else None
+
+    def add_slot(self, key, user_id, expires_at):
+        with self._lock:
+            if key in self.slots:
+                return False
+            self.slots[key] = {"key": key, "user_id": user_id or "", "expires_at": expires_at}
+            return True
+
+    def remove_slot(self, key):
+        with self._lock:
+            return self.slots.pop(key, None) is not None
+
+    def expired_slots(self, now, limit=100):
+        with self._lock:
+            return [dict(slot) for slot in self.slots.values() if slot["expires_at"] <= now][:limit]
+
+
+#########################################
+# Admission
+################################
+
+class AdmissionController:
+    def __init__(self, store, user_rate=None, user_burst=None, global_rate=None, global_burst=None, max_operations=None, max_operations_per_user=None, slot_seconds=8 * 60 * 60, busy_retry_seconds=30, clock=time.time):
+        """
+        - rates are tokens per second, bursts are how many tokens a bucket holds. None (or 0) for no limit
+        - clock is unix time, since it's compared with what other machines wrote
+        """
+        self.store = store
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        self.global_rate = global_rate
+        self.global_burst = global_burst
+        self.max_operations = max_operations
+        self.max_operations_per_user = max_operations_per_user
+        self.slot_seconds = slot_seconds
+        # there's no telling when a running operation will finish, so this is a guess
+        self.busy_retry_seconds = busy_retry_seconds
+        self.clock = clock
+        self._lock = threading.Lock()
+        # bucket key > clock time it'll have a token again, so we don't go to the db just to hear it's still empty
+        self._empty_until = {}
+        self._stats = {"admitted": 0, "already_admitted": 0, "throttled": 0, "throttled_locally": 0, "released": 0, "expired": 0, "conflicts": 0}
+
+    def _count(self, name, amount=1):
+        with self._lock:
+            self._stats[name] += amount
+
+    #########################################
+    # counters
+    ################################
+
+    def _change(self, key, initial, change):
+        """
+        change(value, updated_at, now) returns (new value, result), or (None, result) to leave it alone. Returns result
+        - read, change, and write only if no one else wrote in between. Otherwise try again with what they wrote
+        """
+        for _ in range(_MAX_TRIES):
+            now = self.clock()
+            row = self.store.get(key)
+            if row is None:
+                self.store.create(key, initial, now)
+                continue
+
+            value, result = change(row["value"], row["updated_at"], now)
+            if value is None or self.store.swap(key, row["version"], value, now):
+                return result
+
+            self._count("conflicts")
+
+        raise Throttled(1, f"Too many requests at once for {key}, try again")
+
+    def _take_token(self, key, rate, burst):
+        """
+        0 if took one, otherwise seconds until there'll be one
+        """
+        def take(tokens, updated_at, now):
+            tokens = min(burst, tokens + max(0, now - updated_at) * rate)
+            if tokens < 1:
+                return None, (1 - tokens) / rate
+            return tokens - 1, 0
+
+        return self._change(key, burst, take)
+
+    def _give_back_token(self, key, rate, burst):
+        def give_back(tokens, updated_at, now):
+            tokens = min(burst, tokens + max(0, now - updated_at) * rate)
+            return min(burst, tokens + 1), None
+
+        self._change(key, burst, give_back)
+
+    def _start_operation(self, key, cap):
+        def start(running, updated_at, now):
+            if running >= cap:
+                return None, False
+            return running + 1, True
+
+        return self._change(key, 0, start)
+
+    def _end_operation(self, key):
+        self._change(key, 0, lambda running, updated_at, now: (max(0, running - 1), None))
+
+    #########################################
+    # keys and limits
+    ################################
+
+    def _buckets(self, user_id):
+        buckets = []
+        if self.user_rate and self.user_burst and user_id:
+            buckets.append((f"tokens:user:{user_id}", self.user_rate, self.user_burst, "Too many transcription requests, try again later"))
+        if self.global_rate and self.global_burst:
+            buckets.append(("tokens:global", self.global_rate, self.global_burst, "We're getting a lot of transcription requests right now, try again later"))
+        return buckets
+
+    def _operation_caps(self, user_id):
+        caps = []
+        if self.max_operations_per_user and user_id:
+            caps.append((f"operations:user:{user_id}", self.max_operations_per_user, "You already have as many transcriptions going as we can do at once, try again once one finishes"))
+        if self.max_operations:
+            caps.append(("operations:global", self.max_operations, "We have as many transcriptions going as we can do at once right now, try again later"))
+        return caps
+
+    #########################################
+    # admit/release
+    ################################
+
+    def admit(self, user_id, key):
+        """
+        key identifies the transcribe request (e.g., its path). Raises Throttled if it has to wait
+        """
+        now = self.clock()
+        slot = self.store.get_slot(key)
+        if slot is not None:
+            if slot["expires_at"] > now:
+                self._count("already_admitted")
+                return
+
+            self._release_slot(slot, expired=True)
+
+        buckets = self._buckets(user_id)
+        with self._lock:
+            empty_until, reason = max([(self._empty_until.get(bucket_key, 0), reason) for bucket_key, _, _, reason in buckets], default=(0, None))
+        if empty_until > now:
+            self._count("throttled")
+            self._count("throttled_locally")
+            raise Throttled(empty_until - now, reason)
+
+        # everything taken so far, to give back if something after says no
+        undo = []
+        try:
+            for counter_key, cap, reason in self._operation_caps(user_id):
+                if not self._start_operation(counter_key, cap):
+                    # maybe some of them expired without us hearing about it
+                    if not (self.release_expired() and self._start_operation(counter_key, cap)):
+                        raise Throttled(self.busy_retry_seconds, reason)
+                undo.append(lambda counter_key=counter_key: self._end_operation(counter_key))
+
+            for bucket_key, rate, burst, reason in buckets:
+                wait = self._take_token(bucket_key, rate, burst)
+                if wait:
+                    with self._lock:
+                        self._empty_until[bucket_key] = self.clock() + wait
+                    raise Throttled(wait, reason)
+                undo.append(lambda bucket_key=bucket_key, rate=rate, burst=burst: self._give_back_token(bucket_key, rate, burst))
+
+            if not self.store.add_slot(key, user_id, now + self.slot_seconds):
+                # someone let the same request through at the same time, so it's already counted
+                for step in reversed(undo):
+                    step()
+                self._count("already_admitted")
+                return
+
+        except Throttled:
+            for step in reversed(undo):
+                step()
+            self._count("throttled")
+            raise
+
+        self._count("admitted")
+
+    def release(self, key):
+        """
+        the request's operation finished (or failed), so its slot is free. Fine to call more than once
+        """
+        slot = self.store.get_slot(key)
+        if slot is not None:
+            self._release_slot(slot)
+
+    def _release_slot(self, slot, expired=False):
+        if not self.store.remove_slot(slot["key"]):
+            # someone else already did
+            return False
+
+        for counter_key, _, _ in self._operation_caps(slot["user_id"]):
+            self._end_operation(counter_key)
+
+        self._count("expired" if expired else "released")
+        return True
+
+    def release_expired(self, limit=100):
+        """
+        returns how many slots were freed
+        """
+        slots = self.store.expired_slots(self.clock(), limit)
+        released = sum(1 for slot in slots if self._release_slot(slot, expired=True))
+        if released:
+            logger.info(f"freed {released} admission slots that expired")
+        return released
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats)
+
+
+def _per_second(per_minute):
+    return per_minute / 60 if per_minute else None
+
+
+admission_control = AdmissionController(
+    DatabaseStore(),
+    user_rate=_per_second(settings.ADMISSION_USER_PER_MINUTE),
+    user_burst=settings.ADMISSION_USER_BURST,
+    global_rate=_per_second(settings.ADMISSION_GLOBAL_PER_MINUTE),
+    global_burst=settings.ADMISSION_GLOBAL_BURST,
+    max_operations=settings.ADMISSION_MAX_OPERATIONS,
+    max_operations_per_user=settings.ADMISSION_MAX_OPERATIONS_PER_USER,
+    slot_seconds=settings.ADMISSION_SLOT_SECONDS,
+    busy_retry_seconds=settings.ADMISSION_BUSY_RETRY_SECONDS,
+)
@@ -0,0 +1,61 @@
+"""
+Streaming an async iterator as the response (for status_stream), on django 3.x
+
+- Django only takes async iterators in StreamingHttpResponse from 4.2 on. Before that, it iterates the content synchronously, on the event loop
+- AsyncStreamingHttpResponse holds the async iterator, and ASGIHandler (used in config/asgi.py) awaits each part as it's sent
+- On django 4.2 or later, AsyncStreamingHttpResponse is just StreamingHttpResponse, and ASGIHandler doesn't change anything
+"""
+import django
+from django.core.handlers.asgi import ASGIHandler as DjangoASGIHandler
+from django.http import StreamingHttpResponse
+
+
+if django.VERSION >= (4, 2):
+    AsyncStreamingHttpResponse = StreamingHttpResponse
+
+else:
+    class AsyncStreamingHttpResponse(StreamingHttpResponse):
+        """
+        streaming_content is an async iterator of bytes. Only works when served by ASGIHandler below
+        """
+
+        @property
+        def streaming_content(self):
+            return self._stream()
+
+        @streaming_content.setter
+        def streaming_content(self, value):
+            self._iterator = value.__aiter__()
+
+        async def _stream(self):
+            async for part in self._iterator:
+                yield self.make_bytes(part)
+
+        def __iter__(self):
+            # nothing to iterate synchronously, ASGIHandler sends the content
+            return iter(())
+
+
+class ASGIHandler(DjangoASGIHandler):
+    async def send_response(self, response, send):
+        if AsyncStreamingHttpResponse is StreamingHttpResponse or not isinstance(response, AsyncStreamingHttpResponse):
+            return await super().send_response(response, send)
+
+        async def send_content_before_closing(message):
+            # django sends the headers, then (since the response iterates as empty) the closing message. The content goes right before that
+            if message["type"] == "http.response.body" and not message.get("more_body"):
+                async for part in response.streaming_content:
+                    for chunk, _ in self.chunk_bytes(part):
+                        await send({"type": "http.response.body", "body": chunk, "more_body": True})
+
+            await send(message)
+
+        await super().send_response(response, send_content_before_closing)
+
+
+def get_asgi_application():
+    """
+    django.core.asgi.get_asgi_application, with the ASGIHandler above
+    """
+    django.setup(set_prefix=False)
+    return ASGIHandler()
@@ -0,0 +1,300 @@
+"""
+Async versions of the transcribe, resume-request and check-status endpoints, for when running under ASGI (see config/asgi.py)
+
+- Set USE_ASYNC_VIEWS=true to route to these instead of the ones in views.py
+- The firestore and speech clients we use are sync only, so their calls get offloaded to a thread pool. The event loop stays free to take other requests while they wait on Google
+- Calls that don't depend on each other run at the same time (e.g., refreshing from firestore and getting the operation from Google in check_status)
+- status_stream only exists here: it holds the connection open, which only makes sense on the event loop
+"""
+from django.http import HttpResponse
+from django.conf import settings
+from asgiref.sync import sync_to_async
+import asyncio
+import logging
+
+from .helpers import get_operation, snapshot_hub
+from .transcribe_class import TranscribeRequest
+from . import responses, serialization
+from .responses import InvalidFields
+from .admission import Throttled
+from .status_stream import StatusBroadcaster, PollingEventSource, is_final
+from .transcript_store import ChunkedTranscript
+from .asgi import AsyncStreamingHttpResponse
+from .helpers import TRANSCRIPTION_STATUSES
+from . import views
+from .views import (
+    check_status_cache,
+    _check_status_response_data,
+    _project_response_data,
+    _check_status_cache_key,
+    _check_status_ttl,
+    _log_error,
+    _resume_message,
+    _start_transcribing,
+)
+
+logger = logging.getLogger('testlogger')
+
+# the same fields check-status needs in its body
+_STREAM_REQUIRED_PARAMS = ["id", "filename", "file_last_modified", "file_type"]
+
+
+def _csrf_exempt(view):
+    # django's csrf_exempt wraps the view in a sync function (at least before django 5), which hides that the view is async. All it needs is this attribute anyways
+    view.csrf_exempt = True
+    return view
+
+
+def _in_thread(func, *args):
+    """
+    run a blocking (firestore/Google) call in the thread pool, without tying up the event loop
+    """
+    return sync_to_async(func, thread_sensitive=False)(*args)
+
+
+###################################
+# Controllers
+###################################
+
+@_csrf_exempt
+async def transcribe(req):
+    """
+    async version of views.transcribe
+    - each step depends on the one before (and we don't want "transcribing" to be written before "processing-file"), so nothing to run concurrently here, but at least the event loop isn't blocked
+    """
+    transcribe_request = False
+
+    try:
+        if req.method != "POST":
+            logger.info(req.method)
+            return HttpResponse(f"<html><body>Needs to be a post....</body></html>")
+
+        file_data = serialization.loads(req.body)
+        fields = responses.requested_fields(req, file_data)
+        transcribe_request = TranscribeRequest(file_data)
+        await _in_thread(_start_transcribing, transcribe_request)
+
+        return responses.json_response(req, {
+            "current_request_data": responses.project(responses.serialize(transcribe_request), fields)
+        })
+
+    except InvalidFields as error:
+        return responses.invalid_fields_response(error)
+
+    except Throttled as error:
+        return responses.throttled_response(error)
+
+    except Exception as error:
+        logger.info("error transcribing file")
+        return await _in_thread(_log_error, error, transcribe_request)
+
+
+@_csrf_exempt
+async def resume_request(req):
+    """
+    async version of views.resume_request
+    """
+    transcribe_request = False
+
+    try:
+        file_data = serialization.loads(req.body)
+        transcribe_request = TranscribeRequest(file_data)
+
+        await _in_thread(transcribe_request.refresh_from_db)
+        message = await _in_thread(_resume_message, transcribe_request)
+
+        return HttpResponse(serialization.dumps({
+            "message": message
+        }), content_type='application/json')
+
+    except Throttled as error:
+        return responses.throttled_response(error)
+
+    except Exception as error:
+        logger.error("error resuming request")
+        return await _in_thread(_log_error, error, transcribe_request)
+
+
+@_csrf_exempt
+async def check_status(req):
+    """
+    async version of views.check_status. Uses the same cache, so concurrent polls for one operation still only cost one check
+    """
+    transcribe_request = False
+
+    try:
+        file_data = serialization.loads(req.body)
+        fields = responses.requested_fields(req, file_data)
+        transaction_id = file_data.get("transaction_id")
+
+        async def check():
+            nonlocal transcribe_request
+            # no I/O here (event logs are only loaded when needed)
+            transcribe_request = TranscribeRequest(file_data)
+            await _check_progress(transcribe_request, transaction_id)
+
+            return _check_status_response_data(transcribe_request)
+
+        if transaction_id:
+            response_data = await check_status_cache.get_or_load_async(_check_status_cache_key(file_data), check, _check_status_ttl)
+        else:
+            response_data = await check()
+
+        return responses.json_response(req, _project_response_data(response_data, fields))
+
+    except InvalidFields as error:
+        return responses.invalid_fields_response(error)
+
+    except Exception as error:
+        logger.error("error checking status")
+        return await _in_thread(_log_error, error, transcribe_request)
+
+
+@_csrf_exempt
+async def check_status_bulk(req):
+    """
+    async version of views.check_status_bulk. The operation lookups already run at the same time in views.bulk_executor, so the whole thing just runs off the event loop
+    """
+    return await _in_thread(views.check_status_bulk, req)
+
+
+@_csrf_exempt
+async def status_stream(req):
+    """
+    Server-Sent Events instead of polling check-status
+    - GET (EventSource can't POST), with what check-status takes in its body as query params instead
+    - fields= works like for check-status. Sends a status event whenever any of those change, then a done event (and closes) once the request is processed or errored
+    - transcript=true also sends a transcript event with all the utterances, once processed
+    - everyone listening to the same request shares one check (see status_stream.py)
+    - closes after STATUS_STREAM_MAX_SECONDS anyway. EventSource reconnects by itself
+    """
+    try:
+        file_data = req.GET.dict()
+        fields = responses.requested_fields(req, file_data)
+    except InvalidFields as error:
+        return responses.invalid_fields_response(error)
+
+    missing = [param for param in _STREAM_REQUIRED_PARAMS if not file_data.get(param)]
+    if missing:
+        return HttpResponse(serialization.dumps({"error": f"Missing params: {', '.join(missing)}"}), status=400, content_type='application/json')
+
+    key = f"{file_data.get('user_id')}/{file_data['id']}"
+    events = _status_events(key, file_data, fields, file_data.get("transcript") == "true")
+
+    response = AsyncStreamingHttpResponse(events, content_type="text/event-stream")
+    response["Cache-Control"] = "no-cache"
+    # so proxies don't hold on to events
+    response["X-Accel-Buffering"] = "no"
+    return response
+
+
+##########################################
+# Controller Helpers
+#######################
+async def _load_status(file_data):
+    """
+    what check_status does, for status_stream's polling
+    """
+    transaction_id = file_data.get("transaction_id")
+
+    async def check():
+        transcribe_request = TranscribeRequest(file_data)
+        await _check_progress(transcribe_request, transaction_id)
+
+        return _check_status_response_data(transcribe_request)
+
+    if transaction_id:
+        return await check_status_cache.get_or_load_async(_check_status_cache_key(file_data), check, _check_status_ttl)
+
+    return await check()
+
+
+status_broadcaster = StatusBroadcaster(PollingEventSource(_load_status, interval=settings.POLLER_INTERVAL, max_interval=settings.POLLER_MAX_INTERVAL))
+
+
+def _sse(event, data):
+    return f"event: {event}\ndata: {serialization.dumps_str(data)}\n\n"
+
+
+def _load_transcript(file_data):
+    transcribe_request = TranscribeRequest(file_data)
+    transcribe_request.refresh_from_db()
+    if not transcribe_request.transcript_pages:
+        return []
+
+    return ChunkedTranscript(transcribe_request.transcript_document_ref(), transcribe_request.transcript_pages).utterances()
+
+
+async def _status_events(key, file_data, fields, send_transcript):
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + settings.STATUS_STREAM_MAX_SECONDS
+    sent = None
+
+    # how long EventSource should wait before reconnecting (ms)
+    yield f"retry: {int(settings.POLLER_INTERVAL * 1000)}\n\n"
+
+    # keep the shared listener on this request going while anyone is streaming it, so each poll reads the local copy
+    document_path = TranscribeRequest(file_data).transcribe_request_ref().path if settings.SNAPSHOT_HUB else None
+    if document_path:
+        await _in_thread(snapshot_hub.acquire, document_path)
+
+    try:
+        async with status_broadcaster.subscribe(key, file_data) as subscription:
+            while True:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    return
+
+                try:
+                    data = await subscription.get(timeout=min(settings.STATUS_STREAM_HEARTBEAT_SECONDS, remaining))
+                except asyncio.TimeoutError:
+                    # a comment, so the connection doesn't get closed for being idle (Heroku's router closes after 55 seconds)
+                    yield ": keep-alive\n\n"
+                    continue
+
+                if data is None:
+                    return
+
+                projected = _project_response_data(data, fields)
+                if projected != sent:
+                    yield _sse("status", projected)
+                    sent = projected
+
+                if is_final(data):
+                    status = data["current_request_data"].get("status")
+                    if send_transcript and status == TRANSCRIPTION_STATUSES[5]: # transcription-processed
+                        utterances = await _in_thread(_load_transcript, file_data)
+                        yield _sse("transcript", {"utterances": utterances})
+
+                    yield _sse("done", {"status": status})
+                    return
+
+    finally:
+        if document_path:
+            snapshot_hub.release(document_path)
+
+
+async def _check_progress(transcribe_request, transaction_id):
+    """
+    refresh from firestore and get the operation from Google at the same time, since they don't depend on each other
+    """
+    if settings.BACKGROUND_POLLING or not transaction_id:
+        await _in_thread(transcribe_request.refresh_from_db)
+        if not settings.BACKGROUND_POLLING:
+            await _in_thread(transcribe_request.check_transcription_progress)
+        return
+
+    _, operation_dict = await asyncio.gather(
+        _in_thread(transcribe_request.refresh_from_db),
+        _in_thread(get_operation, transaction_id),
+    )
+
+    if transcribe_request.child_operations:
+        # split mode, so need all the segments' operations (transaction_id is just the first)
+        operation_dict = await _in_thread(transcribe_request.get_operation_dict)
+
+    elif transcribe_request.transaction_id != transaction_id:
+        # client had an old transaction_id, so get the operation that the db has
+        operation_dict = await _in_thread(get_operation, transcribe_request.transaction_id)
+
+    await _in_thread(transcribe_request.apply_operation, operation_dict)
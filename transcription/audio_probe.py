@@ -0,0 +1,224 @@
+"""
+Reads the header of an audio file to find its encoding, sample rate and channel count, before we send it to Google
+
+- Only downloads the first few KB of the file (ranged read), and parses WAV, FLAC and MP3 headers in pure python
+- Means we can send the right RecognitionConfig the first time, instead of guessing (e.g., 16000 hertz for every mp3) and retrying when Google errors
+- Returns None if it can't tell, in which case we fall back to the old defaults
+"""
+import struct
+import logging
+from collections import namedtuple
+
+logger = logging.getLogger('testlogger')
+
+# enough for WAV and FLAC headers, and for MP3s unless they have a big ID3 tag (e.g., album art), which gets skipped with a second read
+PROBE_BYTES = 16 * 1024
+
+# encoding is the name of a google RecognitionConfig.AudioEncoding
+AudioInfo = namedtuple("AudioInfo", ["encoding", "sample_rate_hertz", "channels", "bits_per_sample"])
+
+
+class NeedMoreData(Exception):
+    """
+    the header goes past the end of what we read. offset is where to read from next
+    """
+    def __init__(self, offset):
+        super().__init__(f"need data from offset {offset}")
+        self.offset = offset
+
+
+#########################################
+# WAV
+################################
+
+# from the WAVE fmt chunk
+_WAV_FORMATS = {
+    1: "LINEAR16", # PCM
+    7: "MULAW",
+}
+_WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+
+def probe_wav(data):
+    if len(data) < 12 or data[0:4] != b"RIFF" or data[8:12] != b"WAVE":
+        return None
+
+    offset = 12
+    while offset + 8 <= len(data):
+        chunk_id = data[offset:offset + 4]
+        chunk_size = struct.unpack_from("<I", data, offset + 4)[0]
+        if chunk_id == b"fmt ":
+            if offset + 8 + 16 > len(data):
+                raise NeedMoreData(len(data))
+
+            audio_format, channels, sample_rate, _, _, bits_per_sample = struct.unpack_from("<HHIIHH", data, offset + 8)
+            if audio_format == _WAVE_FORMAT_EXTENSIBLE and chunk_size >= 40:
+                # actual format is the first two bytes of the sub format guid
+                audio_format = struct.unpack_from("<H", data, offset + 8 + 24)[0]
+
+            return AudioInfo(_WAV_FORMATS.get(audio_format), sample_rate, channels, bits_per_sample)
+
+        # chunks are padded to an even size
+        offset += 8 + chunk_size + (chunk_size % 2)
+
+    raise NeedMoreData(offset)
+
+
+#########################################
+# FLAC
+################################
+
+def probe_flac(data):
+    """
+    sample rate etc are in the STREAMINFO block, which is always the first metadata block
+    """
+    if data[0:4] != b"fLaC":
+        return None
+
+    if len(data) < 8 + 18:
+        raise NeedMoreData(len(data))
+
+    block_type = data[4] & 0x7F
+    if block_type != 0:
+        return None
+
+    # skip min/max block size (2 + 2 bytes) and min/max frame size (3 + 3 bytes)
+    # then 20 bits sample rate, 3 bits (channels - 1), 5 bits (bits per sample - 1)
+    packed = int.from_bytes(data[18:22], "big")
+    sample_rate = packed >> 12
+    channels = ((packed >> 9) & 0x7) + 1
+    bits_per_sample = ((packed >> 4) & 0x1F) + 1
+
+    return AudioInfo("FLAC", sample_rate, channels, bits_per_sample)
+
+
+#########################################
+# MP3
+################################
+
+# index by version bits, then sample rate bits
+_MP3_SAMPLE_RATES = {
+    3: [44100, 48000, 32000], # MPEG 1
+    2: [22050, 24000, 16000], # MPEG 2
+    0: [11025, 12000, 8000],  # MPEG 2.5
+}
+# layer III bitrates in kbps, by bitrate bits
+_MP3_BITRATES = {
+    "v1": [None, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, None],
+    "v2": [None, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160, None],
+}
+
+
+def _id3_size(data):
+    """
+    size of the ID3v2 tag at the start of data (including its header), or 0 if there isn't one
+    """
+    if len(data) < 10 or data[0:3] != b"ID3":
+        return 0
+
+    # "syncsafe" int, 7 bits per byte
+    size = 0
+    for byte in data[6:10]:
+        size = (size << 7) | (byte & 0x7F)
+
+    has_footer = data[5] & 0x10
+    return 10 + size + (10 if has_footer else 0)
+
+
+def _mp3_frame(data, offset):
+    """
+    returns (AudioInfo, frame length) if there is a valid layer III frame header at offset, else None
+    """
+    if offset + 4 > len(data):
+        return None
+
+    header = int.from_bytes(data[offset:offset + 4], "big")
+    if header >> 21 != 0x7FF:
+        return None
+
+    version = (header >> 19) & 0x3
+    layer = (header >> 17) & 0x3
+    bitrate_index = (header >> 12) & 0xF
+    sample_rate_index = (header >> 10) & 0x3
+    padding = (header >> 9) & 0x1
+    channel_mode = (header >> 6) & 0x3
+
+    # version 1 is reserved, and layer 1 (in the bits) means layer III
+    if version == 1 or layer != 1 or sample_rate_index == 3:
+        return None
+
+    bitrate = _MP3_BITRATES["v1" if version == 3 else "v2"][bitrate_index]
+    if bitrate is None:
+        return None
+
+    sample_rate = _MP3_SAMPLE_RATES[version][sample_rate_index]
+    samples_per_frame = 1152 if version == 3 else 576
+    frame_length = samples_per_frame // 8 * bitrate * 1000 // sample_rate + padding
+    # channel mode 3 is mono, everything else (stereo, joint stereo, dual channel) is 2 channels
+    channels = 1 if channel_mode == 3 else 2
+
+    return AudioInfo("MP3", sample_rate, channels, None), frame_length
+
+
+def probe_mp3(data, offset=0):
+    """
+    - offset is where data starts within the file (for when we had to read again past a big ID3 tag)
+    - checks the frame after the first one too, so we don't get fooled by random bytes that happen to look like a header
+    """
+    if offset == 0:
+        tag_size = _id3_size(data)
+        if tag_size >= len(data):
+            raise NeedMoreData(tag_size)
+    else:
+        tag_size = 0
+
+    # sometimes there's junk before the first frame, so scan for it
+    position = tag_size
+    while position + 4 <= len(data):
+        frame = _mp3_frame(data, position)
+        if frame:
+            info, frame_length = frame
+            next_position = position + frame_length
+            if next_position + 4 > len(data) or _mp3_frame(data, next_position):
+                return info
+
+        position += 1
+
+    return None
+
+
+#########################################
+# Probing
+################################
+
+def probe_header(data, offset=0):
+    """
+    data is the beginning of the file (or from offset, if re-reading past an ID3 tag). Returns AudioInfo or None
+    """
+    if offset == 0:
+        for probe in (probe_wav, probe_flac):
+            info = probe(data)
+            if info:
+                return info
+
+    return probe_mp3(data, offset)
+
+
+def probe_blob(blob, probe_bytes=PROBE_BYTES):
+    """
+    reads just the start of the blob (and a bit more if the header turns out to be further in) and probes it
+    """
+    # end is inclusive
+    data = blob.download_as_string(start=0, end=probe_bytes - 1)
+    try:
+        return probe_header(data)
+    except NeedMoreData as need_more:
+        if len(data) < probe_bytes:
+            # that was the whole file
+            return None
+
+        data = blob.download_as_string(start=need_more.offset, end=need_more.offset + probe_bytes - 1)
+        try:
+            return probe_header(data, offset=need_more.offset)
+        except NeedMoreData:
+            return None
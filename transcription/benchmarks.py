@@ -0,0 +1,395 @@
+"""
+Micro-benchmarks, run with `python manage.py benchmark <case>`
+
+- Each case is a function that takes the parsed options and returns a dict of results, which gets printed by the command
+- Register a case with the @benchmark decorator
+"""
+import time
+import statistics
+import os
+import re
+import json
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import subprocess
+import sys
+
+BENCHMARKS = {}
+
+
+def benchmark(name):
+    def register(func):
+        BENCHMARKS[name] = func
+        return func
+
+    return register
+
+
+def time_calls(func, iterations):
+    """
+    calls func iterations times and returns timing stats, in milliseconds per call
+    """
+    durations = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        func()
+        durations.append((time.perf_counter() - start) * 1000)
+
+    durations.sort()
+    return {
+        "iterations": iterations,
+        "mean_ms": round(statistics.mean(durations), 4),
+        "p50_ms": round(durations[len(durations) // 2], 4),
+        "p95_ms": round(durations[min(len(durations) - 1, int(len(durations) * 0.95))], 4),
+    }
+
+
+#########################################
+# Cases
+################################
+
+@benchmark("operations-poll")
+def operations_poll(options):
+    """
+    per-poll latency of looking up an operation, before (building the discovery client on every poll) and after (shared OperationsLookup)
+    - by default uses a fake backend for the actual GET and anonymous credentials for building the client, so it runs offline and what is measured is the overhead of building the client
+    - pass --operation-name to hit Google for real (needs google credentials)
+    """
+    from googleapiclient import discovery
+    from google.auth.credentials import AnonymousCredentials
+    from .operations import OperationsLookup, DiscoveryOperationsBackend, FakeOperationsBackend
+
+    iterations = options["iterations"]
+    operation_name = options.get("operation_name")
+
+    if operation_name:
+        backend = DiscoveryOperationsBackend()
+        build_client = lambda: discovery.build('speech', 'v1p1beta1')
+    else:
+        operation_name = "fake-operation"
+        backend = FakeOperationsBackend({operation_name: {"name": operation_name, "metadata": {}}})
+        # the discovery document ships with the client library, so this doesn't need credentials or the network
+        credentials = AnonymousCredentials()
+        build_client = lambda: discovery.build('speech', 'v1p1beta1', credentials=credentials, cache_discovery=False)
+
+    def before():
+        # what get_operation used to do on every poll
+        build_client()
+        backend.get_operation(operation_name)
+
+    lookup = OperationsLookup(lambda: backend)
+
+    def after():
+        lookup.get(operation_name)
+
+    return {
+        "before": time_calls(before, iterations),
+        "after": time_calls(after, iterations),
+    }
+
+
+@benchmark("import-time")
+def import_time(options):
+    """
+    cold-start cost of importing our modules, using `python -X importtime` in a fresh process
+    - also checks that importing doesn't create any of the google clients (see services.py)
+    - pass --budget-ms to fail if importing transcription.views takes longer than that (e.g., in CI)
+    """
+    module = options.get("module") or "transcription.views"
+    code = (
+        "import django; django.setup(); "
+        f"import {module}; "
+        "from transcription.helpers import services; "
+        "print(','.join(services.initialized()))"
+    )
+    env = {**os.environ, "DJANGO_SETTINGS_MODULE": os.environ.get("DJANGO_SETTINGS_MODULE", "config.settings")}
+    process = subprocess.run([sys.executable, "-X", "importtime", "-c", code], capture_output=True, text=True, env=env)
+    if process.returncode != 0:
+        raise RuntimeError(process.stderr[-2000:])
+
+    # lines look like: "import time:       341 |       5127 | transcription.helpers"
+    cumulative = {}
+    for line in process.stderr.splitlines():
+        match = re.match(r"import time:\s+(\d+) \|\s+(\d+) \|(\s*)(\S+)", line)
+        if match:
+            cumulative[match.group(4)] = int(match.group(2)) / 1000
+
+    slowest = sorted(cumulative.items(), key=lambda item: item[1], reverse=True)[:10]
+    results = {
+        "module": module,
+        "cumulative_ms": cumulative.get(module),
+        "slowest_ms": dict(slowest),
+        "services_initialized_on_import": [name for name in process.stdout.strip().split(",") if name],
+    }
+
+    budget_ms = options.get("budget_ms")
+    if budget_ms is not None:
+        results["over_budget"] = (results["cumulative_ms"] or 0) > budget_ms or bool(results["services_initialized_on_import"])
+
+    return results
+
+
+@benchmark("views-load")
+def views_load(options):
+    """
+    requests/sec for check-status, sync views vs async views, against the fakes with simulated latency on every firestore/Google round trip
+    - sync views are served by --workers threads at a time, like that many gunicorn sync workers
+    - async views are run on one event loop, with up to --concurrency requests in flight
+    """
+    from django.test import RequestFactory
+    from .fakes import FakeFirestore
+    from .operations import FakeOperationsBackend
+    from .helpers import services, operations_lookup
+    from . import views, async_views
+
+    request_count = options["iterations"]
+    latency = options["latency_ms"] / 1000
+    factory = RequestFactory()
+
+    def seed():
+        # new docs each run, so that both runs do the same amount of writing
+        db = FakeFirestore()
+        backend = FakeOperationsBackend()
+        bodies = []
+        for i in range(request_count):
+            doc = {
+                "filename": f"sermon-{i}.flac",
+                "file_last_modified": "1587849000",
+                "id": f"request-{i}",
+                "user_id": "user-1",
+                "file_type": "audio/flac",
+                "status": "transcribing",
+                "transaction_id": f"op-{i}",
+            }
+            db.document(f"users/user-1/transcribeRequests/request-{i}").set(doc)
+            backend.set_operation(f"op-{i}", {
+                "name": f"op-{i}",
+                "metadata": {"progressPercent": 50, "startTime": "2020-04-25T21:22:07.436054Z", "lastUpdateTime": "2020-04-25T21:22:14.434078Z"},
+            })
+            bodies.append(json.dumps(doc))
+
+        db.latency = backend.latency = latency
+        return db, backend, bodies
+
+    def make_request(body):
+        return factory.post("/check-status/", data=body, content_type="application/json")
+
+    def run_sync(bodies):
+        with ThreadPoolExecutor(max_workers=options["workers"]) as executor:
+            return list(executor.map(lambda body: views.check_status(make_request(body)), bodies))
+
+    async def run_async(bodies):
+        semaphore = asyncio.Semaphore(options["concurrency"])
+
+        async def one(body):
+            async with semaphore:
+                return await async_views.check_status(make_request(body))
+
+        return await asyncio.gather(*(one(body) for body in bodies))
+
+    results = {}
+    for name, run in [("sync", run_sync), ("async", lambda bodies: asyncio.run(run_async(bodies)))]:
+        db, backend, bodies = seed()
+        views.check_status_cache.clear()
+        operations_lookup.set_backend(backend)
+        try:
+            with services.override(db=db):
+                start = time.perf_counter()
+                responses = run(bodies)
+                elapsed = time.perf_counter() - start
+        finally:
+            operations_lookup.reset()
+
+        results[name] = {
+            "requests": request_count,
+            "errors": sum(1 for response in responses if response.status_code != 200),
+            "seconds": round(elapsed, 3),
+            "requests_per_second": round(request_count / elapsed, 2),
+        }
+
+    return results
+
+
+@benchmark("audio-probe")
+def audio_probe(options):
+    """
+    time to probe each file in transcription/fixtures/audio (or --path, a file or dir), reading from a fake bucket
+    - pass --latency-ms to see what the ranged read(s) add, since that's what dominates in real life
+    """
+    from .audio_probe import probe_blob
+    from .fakes import FakeBucket
+
+    path = options.get("path") or os.path.join(os.path.dirname(__file__), "fixtures", "audio")
+    filenames = [os.path.join(path, name) for name in sorted(os.listdir(path))] if os.path.isdir(path) else [path]
+
+    bucket = FakeBucket(latency=(options.get("latency_ms") or 0) / 1000)
+    results = {}
+    for filename in filenames:
+        name = os.path.basename(filename)
+        with open(filename, "rb") as f:
+            bucket.blobs[name] = f.read()
+
+        blob = bucket.blob(name)
+        round_trips = bucket.round_trips
+        info = probe_blob(blob)
+
+        results[name] = {
+            "info": info._asdict() if info else None,
+            "reads": bucket.round_trips - round_trips,
+            **time_calls(lambda: probe_blob(blob), options["iterations"]),
+        }
+
+    return results
+
+
+def synthetic_results(minutes=60, words_per_minute=150, words_per_result=15, alternatives=3):
+    """
+    made up results in the Firestore shape, about what Google gives back for a sermon that long (words only on the top alternative, like Google does)
+    """
+    from .stitching import format_duration_nanos
+
+    results = []
+    word_nanos = 60 * 10 ** 9 // words_per_minute
+    total_words = minutes * words_per_minute
+    for first in range(0, total_words, words_per_result):
+        indexes = range(first, min(first + words_per_result, total_words))
+        words = [{
+            "startTime": format_duration_nanos(i * word_nanos),
+            "endTime": format_duration_nanos((i + 1) * word_nanos),
+            "word": f"ពាក្យ{i}",
+            "confidence": 0.9,
+        } for i in indexes]
+        transcript = " ".join(word["word"] for word in words)
+        results.append({
+            "alternatives": [{"transcript": transcript, "confidence": 0.92, "words": words}] + [
+                {"transcript": transcript + f" alt{n}"} for n in range(1, alternatives)
+            ],
+            "resultEndTime": words[-1]["endTime"],
+            "languageCode": "km-kh",
+        })
+
+    return results
+
+
+@benchmark("transcript-compact")
+def transcript_compact(options):
+    """
+    memory and (de)serialization time of a synthetic hour long transcript, as nested dicts vs CompactTranscript
+    - pass --minutes for a different length
+    """
+    import tracemalloc
+    from .compact_transcript import CompactTranscript
+
+    minutes = options.get("minutes") or 60
+    iterations = max(1, options["iterations"] // 10)
+    # as if it just came from Google/Firestore
+    raw = json.dumps(synthetic_results(minutes=minutes), ensure_ascii=False)
+
+    tracemalloc.start()
+    results = json.loads(raw)
+    dicts_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    tracemalloc.start()
+    compact = CompactTranscript.from_results(results)
+    compact_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    if compact.to_results() != results:
+        raise AssertionError("CompactTranscript didn't convert back to the same results")
+
+    return {
+        "minutes": minutes,
+        "results": len(results),
+        "words": compact.word_count(),
+        "json_bytes": len(raw.encode("utf-8")),
+        "memory_bytes": {
+            "dicts": dicts_bytes,
+            "compact": compact_bytes,
+            "ratio": round(compact_bytes / dicts_bytes, 3),
+        },
+        "dicts_to_json": time_calls(lambda: json.dumps(results, ensure_ascii=False), iterations),
+        "compact_to_json": time_calls(lambda: json.dumps(compact.to_results(), ensure_ascii=False), iterations),
+        "from_results": time_calls(lambda: CompactTranscript.from_results(results), iterations),
+    }
+
+
+@benchmark("json-serialize")
+def json_serialize(options):
+    """
+    dumps/loads of a synthetic transcript (as it would go out in a response) and of a check-status response, with each json backend that's installed
+    - pass --minutes for a different transcript length
+    """
+    from . import serialization
+    from .helpers import TRANSCRIPTION_STATUSES
+
+    minutes = options.get("minutes") or 60
+    iterations = max(1, options["iterations"] // 10)
+    payloads = {
+        # what check-status sends back with fields=status,utterances once it's done
+        "transcript": {"current_request_data": {"status": TRANSCRIPTION_STATUSES[5], "utterances": synthetic_results(minutes=minutes)}}, # transcription-processed
+        "check_status": {
+            "message": "Transcribing",
+            "progress_percent": 42,
+            "current_request_data": {"status": "transcribing", "progress_percent": 42, "updated_at": "2020-05-01T00:00:00Z"},
+        },
+    }
+
+    backends = ["json"] + (["orjson"] if serialization.orjson is not None else [])
+    previous = serialization.get_backend().name
+    results = {"minutes": minutes, "backends": backends}
+    try:
+        for name in backends:
+            backend = serialization.set_backend(name)
+            for payload_name, payload in payloads.items():
+                # small payloads are so fast, need more of them to measure anything
+                count = iterations if payload_name == "transcript" else options["iterations"] * 10
+                raw = backend.dumps(payload, sort_keys=True)
+                results[f"{payload_name}_bytes"] = len(raw)
+                results[f"{name}_{payload_name}_dumps"] = time_calls(lambda: backend.dumps(payload, sort_keys=True), count)
+                results[f"{name}_{payload_name}_loads"] = time_calls(lambda: backend.loads(raw), count)
+    finally:
+        serialization.set_backend(previous)
+
+    return results
+
+
+@benchmark("metrics-overhead")
+def metrics_overhead(options):
+    """
+    what recording metrics adds to each call on the hot path: timed() around a fake firestore read, and a status transition, compared to without
+    - each timed call does 1000 of them, so the result is about the same in microseconds per call
+    """
+    from django.test.utils import override_settings
+    from .fakes import FakeFirestore
+    from .metrics import timed, record_transition
+
+    db = FakeFirestore()
+    ref = db.document("users/user-1/transcribeRequests/request-1")
+    ref.set({"status": "transcribing"})
+    batch = 1000
+
+    def bare():
+        for _ in range(batch):
+            ref.get()
+
+    def with_timed():
+        for _ in range(batch):
+            with timed("firestore", "get"):
+                ref.get()
+
+    def transitions():
+        for _ in range(batch):
+            record_transition("processing-file", "transcribing", since="20200501T000000Z")
+
+    results = {
+        "batch": batch,
+        "firestore_get": time_calls(bare, options["iterations"]),
+        "firestore_get_timed": time_calls(with_timed, options["iterations"]),
+        "status_transition": time_calls(transitions, options["iterations"]),
+    }
+    with override_settings(METRICS=False):
+        results["firestore_get_timed_metrics_off"] = time_calls(with_timed, options["iterations"])
+
+    results["timed_overhead_us"] = round((results["firestore_get_timed"]["mean_ms"] - results["firestore_get"]["mean_ms"]) * 1000 / batch, 3)
+    return results
@@ -0,0 +1,199 @@
+"""
+Small in-process LRU + TTL cache, with single-flight loading
+
+- Used in front of check_status, so that several clients polling the same operation within a few seconds only cost one round of firestore + Google calls
+- If several threads ask for the same key at once and it isn't cached, only one of them runs the loader; the rest wait for and share its result (or its error)
+- Thread-safe. Is per process though, so each gunicorn worker has its own
+- get_or_load_async does the same for coroutines on the event loop (async_views.py). Waiting on someone else's load awaits, so it doesn't hold a thread
+"""
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+
+# use as ttl to keep an entry until it gets evicted
+NO_EXPIRY = None
+_DEFAULT = object()
+
+
+class _InFlight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class TTLCache:
+    def __init__(self, maxsize=1024, ttl=5, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        # key > (expires_at, value), ordered from least to most recently used
+        self._entries = OrderedDict()
+        self._in_flight = {}
+        # same, for get_or_load_async. key > future
+        self._in_flight_async = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.coalesced = 0
+
+    def _get_locked(self, key):
+        """
+        returns (found, value). Caller has to hold the lock
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            return False, None
+
+        expires_at, value = entry
+        if expires_at is not None and expires_at <= self.clock():
+            del self._entries[key]
+            self.expirations += 1
+            return False, None
+
+        self._entries.move_to_end(key)
+        return True, value
+
+    def _set_locked(self, key, value, ttl):
+        expires_at = None if ttl is NO_EXPIRY else self.clock() + ttl
+        self._entries[key] = (expires_at, value)
+        self._entries.move_to_end(key)
+
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def get(self, key, default=None):
+        with self._lock:
+            found, value = self._get_locked(key)
+            if found:
+                self.hits += 1
+                return value
+
+            self.misses += 1
+            return default
+
+    def set(self, key, value, ttl=_DEFAULT):
+        with self._lock:
+            self._set_locked(key, value, self.ttl if ttl is _DEFAULT else ttl)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def get_or_load(self, key, loader, ttl=_DEFAULT):
+        """
+        - returns the cached value for key, or calls loader() to get it and caches that
+        - ttl can be a number of seconds, NO_EXPIRY, or a function that takes the loaded value and returns one of those (e.g., so finished operations can be kept until eviction)
+        - errors from loader are not cached, but are raised for everyone who was waiting on that load
+        """
+        with self._lock:
+            found, value = self._get_locked(key)
+            if found:
+                self.hits += 1
+                return value
+
+            in_flight = self._in_flight.get(key)
+            if in_flight is None:
+                self.misses += 1
+                in_flight = self._in_flight[key] = _InFlight()
+                is_leader = True
+            else:
+                self.coalesced += 1
+                is_leader = False
+
+        if not is_leader:
+            in_flight.done.wait()
+            if in_flight.error is not None:
+                raise in_flight.error
+
+            return in_flight.value
+
+        try:
+            value = loader()
+            with self._lock:
+                self._set_locked(key, value, self._entry_ttl(value, ttl))
+
+            in_flight.value = value
+            return value
+
+        except Exception as error:
+            in_flight.error = error
+            raise
+
+        finally:
+            with self._lock:
+                self._in_flight.pop(key, None)
+            in_flight.done.set()
+
+    async def get_or_load_async(self, key, loader, ttl=_DEFAULT):
+        """
+        get_or_load, but loader is a coroutine function, and is awaited on the running event loop
+        """
+        with self._lock:
+            found, value = self._get_locked(key)
+            if found:
+                self.hits += 1
+                return value
+
+            in_flight = self._in_flight_async.get(key)
+            if in_flight is None:
+                self.misses += 1
+                in_flight = self._in_flight_async[key] = asyncio.get_running_loop().create_future()
+                is_leader = True
+            else:
+                self.coalesced += 1
+                is_leader = False
+
+        if not is_leader:
+            # shield, so one waiter getting cancelled (e.g., its client went away) doesn't cancel it for everyone
+            return await asyncio.shield(in_flight)
+
+        try:
+            value = await loader()
+            with self._lock:
+                self._set_locked(key, value, self._entry_ttl(value, ttl))
+
+            in_flight.set_result(value)
+            return value
+
+        except Exception as error:
+            in_flight.set_exception(error)
+            # marks it as retrieved, so asyncio doesn't complain when no one else was waiting
+            in_flight.exception()
+            raise
+
+        finally:
+            with self._lock:
+                self._in_flight_async.pop(key, None)
+            if not in_flight.done():
+                # the leader got cancelled, so whoever was waiting gets cancelled too
+                in_flight.cancel()
+
+    def _entry_ttl(self, value, ttl):
+        if ttl is _DEFAULT:
+            return self.ttl
+        if callable(ttl):
+            return ttl(value)
+        return ttl
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "coalesced": self.coalesced,
+            }
@@ -0,0 +1,159 @@
+"""
+Compact, columnar version of a transcript's results (what Google returns, and what goes in the utterance pages)
+
+- The Firestore shape is a list of results, each with a list of alternatives, each with a list of word dicts. With max_alternatives 3 and word time offsets, an hour long sermon is tens of thousands of little dicts and strings
+- Here each alternative keeps its words as parallel columns instead: a list of the words, and arrays of start/end offsets (int nanoseconds), confidences and speaker tags
+- Results and alternatives are __slots__ records, so no __dict__ per object
+- Converts to and from the Firestore shape without losing anything (durations come back in the same format protobuf uses, and any fields we don't know about are kept as they are)
+- Indexing and slicing give back results in the Firestore shape, so it can be passed where a list of results is expected (e.g., ChunkedTranscript.append)
+"""
+import math
+from array import array
+
+from .stitching import parse_duration_nanos, format_duration_nanos
+
+# for a word that doesn't have one (e.g., confidence is only set when enable_word_confidence is on)
+_MISSING_TIME = -1
+_MISSING_CONFIDENCE = math.nan
+
+_RESULT_FIELDS = {"alternatives", "channelTag", "languageCode", "resultEndTime"}
+_ALTERNATIVE_FIELDS = {"transcript", "confidence", "words"}
+_WORD_FIELDS = {"word", "startTime", "endTime", "confidence", "speakerTag"}
+
+
+def _extra(data, known):
+    extra = {k: v for k, v in data.items() if k not in known}
+    return extra or None
+
+
+class CompactAlternative:
+    __slots__ = ("transcript", "confidence", "words", "start_nanos", "end_nanos", "word_confidences", "speaker_tags", "has_words", "word_extras", "extra")
+
+    @classmethod
+    def from_dict(cls, data):
+        alternative = cls()
+        alternative.transcript = data.get("transcript")
+        alternative.confidence = data.get("confidence")
+        alternative.has_words = "words" in data
+        alternative.extra = _extra(data, _ALTERNATIVE_FIELDS)
+
+        words = data.get("words") or []
+        alternative.words = [word.get("word") for word in words]
+        alternative.start_nanos = array("q", (parse_duration_nanos(word["startTime"]) if "startTime" in word else _MISSING_TIME for word in words))
+        alternative.end_nanos = array("q", (parse_duration_nanos(word["endTime"]) if "endTime" in word else _MISSING_TIME for word in words))
+        alternative.word_confidences = array("d", (word.get("confidence", _MISSING_CONFIDENCE) for word in words))
+        # proto3 leaves out 0, so 0 means there wasn't one
+        alternative.speaker_tags = array("i", (word.get("speakerTag", 0) for word in words))
+        # word index > fields we don't have a column for. Almost always empty
+        alternative.word_extras = {i: extra for i, extra in ((i, _extra(word, _WORD_FIELDS)) for i, word in enumerate(words)) if extra} or None
+
+        return alternative
+
+    def word_dict(self, i):
+        word = {}
+        if self.words[i] is not None:
+            word["word"] = self.words[i]
+        if self.start_nanos[i] != _MISSING_TIME:
+            word["startTime"] = format_duration_nanos(self.start_nanos[i])
+        if self.end_nanos[i] != _MISSING_TIME:
+            word["endTime"] = format_duration_nanos(self.end_nanos[i])
+        if not math.isnan(self.word_confidences[i]):
+            word["confidence"] = self.word_confidences[i]
+        if self.speaker_tags[i]:
+            word["speakerTag"] = self.speaker_tags[i]
+        if self.word_extras and i in self.word_extras:
+            word.update(self.word_extras[i])
+
+        return word
+
+    def to_dict(self):
+        data = {}
+        if self.transcript is not None:
+            data["transcript"] = self.transcript
+        if self.confidence is not None:
+            data["confidence"] = self.confidence
+        if self.has_words:
+            data["words"] = [self.word_dict(i) for i in range(len(self.words))]
+        if self.extra:
+            data.update(self.extra)
+
+        return data
+
+
+class CompactResult:
+    __slots__ = ("alternatives", "channel_tag", "language_code", "result_end_nanos", "has_alternatives", "extra")
+
+    @classmethod
+    def from_dict(cls, data):
+        result = cls()
+        result.has_alternatives = "alternatives" in data
+        result.alternatives = [CompactAlternative.from_dict(alternative) for alternative in data.get("alternatives") or []]
+        result.channel_tag = data.get("channelTag")
+        result.language_code = data.get("languageCode")
+        result.result_end_nanos = parse_duration_nanos(data["resultEndTime"]) if "resultEndTime" in data else None
+        result.extra = _extra(data, _RESULT_FIELDS)
+
+        return result
+
+    def to_dict(self):
+        data = {}
+        if self.has_alternatives:
+            data["alternatives"] = [alternative.to_dict() for alternative in self.alternatives]
+        if self.channel_tag is not None:
+            data["channelTag"] = self.channel_tag
+        if self.result_end_nanos is not None:
+            data["resultEndTime"] = format_duration_nanos(self.result_end_nanos)
+        if self.language_code is not None:
+            data["languageCode"] = self.language_code
+        if self.extra:
+            data.update(self.extra)
+
+        return data
+
+
+class CompactTranscript:
+    __slots__ = ("results",)
+
+    def __init__(self, results=None):
+        self.results = results or []
+
+    @classmethod
+    def from_results(cls, results):
+        """
+        results in the Firestore shape (list of dicts, as in operation_dict["response"]["results"])
+        """
+        if isinstance(results, CompactTranscript):
+            return results
+
+        return cls([CompactResult.from_dict(result) for result in results or []])
+
+    def to_results(self):
+        return [result.to_dict() for result in self.results]
+
+    def __len__(self):
+        return len(self.results)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [result.to_dict() for result in self.results[index]]
+
+        return self.results[index].to_dict()
+
+    def __iter__(self):
+        for result in self.results:
+            yield result.to_dict()
+
+    def __eq__(self, other):
+        if isinstance(other, CompactTranscript):
+            other = other.to_results()
+
+        return self.to_results() == other
+
+    def text(self):
+        """
+        the most likely transcript for each result, joined together
+        """
+        return " ".join(result.alternatives[0].transcript or "" for result in self.results if result.alternatives)
+
+    def word_count(self):
+        return sum(len(result.alternatives[0].words) for result in self.results if result.alternatives)
@@ -0,0 +1,514 @@
+"""
+In-memory stand-ins for Firestore, for tests and benchmarks
+
+- Only implements the parts of the google.cloud.firestore API that we actually use
+- Documents are stored in a flat dict keyed by path, e.g., "users/abc/transcribeRequests/xyz"
+- round_trips counts calls that would have gone over the network, so tests can assert how chatty something is
+- latency (in seconds) gets added to every round trip, e.g., for benchmarks
+- on_snapshot works for documents and collections. Listeners get called right after each write (on the writing thread), instead of from a background thread like the real thing
+"""
+import threading
+import time
+import base64
+import hashlib
+import uuid
+from datetime import datetime, timezone
+from copy import deepcopy
+from itertools import count
+
+from google.api_core import exceptions
+from google.cloud.firestore import ArrayUnion, Increment
+
+
+class FakeFirestore:
+    def __init__(self, latency=0):
+        self.latency = latency
+        self.documents = {}
+        self.round_trips = 0
+        self.writes = 0
+        self._lock = threading.RLock()
+        # fake version of update_time, just needs to change every time a doc is written
+        self._versions = count(1)
+        self._update_times = {}
+        self.watches = []
+        # paths written since listeners were last told
+        self._changed = []
+
+    def collection(self, name):
+        return FakeCollectionReference(self, name)
+
+    def document(self, path):
+        return FakeDocumentReference(self, path)
+
+    def collection_group(self, name):
+        return FakeQuery(self, name, group=True)
+
+    def get_all(self, references):
+        self._round_trip()
+        for reference in references:
+            yield reference._snapshot()
+
+    def batch(self):
+        return FakeWriteBatch(self)
+
+    def write_option(self, last_update_time=None, exists=None):
+        return {"last_update_time": last_update_time, "exists": exists}
+
+    def _watch(self, reference, callback):
+        watch = FakeWatch(self, reference, callback)
+        with self._lock:
+            self.watches.append(watch)
+        watch.send()
+        return watch
+
+    def _notify(self):
+        """
+        tells listeners about whatever was written. Called after the lock is released, so listeners can take their own locks
+        """
+        with self._lock:
+            changed, self._changed = self._changed, []
+            watches = list(self.watches)
+
+        for watch in watches:
+            if any(watch.covers(path) for path in changed):
+                watch.send()
+
+    #########################
+    # internal helpers (used by the refs)
+    #########################
+    def _round_trip(self):
+        with self._lock:
+            self.round_trips += 1
+
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _check_option(self, path, option):
+        if not option:
+            return
+
+        if option.get("last_update_time") is not None and self._update_times.get(path) != option["last_update_time"]:
+            raise exceptions.FailedPrecondition(f"{path} was updated since last read")
+
+        if option.get("exists") is False and path in self.documents:
+            raise exceptions.AlreadyExists(f"{path} already exists")
+
+    def _write(self, path, data, merge=False, option=None, field_paths=False):
+        """
+        - merge merges nested maps, like set(merge=True)
+        - field_paths treats keys like "a.b" as paths, and replaces maps rather than merging them, like update()
+        """
+        with self._lock:
+            self._check_option(path, option)
+            document = self.documents.get(path) if merge else None
+            document = document if document is not None else {}
+
+            if field_paths:
+                for key, value in data.items():
+                    *parents, field = key.split(".")
+                    target = document
+                    for parent in parents:
+                        target = target.setdefault(parent, {})
+                    target[field] = _merge({}, value) if isinstance(value, dict) else _resolve(target.get(field), value)
+            else:
+                _merge(document, data)
+
+            self.documents[path] = document
+
+            self.writes += 1
+            self._update_times[path] = next(self._versions)
+            self._changed.append(path)
+
+    def _delete(self, path):
+        with self._lock:
+            self.documents.pop(path, None)
+            self._update_times.pop(path, None)
+            self.writes += 1
+            self._changed.append(path)
+
+
+def _resolve(existing, value):
+    """
+    apply firestore transforms (ArrayUnion, Increment), otherwise just the value
+    """
+    if isinstance(value, ArrayUnion):
+        values = list(existing) if isinstance(existing, list) else []
+        values.extend(v for v in value.values if v not in values)
+        return values
+
+    if isinstance(value, Increment):
+        return (existing if isinstance(existing, (int, float)) else 0) + value.value
+
+    return deepcopy(value)
+
+
+def _merge(target, data):
+    for key, value in data.items():
+        if isinstance(value, dict):
+            if not isinstance(target.get(key), dict):
+                target[key] = {}
+            _merge(target[key], value)
+        else:
+            target[key] = _resolve(target.get(key), value)
+
+    return target
+
+
+class FakeWatch:
+    def __init__(self, client, reference, callback):
+        self._client = client
+        self.reference = reference
+        self.callback = callback
+        self.calls = 0
+
+    def covers(self, path):
+        if isinstance(self.reference, FakeDocumentReference):
+            return path == self.reference.path
+
+        return self.reference._in_collection(path)
+
+    def send(self):
+        if isinstance(self.reference, FakeDocumentReference):
+            snapshots = [self.reference._snapshot()]
+        else:
+            snapshots = list(self.reference._snapshots())
+
+        self.calls += 1
+        self.callback(snapshots, [], None)
+
+    def unsubscribe(self):
+        with self._client._lock:
+            if self in self._client.watches:
+                self._client.watches.remove(self)
+
+
+class FakeDocumentSnapshot:
+    def __init__(self, reference, data, update_time=None):
+        self.reference = reference
+        self.id = reference.id
+        self.exists = data is not None
+        self.update_time = update_time
+        self._data = data
+
+    def to_dict(self):
+        return deepcopy(self._data) if self.exists else None
+
+    def get(self, field):
+        return (self._data or {}).get(field)
+
+
+class FakeDocumentReference:
+    def __init__(self, client, path):
+        self._client = client
+        self.path = path
+        self.id = path.split("/")[-1]
+
+    @property
+    def parent(self):
+        return FakeCollectionReference(self._client, "/".join(self.path.split("/")[:-1]))
+
+    def collection(self, name):
+        return FakeCollectionReference(self._client, f"{self.path}/{name}")
+
+    def _snapshot(self):
+        client = self._client
+        with client._lock:
+            return FakeDocumentSnapshot(self, deepcopy(client.documents.get(self.path)), client._update_times.get(self.path))
+
+    def get(self, **kwargs):
+        self._client._round_trip()
+        return self._snapshot()
+
+    def set(self, document_data, merge=False):
+        self._client._round_trip()
+        self._client._write(self.path, document_data, merge=merge)
+        self._client._notify()
+
+    def update(self, field_updates, option=None):
+        self._client._round_trip()
+        if self.path not in self._client.documents:
+            raise exceptions.NotFound(f"No document to update: {self.path}")
+
+        self._client._write(self.path, field_updates, merge=True, option=option, field_paths=True)
+        self._client._notify()
+
+    def create(self, document_data):
+        self._client._round_trip()
+        self._client._write(self.path, document_data, option={"exists": False})
+        self._client._notify()
+
+    def delete(self, **kwargs):
+        self._client._round_trip()
+        self._client._delete(self.path)
+        self._client._notify()
+
+    def on_snapshot(self, callback):
+        return self._client._watch(self, callback)
+
+
+class FakeQuery:
+    def __init__(self, client, collection_path, group=False, filters=None, limit=None):
+        self._client = client
+        self._collection_path = collection_path
+        self._group = group
+        self._filters = filters or []
+        self._limit = limit
+
+    def where(self, field, op, value):
+        return FakeQuery(self._client, self._collection_path, self._group, self._filters + [(field, op, value)], self._limit)
+
+    def limit(self, count):
+        return FakeQuery(self._client, self._collection_path, self._group, self._filters, count)
+
+    def _in_collection(self, path):
+        parent, _, _ = path.rpartition("/")
+        if self._group:
+            return parent.split("/")[-1] == self._collection_path
+
+        return parent == self._collection_path
+
+    def _matches(self, data):
+        for field, op, value in self._filters:
+            actual = data.get(field)
+            if op == "==" and not actual == value:
+                return False
+            elif op == "!=" and not actual != value:
+                return False
+            elif op == "in" and actual not in value:
+                return False
+            elif op == "<" and not (actual is not None and actual < value):
+                return False
+            elif op == "<=" and not (actual is not None and actual <= value):
+                return False
+            elif op == ">" and not (actual is not None and actual > value):
+                return False
+            elif op == ">=" and not (actual is not None and actual >= value):
+                return False
+
+        return True
+
+    def _snapshots(self):
+        client = self._client
+        with client._lock:
+            paths = sorted(path for path, data in client.documents.items() if self._in_collection(path) and self._matches(data))
+
+        if self._limit is not None:
+            paths = paths[:self._limit]
+
+        for path in paths:
+            yield FakeDocumentReference(client, path)._snapshot()
+
+    def stream(self, **kwargs):
+        self._client._round_trip()
+        yield from self._snapshots()
+
+    def get(self, **kwargs):
+        return list(self.stream())
+
+    def on_snapshot(self, callback):
+        return self._client._watch(self, callback)
+
+
+class FakeCollectionReference(FakeQuery):
+    def __init__(self, client, path):
+        super().__init__(client, path)
+        self.path = path
+        self.id = path.split("/")[-1]
+
+    def document(self, document_id=None):
+        return FakeDocumentReference(self._client, f"{self.path}/{document_id or uuid.uuid4().hex}")
+
+    def add(self, document_data):
+        reference = self.document()
+        reference.set(document_data)
+        return None, reference
+
+
+class FakeWriteBatch:
+    """
+    all writes go in one round trip, and either all happen or none do (eg if a precondition fails)
+    """
+
+    def __init__(self, client):
+        self._client = client
+        self._writes = []
+
+    def set(self, reference, document_data, merge=False):
+        self._writes.append((reference.path, document_data, merge, None))
+
+    def update(self, reference, field_updates, option=None):
+        self._writes.append((reference.path, field_updates, True, {**(option or {}), "must_exist": True, "field_paths": True}))
+
+    def create(self, reference, document_data):
+        self._writes.append((reference.path, document_data, False, {"exists": False}))
+
+    def delete(self, reference):
+        self._writes.append((reference.path, None, False, None))
+
+    def commit(self):
+        client = self._client
+        client._round_trip()
+        with client._lock:
+            # check everything first, so that nothing gets written if something fails
+            for path, data, merge, option in self._writes:
+                client._check_option(path, option)
+                if option and option.get("must_exist") and path not in client.documents:
+                    raise exceptions.NotFound(f"No document to update: {path}")
+
+            for path, data, merge, option in self._writes:
+                if data is None:
+                    client._delete(path)
+                else:
+                    client._write(path, data, merge=merge, field_paths=bool(option and option.get("field_paths")))
+
+        self._writes = []
+        client._notify()
+
+
+class FakeBucket:
+    """
+    stand-in for a cloud storage bucket. blobs is a dict of blob name > bytes
+    """
+
+    def __init__(self, name="fake-bucket", latency=0):
+        self.name = name
+        self.latency = latency
+        self.blobs = {}
+        self.metadata = {}
+        # blob name > datetime, defaults to when the blob was uploaded
+        self.created = {}
+        # names of blobs that don't get an md5, like composite objects in cloud storage
+        self.composite = set()
+        self.round_trips = 0
+        self._lock = threading.RLock()
+
+    def _round_trip(self):
+        with self._lock:
+            self.round_trips += 1
+
+        if self.latency:
+            time.sleep(self.latency)
+
+    def blob(self, name):
+        return FakeBlob(self, name)
+
+    def get_blob(self, name):
+        self._round_trip()
+        if name not in self.blobs:
+            return None
+
+        return FakeBlob(self, name)
+
+    def list_blobs(self, prefix=None, page_size=1000, max_results=None):
+        with self._lock:
+            names = sorted(name for name in self.blobs if name.startswith(prefix or ""))
+
+        if max_results is not None:
+            names = names[:max_results]
+
+        return FakeBlobIterator(self, names, page_size)
+
+
+class FakeBlobIterator:
+    """
+    like google.api_core.page_iterator: iterate over blobs, or over .pages (one round trip per page)
+    """
+
+    def __init__(self, bucket, names, page_size):
+        self.bucket = bucket
+        self.names = names
+        self.page_size = page_size
+
+    @property
+    def pages(self):
+        for start in range(0, len(self.names), self.page_size):
+            self.bucket._round_trip()
+            yield [FakeBlob(self.bucket, name) for name in self.names[start:start + self.page_size]]
+
+    def __iter__(self):
+        for page in self.pages:
+            yield from page
+
+
+class FakeBlob:
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+        # like the real thing, if set then downloads/uploads go a chunk at a time
+        self.chunk_size = None
+
+    @property
+    def size(self):
+        data = self.bucket.blobs.get(self.name)
+        return None if data is None else len(data)
+
+    @property
+    def metadata(self):
+        return self.bucket.metadata.get(self.name)
+
+    @property
+    def md5_hash(self):
+        # base64, like the real thing
+        data = self.bucket.blobs.get(self.name)
+        if data is None or self.name in self.bucket.composite:
+            return None
+
+        return base64.b64encode(hashlib.md5(data).digest()).decode("ascii")
+
+    @property
+    def time_created(self):
+        return self.bucket.created.get(self.name)
+
+    def exists(self):
+        self.bucket._round_trip()
+        return self.name in self.bucket.blobs
+
+    def delete(self):
+        self.bucket._round_trip()
+        with self.bucket._lock:
+            if self.name not in self.bucket.blobs:
+                raise exceptions.NotFound(f"No such object: {self.bucket.name}/{self.name}")
+
+            del self.bucket.blobs[self.name]
+            self.bucket.metadata.pop(self.name, None)
+            self.bucket.created.pop(self.name, None)
+
+    def upload_from_string(self, data, content_type=None):
+        self.bucket._round_trip()
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        with self.bucket._lock:
+            self.bucket.blobs[self.name] = bytes(data)
+            self.bucket.created.setdefault(self.name, datetime.now(timezone.utc))
+
+    def download_as_string(self, start=None, end=None):
+        """
+        like the real thing, end is inclusive
+        """
+        self.bucket._round_trip()
+        if self.name not in self.bucket.blobs:
+            raise exceptions.NotFound(f"No such object: {self.bucket.name}/{self.name}")
+
+        data = self.bucket.blobs[self.name]
+        return data[start or 0:None if end is None else end + 1]
+
+    def download_to_file(self, file_obj):
+        data = self.download_as_string()
+        step = self.chunk_size or len(data) or 1
+        for start in range(0, len(data), step):
+            file_obj.write(data[start:start + step])
+
+    def upload_from_file(self, file_obj, content_type=None, size=None):
+        """
+        reads a chunk at a time (if chunk_size is set), like a resumable upload
+        """
+        chunks = []
+        while True:
+            chunk = file_obj.read(self.chunk_size or -1)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            if not self.chunk_size:
+                break
+
+        self.upload_from_string(b"".join(chunks), content_type=content_type)
@@ -1,20 +1,17 @@
-# NOTE/TODO if ever import into more than one file, will need to conditionally initialize some of these services to make sure they only run once
 import os
 import asyncio
+from enum import IntEnum
 from django.conf import settings
-import firebase_admin
-from firebase_admin import credentials
-from firebase_admin import storage
-from firebase_admin import firestore
-from google.cloud import speech_v1p1beta1
-from google.cloud.speech_v1p1beta1 import enums
 from datetime import datetime
-from googleapiclient import discovery
-from google.api_core import operations_v1
-from oauth2client.client import GoogleCredentials
+from urllib.parse import quote
 from pprint import pprint
 from urllib3.exceptions import ProtocolError
 from google.api_core import retry
+from google.api_core import exceptions
+from .operations import OperationsLookup, DiscoveryOperationsBackend, GrpcOperationsBackend
+from .services import ServiceRegistry
+from .snapshot_hub import SnapshotHub
+from .retries import RetryPolicy, Backoff, CircuitBreaker
 
 
 # experiment with logging
@@ -33,20 +30,12 @@ BUCKET_NAME = "khmer-speech-to-text.appspot.com"
 logger = logging.getLogger('testlogger')
 # provide alternate path in case we don't want to set the GOOGLE_APPLICATION_CREDENTIALS, though this matters less with honcho
 admin_key_location = os.environ.get('ADMIN_KEY_LOCATION')
-from pprint import pprint
 default_key_location = os.environ.get('GOOGLE_APPLICATION_CREDENTIALS')
 
 # path to service account json file
 # don't need to set the credentials, everything is automatically derived from system GOOGLE_APPLICATION_CREDENTIALS env var. But if need a different credential, can set it 
 service_account = admin_key_location or default_key_location
 
-cred = credentials.Certificate(service_account)
-firebase_admin.initialize_app(cred, {
-    'storageBucket': BUCKET_NAME,
-    'projectId': APP_NAME,
-    'databaseURL': f"https://{APP_NAME}.firebaseio.com/",
-})
-
 # for getting operation_futures
 # don't know if this will work, officially they have sample like so: 
 # if don't want to set, GOOGLE_APPLICATION_CREDENTIALS can try this
@@ -56,37 +45,105 @@ firebase_admin.initialize_app(cred, {
 # but trying to use the firebase admin creds for now
 # google_api_service = discovery.build('cloudresourcemanager', 'v1', credentials=credentials)
 
-# not sure why, but doing admin.firestore.Client() doesn't work on its own
-# NOTE should now, we're setting the GOOGLE_APPLICATION_CREDENTIALS now
-db = firestore.Client.from_service_account_json(service_account)
+# same values as google.cloud.speech_v1p1beta1.enums.RecognitionConfig.AudioEncoding. Importing that loads the whole speech client, which we only want once something actually calls Google (see _speech_client)
+class AudioEncoding(IntEnum):
+    ENCODING_UNSPECIFIED = 0
+    LINEAR16 = 1
+    FLAC = 2
+    MULAW = 3
+    AMR = 4
+    AMR_WB = 5
+    OGG_OPUS = 6
+    SPEEX_WITH_HEADER_BYTE = 7
+    MP3 = 8
+
+#########################################
+# Services
+# none of these are created until first used (see services.py), so importing this file is cheap and doesn't need credentials
+# the google/firebase libs are imported in here too, since importing them is most of the cost
+################################
+
+def _firebase_app(registry):
+    import firebase_admin
+    from firebase_admin import credentials
+
+    cred = credentials.Certificate(service_account)
+    return firebase_admin.initialize_app(cred, {
+        'storageBucket': BUCKET_NAME,
+        'projectId': APP_NAME,
+        'databaseURL': f"https://{APP_NAME}.firebaseio.com/",
+    })
+
+def _db(registry):
+    from firebase_admin import firestore
 
-# alias so don't have to write out the beta part
-# for now only using the beta
+    # not sure why, but doing admin.firestore.Client() doesn't work on its own
+    # NOTE should now, we're setting the GOOGLE_APPLICATION_CREDENTIALS now
+    return firestore.Client.from_service_account_json(service_account)
 
-speech = speech_v1p1beta1
-speech_client = speech.SpeechClient.from_service_account_json(service_account)
+def _speech_client(registry):
+    # for now only using the beta
+    from google.cloud import speech_v1p1beta1 as speech
+
+    return speech.SpeechClient.from_service_account_json(service_account)
+
+def _operations_api(registry):
+    from google.api_core import operations_v1
+
+    return operations_v1.OperationsClient(registry.speech_client.transport.channel)
+
+def _bucket(registry):
+    from firebase_admin import storage
+
+    return storage.bucket(app=registry.firebase_app)
+
+services = ServiceRegistry()
+services.register("firebase_app", _firebase_app)
+services.register("db", _db)
+services.register("speech_client", _speech_client)
+services.register("operations_api", _operations_api)
+services.register("bucket", _bucket)
 
-operations_api = operations_v1.OperationsClient(speech_client.transport.channel)
 def get_operation_old(operation_name):
     """
     - I'm currently not using this, but reserving this code for future use especially since it is difficult to locate within the documentation
     - Borrowing code from https://github.com/googleapis/python-speech/issues/8
     - To get metadata: get_operation(name).metadata
     """
-    op = operations_api.get_operation(operation_name)
+    op = services.operations_api.get_operation(operation_name)
     return op
 
+def _build_operations_backend():
+    """
+    - Set OPERATIONS_BACKEND=grpc to use the gRPC operations_api client instead of the discovery client
+    """
+    if os.environ.get("OPERATIONS_BACKEND") == "grpc":
+        return GrpcOperationsBackend(services.operations_api)
+
+    return DiscoveryOperationsBackend('speech', 'v1p1beta1')
+
+# shared by all threads in this process, so we only build the client once rather than on every poll
+operations_lookup = OperationsLookup(_build_operations_backend)
+
+# shared listeners on transcribe request docs, so refresh_from_db can skip the read (only used if SNAPSHOT_HUB is on)
+snapshot_hub = SnapshotHub(lambda: services.db, idle_seconds=settings.SNAPSHOT_HUB_IDLE_SECONDS, max_age=settings.SNAPSHOT_HUB_MAX_AGE)
+
+# for asking Speech to transcribe (see retries.py). The breaker is shared by every request in this process
+speech_breaker = CircuitBreaker(threshold=settings.SPEECH_BREAKER_THRESHOLD, reset_seconds=settings.SPEECH_BREAKER_RESET_SECONDS)
+speech_retry = RetryPolicy(
+    max_attempts=settings.SPEECH_RETRY_MAX_ATTEMPTS,
+    deadline=settings.SPEECH_RETRY_DEADLINE,
+    backoff=Backoff(initial=settings.SPEECH_RETRY_INITIAL_DELAY, maximum=settings.SPEECH_RETRY_MAX_DELAY),
+    breaker=speech_breaker,
+)
+
 def get_operation(operation_name):
     """
     - Borrowing code from https://github.com/googleapis/python-speech/issues/8
     - operation returned is similar to what is returned by the original long-running request, but is a dict
+    - goes through operations_lookup, so the client is built once per process instead of on every call
     """
-    speech_service = discovery.build('speech', 'v1p1beta1')
-    request = speech_service.operations().get(name=operation_name)
-    operation_dict = request.execute()
-    return operation_dict
-
-bucket = storage.bucket()
+    return operations_lookup.get(operation_name)
 
 cwd = os.getcwd()
 destination_filename = cwd + "/tmp/"
@@ -94,6 +151,12 @@ destination_filename = cwd + "/tmp/"
 # note: not all flietypes supported yet. E.g., mp4 might end up being under flac or something. Eventually, handle all file types and either convert file or do something
 # mpeg is often mp3
 FILE_TYPES = ["flac", "mp3", "wav", "mpeg"] 
+# we convert these to flac with ffmpeg first (see transcoding.py). Matches what comes after "audio/" (or "video/") in the file type
+TRANSCODE_FILE_TYPES = ["m4a", "x-m4a", "mp4", "aac", "ogg", "opus", "webm", "amr", "3gpp", "aiff", "x-aiff", "x-wav", "wave", "x-ms-wma"]
+# index of uploaded file path > transcribe request that uses it, so the sweeper can tell which files are orphaned
+UPLOAD_REFS_COLLECTION = "uploadRefs"
+# written once backfill_upload_refs has indexed the requests from before uploadRefs existed. Until then the sweeper can't tell an unreferenced file from one that just isn't indexed
+UPLOAD_REFS_BACKFILL_DOC = "uploadRefsMeta/backfill"
 file_types_sentence = ", ".join(FILE_TYPES[0:-1]) + ", and " + FILE_TYPES[-1]
 
 # not using right now
@@ -168,6 +231,22 @@ def timestamp():
     return datetime.utcnow().strftime("%Y%m%dT%H%M%SZ") 
 
 
+def storage_doc_id(path):
+    """
+    for docs keyed by a cloud storage path (can't have slashes in firestore doc ids)
+    - percent-encoded, so different paths always get different ids (e.g., "a/b" and "a__b")
+    """
+    return quote(path, safe="")
+
+
+def storage_paths(request_data):
+    """
+    the cloud storage files a transcribe request uses (its upload, and whatever we made from it), from the request doc's data
+    """
+    segment_paths = [child.get("path") for child in request_data.get("child_operations") or []]
+    return [path for path in [request_data.get("file_path"), request_data.get("original_file_path"), request_data.get("transcoded_from"), *segment_paths] if path]
+
+
 def to_timestamp(string):
     """
     NOTE only takes strings in one format for now
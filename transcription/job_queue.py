@@ -0,0 +1,353 @@
+"""
+Durable job queue (in the Django db, see models.Job) and the worker that runs the jobs
+
+- /request-transcribe/ marks the request as received and queues a job (if JOB_QUEUE is on), instead of asking Google while the client waits. A burst of uploads becomes a queue, not a burst of Speech API calls
+- Workers (`python manage.py run_jobs`, the jobs entry in the Procfile) claim jobs by taking a lease. Claiming is a conditional update, so two workers can't get the same job, and it works the same on sqlite and postgres
+- If a worker dies mid-job, its lease runs out and another worker claims the job again. Failed jobs are retried with backoff, up to max_attempts
+- Concurrency is capped per worker (threads) and overall (JOB_MAX_RUNNING jobs running at once across all workers)
+- Each job records how long each stage took (including how long it sat in the queue). stats() has queue depth and per-stage latency
+- Register what runs for each kind of job with @job_handler. A handler can raise RetryLater to put the job back for a while without using up an attempt (e.g., admission control said to wait)
+"""
+import os
+import socket
+import time
+import threading
+import logging
+import traceback
+import statistics
+from contextlib import contextmanager
+from datetime import timedelta
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.db.models import F, Q
+from django.utils import timezone
+
+from .models import Job
+
+logger = logging.getLogger('testlogger')
+
+JOB_HANDLERS = {}
+
+# seconds before retrying a failed job, doubled for each attempt after that
+RETRY_BACKOFF = 10
+
+
+class RetryLater(Exception):
+    def __init__(self, seconds, reason=""):
+        super().__init__(reason)
+        self.seconds = seconds
+
+
+def job_handler(kind):
+    """
+    handler gets called with (payload, stages). Time parts of it with `with stages.time("name"):`
+    """
+    def register(func):
+        JOB_HANDLERS[kind] = func
+        return func
+
+    return register
+
+
+class Stages:
+    """
+    milliseconds per stage, for one attempt at a job
+    """
+
+    def __init__(self, clock=time.perf_counter):
+        self.clock = clock
+        self.timings = {}
+
+    @contextmanager
+    def time(self, name):
+        start = self.clock()
+        try:
+            yield
+        finally:
+            self.timings[name] = round((self.clock() - start) * 1000, 1)
+
+
+#########################################
+# Queue
+################################
+
+def enqueue(kind, payload, key="", max_attempts=3):
+    """
+    returns the job. If there's already one queued or running for key, returns that one instead of queuing another
+    """
+    if key:
+        existing = Job.objects.filter(kind=kind, key=key, status__in=[Job.QUEUED, Job.RUNNING]).first()
+        if existing:
+            logger.info(f"job for {key} already {existing.status}, not queuing again")
+            return existing
+
+    return Job.objects.create(kind=kind, key=key, payload=payload, max_attempts=max_attempts, run_after=timezone.now())
+
+
+def _claimable(now):
+    # queued and due, or running on a lease that ran out (that worker died or hung)
+    return Q(status=Job.QUEUED, run_after__lte=now) | Q(status=Job.RUNNING, lease_expires_at__lt=now)
+
+
+def claim(worker_id, limit=1, lease_seconds=300, max_running=None):
+    """
+    claims up to limit jobs for worker_id, oldest first. Returns the claimed jobs
+    - max_running caps how many jobs can be running at once across all workers
+    """
+    now = timezone.now()
+    if max_running is not None:
+        running = Job.objects.filter(status=Job.RUNNING, lease_expires_at__gte=now).count()
+        limit = min(limit, max_running - running)
+    if limit <= 0:
+        return []
+
+    candidates = list(Job.objects.filter(_claimable(now)).order_by("run_after", "id").values_list("id", flat=True)[:limit * 2])
+    claimed = []
+    for job_id in candidates:
+        if len(claimed) >= limit:
+            break
+
+        # only one worker's update can match, since the first one changes the status/lease
+        updated = Job.objects.filter(_claimable(now), id=job_id).update(
+            status=Job.RUNNING,
+            lease_owner=worker_id,
+            lease_expires_at=now + timedelta(seconds=lease_seconds),
+            attempts=F("attempts") + 1,
+            started_at=now,
+        )
+        if updated:
+            claimed.append(Job.objects.get(id=job_id))
+
+    return claimed
+
+
+def extend_lease(job, lease_seconds=300):
+    """
+    for long jobs. Returns False if the lease isn't ours anymore
+    """
+    return bool(Job.objects.filter(id=job.id, status=Job.RUNNING, lease_owner=job.lease_owner).update(
+        lease_expires_at=timezone.now() + timedelta(seconds=lease_seconds),
+    ))
+
+
+def complete(job, timings):
+    Job.objects.filter(id=job.id, lease_owner=job.lease_owner).update(
+        status=Job.DONE,
+        finished_at=timezone.now(),
+        timings=timings,
+        lease_expires_at=None,
+        error="",
+    )
+
+
+def fail(job, error, timings):
+    """
+    queues it again with backoff, unless it's out of attempts
+    """
+    now = timezone.now()
+    out_of_attempts = job.attempts >= job.max_attempts
+    Job.objects.filter(id=job.id, lease_owner=job.lease_owner).update(
+        status=Job.FAILED if out_of_attempts else Job.QUEUED,
+        run_after=now + timedelta(seconds=RETRY_BACKOFF * 2 ** (job.attempts - 1)),
+        finished_at=now if out_of_attempts else None,
+        timings=timings,
+        lease_expires_at=None,
+        error=str(error)[:2000],
+    )
+
+
+def postpone(job, seconds, timings):
+    """
+    back in the queue after seconds, and this attempt doesn't count
+    """
+    Job.objects.filter(id=job.id, lease_owner=job.lease_owner).update(
+        status=Job.QUEUED,
+        run_after=timezone.now() + timedelta(seconds=seconds),
+        attempts=F("attempts") - 1,
+        timings=timings,
+        lease_expires_at=None,
+    )
+
+
+def stats(recent=200):
+    """
+    queue depth by status, how long the oldest queued job has waited, and latency per stage over the most recent finished jobs
+    """
+    now = timezone.now()
+    depth = {status: Job.objects.filter(status=status).count() for status, _ in Job.STATUSES}
+    oldest = Job.objects.filter(status=Job.QUEUED).order_by("created_at").values_list("created_at", flat=True).first()
+
+    by_stage = {}
+    for timings in Job.objects.filter(status=Job.DONE).order_by("-finished_at").values_list("timings", flat=True)[:recent]:
+        for stage, ms in (timings or {}).items():
+            by_stage.setdefault(stage, []).append(ms)
+
+    latency = {}
+    for stage, values in by_stage.items():
+        values.sort()
+        latency[stage] = {
+            "count": len(values),
+            "median_ms": round(statistics.median(values), 1),
+            "p95_ms": round(values[min(len(values) - 1, int(len(values) * 0.95))], 1),
+            "max_ms": round(values[-1], 1),
+        }
+
+    return {
+        "depth": depth,
+        "oldest_queued_seconds": round((now - oldest).total_seconds(), 1) if oldest else None,
+        "latency": latency,
+    }
+
+
+#########################################
+# Worker
+################################
+
+def default_worker_id():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+class JobWorker:
+    def __init__(self, worker_id=None, concurrency=2, lease_seconds=300, max_running=None, poll_interval=1, sleep=time.sleep):
+        self.worker_id = worker_id or default_worker_id()
+        self.concurrency = concurrency
+        self.lease_seconds = lease_seconds
+        self.max_running = max_running
+        self.poll_interval = poll_interval
+        self.sleep = sleep
+        self._executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="job-worker")
+        self._running = set()
+        self._lock = threading.Lock()
+        self._stopped = False
+
+    def run_job(self, job):
+        stages = Stages()
+        queued_since = job.created_at if job.attempts <= 1 else job.run_after
+        timings = {"queued": round((job.started_at - queued_since).total_seconds() * 1000, 1)} if job.started_at and queued_since else {}
+
+        try:
+            handler = JOB_HANDLERS.get(job.kind)
+            if handler is None:
+                raise KeyError(f"No handler for job kind {job.kind}")
+
+            with stages.time("run"):
+                handler(job.payload, stages)
+
+        except RetryLater as retry:
+            logger.info(f"job {job.id} ({job.kind}) has to wait {retry.seconds:.0f} seconds: {retry}")
+            postpone(job, retry.seconds, {**timings, **stages.timings})
+            return False
+
+        except Exception as error:
+            logger.error(f"job {job.id} ({job.kind}) failed on attempt {job.attempts}")
+            logger.error(traceback.format_exc())
+            fail(job, error, {**timings, **stages.timings})
+            return False
+
+        else:
+            complete(job, {**timings, **stages.timings})
+            return True
+
+        finally:
+            # each thread has its own db connection, don't let them go stale
+            close_old_connections()
+
+    def _run_and_release(self, job):
+        try:
+            return self.run_job(job)
+        finally:
+            with self._lock:
+                self._running.discard(job.id)
+
+    def run_once(self, wait=True):
+        """
+        claims as many jobs as there are free threads and runs them. Returns how many it claimed
+        """
+        with self._lock:
+            free = self.concurrency - len(self._running)
+
+        jobs = claim(self.worker_id, limit=free, lease_seconds=self.lease_seconds, max_running=self.max_running)
+        futures = []
+        for job in jobs:
+            with self._lock:
+                self._running.add(job.id)
+            futures.append(self._executor.submit(self._run_and_release, job))
+
+        if wait:
+            for future in futures:
+                future.result()
+
+        return len(jobs)
+
+    def run_forever(self):
+        logger.info(f"job worker {self.worker_id} started, {self.concurrency} at a time")
+        while not self._stopped:
+            try:
+                claimed = self.run_once(wait=False)
+            except Exception:
+                logger.error(traceback.format_exc())
+                claimed = 0
+                close_old_connections()
+
+            if not claimed:
+                self.sleep(self.poll_interval)
+
+    def stop(self):
+        self._stopped = True
+        self._executor.shutdown(wait=True)
+
+
+#########################################
+# Handlers
+################################
+
+TRANSCRIBE_JOB = "request-transcription"
+
+
+def enqueue_transcription(transcribe_request, key=None):
+    """
+    only what's needed to find the request again. The worker reads the rest from firestore
+    - key defaults to the request's path, so it's only queued once at a time
+    """
+    payload = {
+        "filename": transcribe_request.filename,
+        "file_last_modified": transcribe_request.file_last_modified,
+        "id": transcribe_request.id,
+        "user_id": transcribe_request.user_id,
+        "file_type": transcribe_request.file_type,
+        "file_path": transcribe_request.file_path,
+    }
+    key = key or transcribe_request.transcribe_request_ref().path
+    return enqueue(TRANSCRIBE_JOB, payload, key=key, max_attempts=settings.JOB_MAX_ATTEMPTS)
+
+
+@job_handler(TRANSCRIBE_JOB)
+def request_transcription_job(payload, stages):
+    """
+    what views._start_transcribing used to do inline after marking as received
+    - if the file needs converting to flac first, this only starts that. Once it's converted, _finish_transcoding queues another one of these for the flac
+    """
+    from .transcribe_class import TranscribeRequest
+    from .helpers import TRANSCRIPTION_STATUSES
+    from .admission import Throttled, admission_control
+
+    transcribe_request = TranscribeRequest(payload)
+    with stages.time("refresh_from_db"):
+        transcribe_request.refresh_from_db()
+
+    if transcribe_request.transaction_id or transcribe_request.status == TRANSCRIPTION_STATUSES[5]: # transcription-processed
+        # someone already got to it (e.g., a resume while it was queued)
+        logger.info(f"{transcribe_request.transcribe_request_ref().path} already has a transcription going, skipping")
+        return
+
+    if settings.ADMISSION_CONTROL:
+        try:
+            with stages.time("admission"):
+                admission_control.admit(transcribe_request.user_id, transcribe_request.transcribe_request_ref().path)
+        except Throttled as error:
+            raise RetryLater(error.retry_after, error.reason)
+
+    with stages.time("request_transcription"):
+        transcribe_request.request_transcription()
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+import json
+
+from transcription.helpers import services
+from transcription.sweeper import backfill_upload_refs
+
+
+class Command(BaseCommand):
+    help = "Add the files of every transcribe request to uploadRefs, so sweep_orphaned_uploads can tell which files are orphaned. Run once before sweeping"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--page-size", type=int, default=500, help="writes per commit")
+
+    def handle(self, *args, **options):
+        written = backfill_upload_refs(services.db, page_size=options["page_size"])
+        self.stdout.write(json.dumps({"refs": written}, indent=2))
@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand, CommandError
+import json
+
+from transcription.benchmarks import BENCHMARKS
+
+
+class Command(BaseCommand):
+    help = "Run one of the micro-benchmarks in transcription/benchmarks.py"
+
+    def add_arguments(self, parser):
+        parser.add_argument("case", help="one of: " + ", ".join(sorted(BENCHMARKS)))
+        parser.add_argument("--iterations", type=int, default=100)
+        parser.add_argument("--operation-name", help="real operation name to look up from Google, instead of using a fake")
+        parser.add_argument("--module", help="module to import, for import-time")
+        parser.add_argument("--budget-ms", type=float, help="fail if over this budget (import-time)")
+        parser.add_argument("--concurrency", type=int, default=20, help="requests in flight at once (views-load)")
+        parser.add_argument("--workers", type=int, default=3, help="sync workers (views-load)")
+        parser.add_argument("--latency-ms", type=float, default=50, help="simulated latency per firestore/Google round trip (views-load, audio-probe)")
+        parser.add_argument("--minutes", type=int, default=60, help="length of the synthetic transcript (transcript-compact, json-serialize)")
+        parser.add_argument("--path", help="audio file or directory of them to probe, instead of the fixtures (audio-probe)")
+
+    def handle(self, *args, **options):
+        case = options["case"]
+        if case not in BENCHMARKS:
+            raise CommandError(f"Unknown benchmark {case}, should be one of: " + ", ".join(sorted(BENCHMARKS)))
+
+        results = BENCHMARKS[case](options)
+        self.stdout.write(json.dumps(results, indent=2))
+
+        if results.get("over_budget"):
+            raise CommandError(f"{case} is over budget")
@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand
+from django.conf import settings
+
+from transcription.helpers import services, operations_lookup
+from transcription.poller import TranscriptionPoller
+
+
+class Command(BaseCommand):
+    help = "Poll Google for the progress of all transcribing requests (runs as the worker process)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--once", action="store_true", help="poll once and exit, instead of running forever")
+        parser.add_argument("--interval", type=float, default=settings.POLLER_INTERVAL)
+        parser.add_argument("--max-interval", type=float, default=settings.POLLER_MAX_INTERVAL)
+        parser.add_argument("--batch-size", type=int, default=settings.POLLER_BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        poller = TranscriptionPoller(
+            services.db,
+            operations_lookup,
+            interval=options["interval"],
+            max_interval=options["max_interval"],
+            batch_size=options["batch_size"],
+        )
+
+        if options["once"]:
+            count = poller.poll_once()
+            self.stdout.write(f"polled {count} operations")
+        else:
+            poller.run_forever()
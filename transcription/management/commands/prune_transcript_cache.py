@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+import json
+
+from transcription.transcript_cache import transcript_cache
+
+
+class Command(BaseCommand):
+    help = "Delete transcript cache entries that the retention policy doesn't keep anymore (TRANSCRIPT_CACHE_MAX_AGE_DAYS)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--dry-run", action="store_true", help="only report what would be deleted")
+        parser.add_argument("--limit", type=int, help="only look at this many entries")
+
+    def handle(self, *args, **options):
+        stats = transcript_cache.prune(dry_run=options["dry_run"], limit=options["limit"])
+        stats["process"] = transcript_cache.stats()
+        self.stdout.write(json.dumps(stats, indent=2))
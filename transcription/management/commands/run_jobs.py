@@ -0,0 +1,38 @@
+from django.core.management.base import BaseCommand
+from django.conf import settings
+import json
+
+from transcription import job_queue
+
+
+class Command(BaseCommand):
+    help = "Run jobs from the job queue, e.g., asking Google to transcribe (runs as the jobs process)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--once", action="store_true", help="claim and run one round of jobs and exit, instead of running forever")
+        parser.add_argument("--stats", action="store_true", help="print queue depth and latency per stage, and exit")
+        parser.add_argument("--workers", type=int, default=settings.JOB_WORKERS, help="jobs at a time in this process")
+        parser.add_argument("--lease-seconds", type=float, default=settings.JOB_LEASE_SECONDS)
+        parser.add_argument("--poll-interval", type=float, default=settings.JOB_POLL_INTERVAL)
+
+    def handle(self, *args, **options):
+        if options["stats"]:
+            self.stdout.write(json.dumps(job_queue.stats(), indent=2))
+            return
+
+        worker = job_queue.JobWorker(
+            concurrency=options["workers"],
+            lease_seconds=options["lease_seconds"],
+            max_running=settings.JOB_MAX_RUNNING,
+            poll_interval=options["poll_interval"],
+        )
+
+        if options["once"]:
+            count = worker.run_once()
+            self.stdout.write(f"ran {count} jobs")
+            worker.stop()
+        else:
+            try:
+                worker.run_forever()
+            finally:
+                worker.stop()
@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand
+from datetime import timedelta
+import json
+
+from transcription.helpers import services
+from transcription.sweeper import OrphanSweeper
+
+
+class Command(BaseCommand):
+    help = "Delete uploaded audio files in cloud storage that no transcribe request needs anymore"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--dry-run", action="store_true", help="only report what would be deleted")
+        parser.add_argument("--prefix", required=True, help="only look at files under this prefix (e.g., where uploads go)")
+        parser.add_argument("--page-size", type=int, default=500)
+        parser.add_argument("--min-age-hours", type=float, default=24, help="skip files newer than this")
+        parser.add_argument("--error-retention-days", type=float, default=7, help="keep files for errored requests this long, in case they get resumed")
+
+    def handle(self, *args, **options):
+        sweeper = OrphanSweeper(
+            services.bucket,
+            services.db,
+            prefix=options["prefix"],
+            page_size=options["page_size"],
+            min_age=timedelta(hours=options["min_age_hours"]),
+            error_retention=timedelta(days=options["error_retention_days"]),
+            dry_run=options["dry_run"],
+        )
+        stats = sweeper.run()
+        self.stdout.write(json.dumps(stats, indent=2))
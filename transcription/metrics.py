@@ -0,0 +1,194 @@
+"""
+Prometheus metrics, served at /metrics
+
+- Status transitions: a count for each (from, to), and how long requests spent in the status they're leaving (e.g., how long processing-file took)
+- Calls to Firestore, Storage and Speech: how long they take and how many fail, by service and call. Wrap a call with `with timed("firestore", "commit"):`
+- Views: how long each takes, by url name, method and response status (metrics_middleware)
+- Job queue depth, read from the db when scraped
+- Under gunicorn, each worker is a separate process, so set PROMETHEUS_MULTIPROC_DIR (an empty, writable dir) and every worker writes its numbers there, and /metrics adds them up. gunicorn.conf.py clears it on start and cleans up after workers that exit
+- Recording is a few dict lookups and a lock, see `python manage.py benchmark metrics-overhead`. METRICS=false turns it off
+"""
+import os
+import time
+import asyncio
+import logging
+from contextlib import contextmanager
+from datetime import datetime
+
+from django.conf import settings
+from django.utils.decorators import sync_and_async_middleware
+from prometheus_client import Counter, Histogram, CollectorRegistry, REGISTRY, generate_latest, CONTENT_TYPE_LATEST
+from prometheus_client.core import GaugeMetricFamily
+
+logger = logging.getLogger('testlogger')
+
+# calls to Google are mostly tens of milliseconds, operations take minutes to hours
+CALL_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+STATUS_BUCKETS = (1, 5, 15, 30, 60, 120, 300, 600, 1200, 1800, 3600, 7200, 14400, 28800)
+
+STATUS_TRANSITIONS = Counter(
+    "transcription_status_transitions_total",
+    "Transcribe requests moving from one status to another",
+    ["from_status", "to_status"],
+)
+STATUS_DURATION = Histogram(
+    "transcription_status_duration_seconds",
+    "How long transcribe requests were in a status before moving on",
+    ["status"],
+    buckets=STATUS_BUCKETS,
+)
+CALL_DURATION = Histogram(
+    "transcription_external_call_duration_seconds",
+    "Calls to Firestore, Storage and Speech",
+    ["service", "call"],
+    buckets=CALL_BUCKETS,
+)
+CALL_ERRORS = Counter(
+    "transcription_external_call_errors_total",
+    "Calls to Firestore, Storage and Speech that raised",
+    ["service", "call"],
+)
+VIEW_DURATION = Histogram(
+    "transcription_view_duration_seconds",
+    "Time to respond, by view",
+    ["view", "method", "status"],
+    buckets=CALL_BUCKETS,
+)
+
+# labels > bound child, since labels() validates and locks every time
+_children = {}
+
+
+def _child(metric, *labels):
+    key = (metric, labels)
+    child = _children.get(key)
+    if child is None:
+        child = _children[key] = metric.labels(*labels)
+
+    return child
+
+
+#########################################
+# Recording
+################################
+
+@contextmanager
+def timed(service, call):
+    """
+    records how long the block took, and counts it as an error if it raises
+    """
+    if not settings.METRICS:
+        yield
+        return
+
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        _child(CALL_ERRORS, service, call).inc()
+        raise
+    finally:
+        _child(CALL_DURATION, service, call).observe(time.perf_counter() - start)
+
+
+def record_transition(from_status, to_status, since=None):
+    """
+    since is when it got to from_status (a timestamp() string)
+    """
+    if not settings.METRICS or from_status == to_status:
+        return
+
+    _child(STATUS_TRANSITIONS, from_status or "none", to_status).inc()
+    if from_status and since:
+        try:
+            started = datetime.strptime(since, "%Y%m%dT%H%M%SZ")
+        except (TypeError, ValueError):
+            return
+        _child(STATUS_DURATION, from_status).observe(max(0, (datetime.utcnow() - started).total_seconds()))
+
+
+def _view_name(request):
+    match = getattr(request, "resolver_match", None)
+    # not the path, so a bunch of 404s can't make a bunch of labels
+    return (match.url_name or match.view_name) if match else "unmatched"
+
+
+@sync_and_async_middleware
+def metrics_middleware(get_response):
+    def observe(request, response, start):
+        if settings.METRICS:
+            _child(VIEW_DURATION, _view_name(request), request.method, str(response.status_code)).observe(time.perf_counter() - start)
+
+    if asyncio.iscoroutinefunction(get_response):
+        async def middleware(request):
+            start = time.perf_counter()
+            response = await get_response(request)
+            observe(request, response, start)
+            return response
+
+    else:
+        def middleware(request):
+            start = time.perf_counter()
+            response = get_response(request)
+            observe(request, response, start)
+            return response
+
+    return middleware
+
+
+#########################################
+# Exposing
+################################
+
+class JobQueueCollector:
+    """
+    queue depth is in the db, so it's the same whichever process is scraped
+    """
+
+    def describe(self):
+        # otherwise registering it calls collect(), which would query the db at import
+        return []
+
+    def collect(self):
+        if not settings.JOB_QUEUE:
+            return
+
+        from . import job_queue
+        stats = job_queue.stats(recent=0)
+        depth = GaugeMetricFamily("transcription_job_queue_depth", "Jobs in the job queue, by status", labels=["status"])
+        for status, count in stats["depth"].items():
+            depth.add_metric([status], count)
+        yield depth
+
+        oldest = GaugeMetricFamily("transcription_job_queue_oldest_seconds", "How long the oldest queued job has been waiting")
+        oldest.add_metric([], stats["oldest_queued_seconds"] or 0)
+        yield oldest
+
+
+def multiprocess_dir():
+    return os.environ.get("PROMETHEUS_MULTIPROC_DIR") or os.environ.get("prometheus_multiproc_dir")
+
+
+def registry():
+    """
+    what /metrics serves. In multiprocess mode, everything the workers wrote
+    """
+    if multiprocess_dir():
+        from prometheus_client import multiprocess
+        scrape_registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(scrape_registry)
+        scrape_registry.register(JobQueueCollector())
+        return scrape_registry
+
+    return REGISTRY
+
+
+if not multiprocess_dir():
+    REGISTRY.register(JobQueueCollector())
+
+
+def render():
+    """
+    returns (body, content type)
+    """
+    return generate_latest(registry()), CONTENT_TYPE_LATEST
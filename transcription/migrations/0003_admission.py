@@ -0,0 +1,30 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('transcription', '0002_job'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AdmissionCounter',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=255, unique=True)),
+                ('value', models.FloatField(default=0)),
+                ('updated_at', models.FloatField(default=0)),
+                ('version', models.IntegerField(default=0)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='AdmissionSlot',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=255, unique=True)),
+                ('user_id', models.CharField(blank=True, default='', max_length=255)),
+                ('expires_at', models.FloatField(db_index=True)),
+            ],
+        ),
+    ]
@@ -3,3 +3,73 @@ from django.db import models
 # Create your models here.
 class Greeting(models.Model):
     when = models.DateTimeField("date created", auto_now_add=True)
+
+
+class Job(models.Model):
+    """
+    A unit of background work (e.g., asking Google to transcribe), see job_queue.py
+    - Workers claim jobs by taking a lease. If a worker dies, the lease runs out and someone else picks the job up
+    """
+    QUEUED = "queued"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+    STATUSES = [(QUEUED, "queued"), (RUNNING, "running"), (DONE, "done"), (FAILED, "failed")]
+
+    kind = models.CharField(max_length=64)
+    # what the job is for (e.g., the transcribe request's path), so the same thing doesn't get queued twice
+    key = models.CharField(max_length=255, blank=True, default="")
+    payload = models.JSONField(default=dict)
+    status = models.CharField(max_length=16, choices=STATUSES, default=QUEUED)
+
+    attempts = models.IntegerField(default=0)
+    max_attempts = models.IntegerField(default=3)
+    # not claimed before this (backoff between attempts)
+    run_after = models.DateTimeField()
+    lease_owner = models.CharField(max_length=255, blank=True, default="")
+    lease_expires_at = models.DateTimeField(null=True, blank=True)
+
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    error = models.TextField(blank=True, default="")
+    # stage > milliseconds, for the last attempt (queued is how long it waited to be claimed)
+    timings = models.JSONField(default=dict)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["status", "run_after"], name="job_status_run_after_idx"),
+            models.Index(fields=["key", "status"], name="job_key_status_idx"),
+        ]
+
+    def __str__(self):
+        return f"{self.kind} {self.key or self.pk} ({self.status})"
+
+
+class AdmissionCounter(models.Model):
+    """
+    A token bucket or a count of running operations, shared by every dyno (see admission.py)
+    - Only ever changed by conditional updates on version, so two processes can't both take the last token
+    """
+    key = models.CharField(max_length=255, unique=True)
+    value = models.FloatField(default=0)
+    # unix time, since this is compared across machines
+    updated_at = models.FloatField(default=0)
+    version = models.IntegerField(default=0)
+
+    def __str__(self):
+        return f"{self.key}: {self.value}"
+
+
+class AdmissionSlot(models.Model):
+    """
+    A transcribe request that was let through and whose operation hasn't finished yet
+    """
+    # the transcribe request's path
+    key = models.CharField(max_length=255, unique=True)
+    user_id = models.CharField(max_length=255, blank=True, default="")
+    # unix time. In case we never hear that it finished, it stops counting after this
+    expires_at = models.FloatField(db_index=True)
+
+    def __str__(self):
+        return self.key
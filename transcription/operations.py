@@ -0,0 +1,134 @@
+"""
+Process-wide lookup layer for Google long-running operations (ie what we poll while Google is transcribing)
+
+- Building the discovery client is way more expensive than the actual operations().get call, so we only want to do it once, not on every poll
+- Backend is pluggable so can use the discovery (REST) client, the gRPC operations client, or a fake (for tests and benchmarks)
+- Everything returns the operation as a dict in the same (camelCase) shape that the discovery client returns
+"""
+import threading
+import logging
+import time
+
+from .metrics import timed
+
+logger = logging.getLogger('testlogger')
+
+
+#########################################
+# Backends
+################################
+
+class DiscoveryOperationsBackend:
+    """
+    - Uses the REST discovery client, which is what get_operation has always used
+    - httplib2 (which the discovery client uses under the hood) is not thread-safe, so each thread gets its own service object. Gunicorn threads stick around for the life of the worker, so this is still only built a handful of times per process
+    """
+
+    def __init__(self, api_name="speech", api_version="v1p1beta1"):
+        self.api_name = api_name
+        self.api_version = api_version
+        self._local = threading.local()
+
+    def _service(self):
+        service = getattr(self._local, "service", None)
+        if service is None:
+            # only import here, so that the fake backend doesn't need the google libs at all
+            from googleapiclient import discovery
+
+            logger.info(f"building {self.api_name} {self.api_version} discovery client for thread {threading.get_ident()}")
+            service = discovery.build(self.api_name, self.api_version)
+            self._local.service = service
+
+        return service
+
+    def get_operation(self, operation_name):
+        request = self._service().operations().get(name=operation_name)
+        return request.execute()
+
+
+class GrpcOperationsBackend:
+    """
+    - Sits on top of the gRPC operations_api client (see helpers.py), which shares the speech client's channel
+    - gRPC channels are thread-safe, so one instance is shared by all threads
+    - Converts the Operation protobuf to a dict so that callers get the same thing as from the discovery client
+    """
+
+    def __init__(self, operations_api):
+        self.operations_api = operations_api
+
+    def get_operation(self, operation_name):
+        from google.protobuf.json_format import MessageToDict
+
+        operation = self.operations_api.get_operation(operation_name)
+        return MessageToDict(operation)
+
+
+class FakeOperationsBackend:
+    """
+    - Local stand-in for Google, for tests and benchmarks
+    - operations is a dict of operation name > operation dict (same shape as what Google returns)
+    - latency (in seconds) can be set to simulate the round trip to Google
+    """
+
+    def __init__(self, operations=None, latency=0):
+        self.operations = operations or {}
+        self.latency = latency
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def set_operation(self, operation_name, operation_dict):
+        self.operations[operation_name] = operation_dict
+
+    def get_operation(self, operation_name):
+        with self._lock:
+            self.calls += 1
+
+        if self.latency:
+            time.sleep(self.latency)
+
+        if operation_name not in self.operations:
+            raise KeyError(f"No such operation: {operation_name}")
+
+        return self.operations[operation_name]
+
+
+#########################################
+# Lookup
+################################
+
+class OperationsLookup:
+    """
+    - Holds a single backend for the whole process, built on first use (not at import time)
+    - backend_factory is a callable that returns a backend. Safe to call get from multiple threads at once
+    """
+
+    def __init__(self, backend_factory):
+        self._backend_factory = backend_factory
+        self._backend = None
+        self._lock = threading.Lock()
+
+    def backend(self):
+        if self._backend is None:
+            with self._lock:
+                # check again, in case another thread built it while we were waiting for the lock
+                if self._backend is None:
+                    self._backend = self._backend_factory()
+
+        return self._backend
+
+    def set_backend(self, backend):
+        """
+        swap out the backend, e.g., for a FakeOperationsBackend in tests
+        """
+        with self._lock:
+            self._backend = backend
+
+    def reset(self):
+        """
+        drop the current backend, so that the next lookup builds a new one from the factory
+        """
+        self.set_backend(None)
+
+    def get(self, operation_name):
+        with timed("speech", "get_operation"):
+            return self.backend().get_operation(operation_name)
@@ -0,0 +1,138 @@
+"""
+Background poller for long-running recognize operations
+
+- Runs in its own process (see the worker entry in the Procfile), so progress gets checked even if no one has the dashboard open, and only once no matter how many tabs are open
+- Scans transcribeRequests that are transcribing, gets their operations from Google in batches, and applies the results
+- Each operation gets polled on its own schedule: starts at interval, and backs off (up to max_interval) while progress isn't moving
+- db and lookup can be swapped for fakes (see fakes.py and operations.FakeOperationsBackend)
+"""
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from .helpers import TRANSCRIPTION_STATUSES
+from .stitching import combine_operations
+
+logger = logging.getLogger('testlogger')
+
+
+class TranscriptionPoller:
+    def __init__(self, db, lookup, interval=5, max_interval=60, backoff=2, batch_size=10, clock=time.monotonic, sleep=time.sleep):
+        self.db = db
+        self.lookup = lookup
+        self.interval = interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.batch_size = batch_size
+        self.clock = clock
+        self.sleep = sleep
+        # operation name > {"next_poll_at", "interval", "progress"}
+        self.schedule = {}
+        self._stopped = False
+
+    def transcribing_snapshots(self):
+        query = self.db.collection_group("transcribeRequests").where("status", "==", TRANSCRIPTION_STATUSES[3]) # transcribing
+        return [snapshot for snapshot in query.stream() if snapshot.get("transaction_id")]
+
+    def due_snapshots(self, snapshots):
+        now = self.clock()
+        operation_names = set(snapshot.get("transaction_id") for snapshot in snapshots)
+
+        # forget about operations that aren't transcribing anymore
+        for operation_name in list(self.schedule):
+            if operation_name not in operation_names:
+                del self.schedule[operation_name]
+
+        return [s for s in snapshots if self.schedule.get(s.get("transaction_id"), {}).get("next_poll_at", 0) <= now]
+
+    def _get_operation(self, operation_name):
+        try:
+            return self.lookup.get(operation_name)
+        except Exception as error:
+            logger.error(f"error getting operation {operation_name}")
+            logger.error(error)
+            return None
+
+    def _get_snapshot_operation(self, snapshot):
+        """
+        in split mode, gets all the child operations and combines them (see stitching.combine_operations)
+        """
+        child_operations = snapshot.get("child_operations")
+        if not child_operations:
+            return self._get_operation(snapshot.get("transaction_id"))
+
+        operation_dicts = [self._get_operation(child["name"]) for child in child_operations]
+        if any(operation_dict is None for operation_dict in operation_dicts):
+            return None
+
+        return combine_operations(child_operations, operation_dicts)
+
+    def _reschedule(self, operation_name, operation_dict):
+        entry = self.schedule.get(operation_name, {"interval": self.interval, "progress": None})
+        progress = None
+        if operation_dict:
+            progress = operation_dict.get("metadata", {}).get("progressPercent", 0)
+
+        if operation_dict is not None and progress != entry["progress"]:
+            # moving along, so keep checking at the normal rate
+            interval = self.interval
+        else:
+            interval = min(entry["interval"] * self.backoff, self.max_interval)
+
+        self.schedule[operation_name] = {
+            "next_poll_at": self.clock() + interval,
+            "interval": interval,
+            "progress": progress,
+        }
+
+    def apply(self, snapshot, operation_dict):
+        """
+        update the transcribe request with the operation from Google. Only processes the transcript once per operation (see TranscribeRequest.claim_for_processing)
+        """
+        # import here since transcribe_class pulls in all of the google clients
+        from .transcribe_class import TranscribeRequest
+
+        transcribe_request = TranscribeRequest.from_firestore(snapshot.to_dict())
+        transcribe_request.apply_operation(operation_dict)
+
+    def poll_once(self):
+        """
+        returns number of operations that were polled
+        """
+        due = self.due_snapshots(self.transcribing_snapshots())
+
+        for start in range(0, len(due), self.batch_size):
+            batch = due[start:start + self.batch_size]
+            operation_names = [snapshot.get("transaction_id") for snapshot in batch]
+
+            # get the whole batch at once, then apply one by one
+            with ThreadPoolExecutor(max_workers=self.batch_size) as executor:
+                operation_dicts = list(executor.map(self._get_snapshot_operation, batch))
+
+            for snapshot, operation_name, operation_dict in zip(batch, operation_names, operation_dicts):
+                self._reschedule(operation_name, operation_dict)
+                if operation_dict is None:
+                    continue
+
+                try:
+                    self.apply(snapshot, operation_dict)
+                except Exception as error:
+                    logger.error(f"error applying operation {operation_name}")
+                    logger.error(error)
+
+        return len(due)
+
+    def stop(self):
+        self._stopped = True
+
+    def run_forever(self, tick=1):
+        logger.info("starting transcription poller")
+        while not self._stopped:
+            try:
+                self.poll_once()
+            except Exception as error:
+                # e.g., firestore is having a moment. Just try again next tick
+                logger.error("error while polling transcriptions")
+                logger.error(error)
+
+            self.sleep(tick)
@@ -0,0 +1,125 @@
+"""
+What the transcribe/check-status/resume endpoints send back about a transcribe request
+
+- Only the fields in RESPONSE_FIELDS are ever sent (never the event logs or request params)
+- Clients pick which ones with fields (e.g., `?fields=status,transcript_pages`, or "fields" in the json body). "all" means all of them
+- By default just status, progress_percent and updated_at, since that's all a poll needs
+- Responses get an ETag, and if the client sends it back in If-None-Match and nothing changed, it gets a 304 with no body
+"""
+import hashlib
+
+from django.http import HttpResponse
+
+from . import serialization
+
+# field name > how to get it from a TranscribeRequest
+RESPONSE_FIELDS = {
+    "id": lambda tr: tr.id,
+    "status": lambda tr: tr.status,
+    "progress_percent": lambda tr: (tr.transcript_metadata or {}).get("progress_percent", 0),
+    "processing_percent": lambda tr: (tr.processing_progress or {}).get("percent"),
+    "updated_at": lambda tr: tr.updated_at,
+    "error": lambda tr: getattr(tr, "error", None),
+    "filename": lambda tr: tr.filename,
+    "file_path": lambda tr: tr.file_path,
+    "file_type": lambda tr: tr.file_type,
+    "file_size": lambda tr: tr.file_size,
+    "file_last_modified": lambda tr: tr.file_last_modified,
+    "user_id": lambda tr: tr.user_id,
+    "request_type": lambda tr: tr.request_type,
+    "transaction_id": lambda tr: tr.transaction_id,
+    "transcript_metadata": lambda tr: tr.transcript_metadata,
+    "processing_progress": lambda tr: tr.processing_progress,
+    "event_summary": lambda tr: tr.event_summary,
+    "transcript_pages": lambda tr: tr.transcript_pages,
+    "audio_info": lambda tr: tr.audio_info,
+    "split_mode": lambda tr: tr.split_mode,
+    "segment_count": lambda tr: len(tr.child_operations) if tr.child_operations else None,
+    "cached_from": lambda tr: tr.cached_from,
+    # the finished transcript, when this request is the one that just got it from Google (otherwise it's in the transcript's pages, see transcript_pages)
+    "utterances": lambda tr: tr.utterances.to_results() if tr.utterances is not None else None,
+}
+
+DEFAULT_FIELDS = ["status", "progress_percent", "updated_at"]
+
+
+class InvalidFields(ValueError):
+    pass
+
+
+def requested_fields(req, body=None):
+    """
+    from ?fields= or "fields" in the body (comma separated string or list). Defaults to DEFAULT_FIELDS
+    """
+    value = req.GET.get("fields")
+    if value is None and isinstance(body, dict):
+        value = body.get("fields")
+    if not value:
+        return list(DEFAULT_FIELDS)
+
+    fields = value.split(",") if isinstance(value, str) else list(value)
+    fields = [field.strip() for field in fields if field.strip()]
+    if fields == ["all"]:
+        return list(RESPONSE_FIELDS)
+
+    unknown = [field for field in fields if field not in RESPONSE_FIELDS]
+    if unknown:
+        raise InvalidFields(f"Unknown fields: {', '.join(unknown)}. Can be any of: {', '.join(RESPONSE_FIELDS)}")
+
+    return fields
+
+
+def serialize(transcribe_request):
+    """
+    every field in the schema. Cache this, and project() per response
+    """
+    return {field: getter(transcribe_request) for field, getter in RESPONSE_FIELDS.items()}
+
+
+def project(data, fields):
+    return {field: data.get(field) for field in fields}
+
+
+def etag_for(body):
+    return '"' + hashlib.sha1(body).hexdigest() + '"'
+
+
+def _etag_matches(req, etag):
+    if_none_match = req.META.get("HTTP_IF_NONE_MATCH")
+    if not if_none_match:
+        return False
+
+    # can be a list, and can have weak (W/) versions of ours
+    candidates = [candidate.strip() for candidate in if_none_match.split(",")]
+    return "*" in candidates or etag in candidates or f"W/{etag}" in candidates
+
+
+def json_response(req, data):
+    """
+    HttpResponse with data as json, with an ETag. 304 with no body if the client already has it
+    """
+    body = serialization.dumps(data, sort_keys=True)
+    etag = etag_for(body)
+
+    if _etag_matches(req, etag):
+        response = HttpResponse(status=304)
+    else:
+        response = HttpResponse(body, content_type='application/json')
+
+    response["ETag"] = etag
+    # different fields or transcribe requests come back from the same url, depending on the body
+    response["Cache-Control"] = "no-cache"
+    return response
+
+
+def invalid_fields_response(error):
+    return HttpResponse(serialization.dumps({"error": str(error)}), status=400, content_type='application/json')
+
+
+def throttled_response(error):
+    """
+    429 for admission.Throttled, with Retry-After in seconds
+    """
+    response = HttpResponse(serialization.dumps({"error": error.reason, "retry_after": round(error.retry_after, 1)}), status=429, content_type='application/json')
+    response["Retry-After"] = error.retry_after_header()
+    return response
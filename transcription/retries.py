@@ -0,0 +1,269 @@
+"""
+Retrying calls to Google (e.g., asking Speech to transcribe), and failing fast while Google is having trouble
+
+- Errors are classified by type/status code (google.api_core.exceptions), not by matching the message: transient ones (500, 503, 504, 429, connection resets) get retried, the rest don't
+- Retries wait with jittered exponential backoff, and stop at max_attempts or once the deadline would pass
+- A circuit breaker (one per process) opens after threshold transient failures in a row. While open, calls fail right away with CircuitOpenError instead of adding to the pile, and after reset_seconds one call is let through to see if Google is back
+- Strategies handle errors that mean we asked wrong (e.g., stereo audio sent as mono). A strategy changes the request and it's tried again right away. Each strategy is only used once per call
+- clock, sleep and random can be passed in, so tests don't actually wait
+"""
+import random
+import threading
+import time
+import logging
+
+from google.api_core import exceptions
+from urllib3.exceptions import ProtocolError
+
+logger = logging.getLogger('testlogger')
+
+TRANSIENT = "transient"
+INVALID = "invalid"
+FATAL = "fatal"
+
+# https://cloud.google.com/speech-to-text/docs/error-messages
+_TRANSIENT_TYPES = (
+    exceptions.InternalServerError, # 500, grpc INTERNAL (13)
+    exceptions.ServiceUnavailable, # 503
+    exceptions.GatewayTimeout, # 504, grpc DEADLINE_EXCEEDED
+    exceptions.TooManyRequests, # 429, grpc RESOURCE_EXHAUSTED
+    exceptions.Aborted,
+    ConnectionError,
+    ProtocolError,
+)
+
+
+def classify(error):
+    """
+    TRANSIENT (try again later), INVALID (400, something about what we sent) or FATAL (e.g., permission denied, not found)
+    """
+    if isinstance(error, _TRANSIENT_TYPES):
+        return TRANSIENT
+
+    if isinstance(error, exceptions.InvalidArgument):
+        return INVALID
+
+    if isinstance(error, exceptions.GoogleAPICallError) and error.code is not None and error.code >= 500:
+        # e.g., 501, 502
+        return TRANSIENT
+
+    return FATAL
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+#########################################
+# Backoff
+################################
+
+class Backoff:
+    """
+    full jitter: a random delay between 0 and initial * multiplier ** retry, capped at maximum
+    """
+
+    def __init__(self, initial=1, maximum=30, multiplier=2, random=random.random):
+        self.initial = initial
+        self.maximum = maximum
+        self.multiplier = multiplier
+        self.random = random
+
+    def delay(self, retry):
+        """
+        retry is 0 for the first retry
+        """
+        return self.random() * min(self.maximum, self.initial * self.multiplier ** retry)
+
+
+#########################################
+# Circuit breaker
+################################
+
+class CircuitBreaker:
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, threshold=5, reset_seconds=30, clock=time.monotonic):
+        self.threshold = threshold
+        self.reset_seconds = reset_seconds
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        # half open lets one call through at a time, to see if things are working again
+        self._trial_running = False
+        self._stats = {"opened": 0, "rejected": 0}
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._state()
+
+    def _state(self):
+        if self._opened_at is None:
+            return self.CLOSED
+
+        if self.clock() - self._opened_at >= self.reset_seconds:
+            return self.HALF_OPEN
+
+        return self.OPEN
+
+    def before_call(self):
+        """
+        raises CircuitOpenError if the call shouldn't be made
+        """
+        with self._lock:
+            state = self._state()
+            if state == self.CLOSED:
+                return
+
+            if state == self.HALF_OPEN and not self._trial_running:
+                self._trial_running = True
+                return
+
+            self._stats["rejected"] += 1
+            retry_in = max(0, self.reset_seconds - (self.clock() - self._opened_at))
+            raise CircuitOpenError(f"Too many errors from Google in a row, not trying again for {retry_in:.0f} seconds")
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._trial_running or (self._opened_at is None and self._failures >= self.threshold):
+                if self._opened_at is None:
+                    logger.error(f"opening circuit breaker after {self._failures} errors in a row")
+                self._stats["opened"] += 1
+                self._opened_at = self.clock()
+
+            self._trial_running = False
+
+    def release(self):
+        """
+        the call failed but it wasn't Google's fault (e.g., a 400), so it says nothing either way
+        """
+        with self._lock:
+            self._trial_running = False
+
+    def reset(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial_running = False
+
+    def stats(self):
+        with self._lock:
+            return {**self._stats, "state": self._state(), "consecutive_failures": self._failures}
+
+
+#########################################
+# Strategies
+################################
+
+class Strategy:
+    """
+    fixes what we're asking for, for errors that mean we asked wrong
+    """
+
+    def matches(self, error):
+        raise NotImplementedError
+
+    def apply(self, error):
+        raise NotImplementedError
+
+
+class MultipleChannelsFix(Strategy):
+    """
+    Google says the audio isn't mono (e.g., a stereo wav or flac), so ask again with a channel per speaker
+    - apply is whatever changes the request (e.g., sets multiple_channels and sets the request up again)
+    """
+    _messages = [
+        # wav
+        "Must use single channel (mono) audio",
+        # flac
+        "Invalid audio channel count",
+    ]
+
+    def __init__(self, apply):
+        self._apply = apply
+
+    def matches(self, error):
+        return isinstance(error, exceptions.InvalidArgument) and any(message in error.message for message in self._messages)
+
+    def apply(self, error):
+        logger.info("trying again, but with multiple channel configuration.")
+        self._apply()
+
+
+#########################################
+# Retrying
+################################
+
+class RetryPolicy:
+    def __init__(self, max_attempts=4, deadline=60, backoff=None, breaker=None, clock=time.monotonic, sleep=time.sleep):
+        """
+        deadline is in seconds from the first attempt. breaker is optional (e.g., for calls that shouldn't trip it)
+        """
+        self.max_attempts = max_attempts
+        self.deadline = deadline
+        self.backoff = backoff or Backoff()
+        self.breaker = breaker
+        self.clock = clock
+        self.sleep = sleep
+
+    def call(self, func, strategies=(), on_retry=None):
+        """
+        returns what func returns, or raises the last error (or CircuitOpenError)
+        - on_retry is called with (error, delay) before each retry
+        """
+        strategies = list(strategies)
+        started = self.clock()
+        retries = 0
+
+        while True:
+            if self.breaker:
+                self.breaker.before_call()
+
+            try:
+                result = func()
+
+            except Exception as error:
+                kind = classify(error)
+                if self.breaker:
+                    if kind == TRANSIENT:
+                        self.breaker.record_failure()
+                    else:
+                        self.breaker.release()
+
+                strategy = next((strategy for strategy in strategies if strategy.matches(error)), None)
+                if strategy:
+                    strategies.remove(strategy)
+                    strategy.apply(error)
+                    if on_retry:
+                        on_retry(error, 0)
+                    continue
+
+                if kind != TRANSIENT or retries + 1 >= self.max_attempts:
+                    raise
+
+                delay = self.backoff.delay(retries)
+                if self.clock() + delay - started > self.deadline:
+                    logger.error(f"not retrying, would be past the {self.deadline} second deadline")
+                    raise
+
+                logger.info(f"{type(error).__name__} from Google, retrying in {delay:.1f} seconds")
+                if on_retry:
+                    on_retry(error, delay)
+                self.sleep(delay)
+                retries += 1
+
+            else:
+                if self.breaker:
+                    self.breaker.record_success()
+                return result
@@ -0,0 +1,105 @@
+"""
+JSON in and out, for view responses, logging and sizing what goes to Firestore
+
+- Uses orjson if it's installed (several times faster on big payloads, like transcripts), and falls back to the stdlib json module otherwise
+- Both backends write the same bytes (compact separators, non-ascii left as is), so ETags and page sizes don't change depending on which one is installed
+- JSON_BACKEND setting picks one: "auto" (default, orjson if installed), "orjson" or "json"
+"""
+import json
+import logging
+
+from django.conf import settings
+
+logger = logging.getLogger('testlogger')
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class StdlibBackend:
+    name = "json"
+
+    def dumps(self, data, sort_keys=False, default=None):
+        return json.dumps(data, sort_keys=sort_keys, default=default, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+    def loads(self, data):
+        return json.loads(data)
+
+
+class OrjsonBackend:
+    name = "orjson"
+
+    def dumps(self, data, sort_keys=False, default=None):
+        option = orjson.OPT_NON_STR_KEYS
+        if sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+
+        return orjson.dumps(data, default=default, option=option)
+
+    def loads(self, data):
+        return orjson.loads(data)
+
+
+_backend = None
+
+
+def get_backend():
+    global _backend
+    if _backend is None:
+        set_backend(getattr(settings, "JSON_BACKEND", "auto"))
+
+    return _backend
+
+
+def set_backend(name):
+    """
+    mostly for tests and benchmarks
+    """
+    global _backend
+    if name == "auto":
+        name = "orjson" if orjson is not None else "json"
+
+    if name == "orjson":
+        if orjson is None:
+            raise ImportError("JSON_BACKEND is orjson, but orjson isn't installed")
+        _backend = OrjsonBackend()
+    elif name == "json":
+        _backend = StdlibBackend()
+    else:
+        raise ValueError(f"Unknown JSON_BACKEND {name}, should be auto, orjson or json")
+
+    return _backend
+
+
+def dumps(data, sort_keys=False, default=None):
+    """
+    returns bytes (utf-8), ready to go in an HttpResponse
+    """
+    return get_backend().dumps(data, sort_keys=sort_keys, default=default)
+
+
+def dumps_str(data, sort_keys=False, default=None):
+    return dumps(data, sort_keys=sort_keys, default=default).decode("utf-8")
+
+
+def loads(data):
+    """
+    takes bytes or str
+    """
+    return get_backend().loads(data)
+
+
+class lazy:
+    """
+    for logging: only serializes if the message actually gets logged
+    e.g., logger.info("sending with config %s", serialization.lazy(config_dict))
+    """
+    __slots__ = ("data",)
+
+    def __init__(self, data):
+        self.data = data
+
+    def __str__(self):
+        return dumps_str(self.data, default=str)
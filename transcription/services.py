@@ -0,0 +1,87 @@
+"""
+Lazy registry for the Google/Firebase clients (firebase app, firestore, speech, operations, storage bucket)
+
+- Nothing gets created at import time. Each service is created the first time it's used, and then shared for the rest of the process
+- Safe to use from multiple threads; a service is only ever created once
+- Can be pre-warmed (e.g., in gunicorn's post_fork hook, see config/gunicorn.conf.py) so the first request doesn't pay for it
+- Any service can be swapped out for a fake with override()
+"""
+import threading
+import logging
+from contextlib import contextmanager
+
+logger = logging.getLogger('testlogger')
+
+
+class ServiceRegistry:
+    def __init__(self):
+        self._factories = {}
+        self._instances = {}
+        # reentrant, since some factories use other services (e.g., db needs the service account)
+        self._lock = threading.RLock()
+
+    def register(self, name, factory):
+        """
+        factory is called with the registry, so it can get other services it depends on
+        """
+        self._factories[name] = factory
+
+    def get(self, name):
+        instance = self._instances.get(name)
+        if instance is not None:
+            return instance
+
+        with self._lock:
+            if name not in self._instances:
+                if name not in self._factories:
+                    raise KeyError(f"No service registered as {name}")
+
+                logger.info(f"initializing service {name}")
+                self._instances[name] = self._factories[name](self)
+
+            return self._instances[name]
+
+    def __getattr__(self, name):
+        # so can do services.db instead of services.get("db")
+        # only unknown names are an AttributeError. Anything a factory raises (even a KeyError) goes through as is
+        if name.startswith("_") or (name not in self._factories and name not in self._instances):
+            raise AttributeError(name)
+
+        return self.get(name)
+
+    def initialized(self):
+        return sorted(self._instances)
+
+    def prewarm(self, names=None):
+        for name in names or list(self._factories):
+            self.get(name)
+
+    def reset(self, *names):
+        """
+        forget services, so they get created again next time they're used. Forgets all of them if no names are passed
+        """
+        with self._lock:
+            for name in names or list(self._instances):
+                self._instances.pop(name, None)
+
+    @contextmanager
+    def override(self, **instances):
+        """
+        use these instances instead (e.g., fakes for tests) until the block exits
+
+            with services.override(db=FakeFirestore()):
+                ...
+        """
+        with self._lock:
+            previous = {name: self._instances.get(name) for name in instances}
+            self._instances.update(instances)
+
+        try:
+            yield self
+        finally:
+            with self._lock:
+                for name, instance in previous.items():
+                    if instance is None:
+                        self._instances.pop(name, None)
+                    else:
+                        self._instances[name] = instance
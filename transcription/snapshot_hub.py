@@ -0,0 +1,213 @@
+"""
+One Firestore listener (on_snapshot) per document or collection in this process, shared by everything that reads it
+
+- Without this, every check-status call (and every status-stream poll) reads the transcribe request doc again with refresh_from_db, even if nothing changed
+- With it, the first read starts a listener, and reads after that come from the copy the listener keeps up to date. N clients polling the same request cost one listener instead of N reads
+- Can watch a single document, or a collection (e.g., users/<uid>/transcribeRequests), which covers every document in it
+- Listeners are reference counted. Once no one is using one, it's kept for idle_seconds (so the next poll can still use it) and then torn down
+- A copy older than max_age isn't used (in case a listener died quietly), so it gets read again directly. Anything we write ourselves is dropped until the listener sends it back, so we don't read back what we had before writing
+- FakeFirestore's refs have on_snapshot too (see fakes.py), so this can be tested without Firestore
+"""
+import threading
+import time
+import logging
+from contextlib import contextmanager
+from copy import deepcopy
+
+logger = logging.getLogger('testlogger')
+
+
+class _Listener:
+    def __init__(self):
+        self.refs = 0
+        self.watch = None
+        # clock time since no one has been using it, None while someone is
+        self.idle_since = None
+
+
+def _is_document_path(path):
+    # users/abc is a document, users/abc/transcribeRequests is a collection
+    return len(path.split("/")) % 2 == 0
+
+
+class SnapshotHub:
+    def __init__(self, get_db, idle_seconds=60, max_age=300, clock=time.monotonic):
+        """
+        get_db returns the firestore client (called each time a listener starts, so services.override works)
+        """
+        self.get_db = get_db
+        self.idle_seconds = idle_seconds
+        self.max_age = max_age
+        self.clock = clock
+        # watched path > _Listener
+        self._listeners = {}
+        # document path > {"data", "update_time", "received_at"}
+        self._documents = {}
+        # reentrant, since a listener can call back right away (the fake does) while we're starting it
+        self._lock = threading.RLock()
+        self._stats = {"hits": 0, "misses": 0, "listeners_started": 0, "listeners_stopped": 0}
+
+    #########################################
+    # listeners
+    ################################
+
+    def acquire(self, path):
+        with self._lock:
+            self.evict_idle()
+            listener = self._listeners.get(path)
+            if listener is not None:
+                listener.refs += 1
+                listener.idle_since = None
+                return
+
+            listener = self._listeners[path] = _Listener()
+            listener.refs = 1
+
+            db = self.get_db()
+            reference = db.document(path) if _is_document_path(path) else db.collection(path)
+            try:
+                listener.watch = reference.on_snapshot(lambda snapshots, changes, read_time: self._on_snapshot(path, listener, snapshots))
+            except Exception:
+                del self._listeners[path]
+                raise
+
+            self._stats["listeners_started"] += 1
+            logger.info(f"listening to {path}")
+
+    def release(self, path):
+        with self._lock:
+            listener = self._listeners.get(path)
+            if listener is None:
+                return
+
+            listener.refs -= 1
+            if listener.refs <= 0:
+                listener.idle_since = self.clock()
+
+            self.evict_idle()
+
+    @contextmanager
+    def watching(self, path):
+        self.acquire(path)
+        try:
+            yield self
+        finally:
+            self.release(path)
+
+    def evict_idle(self):
+        """
+        stops listeners no one has used for idle_seconds. Called on every acquire/release, so there's no timer thread
+        """
+        with self._lock:
+            now = self.clock()
+            for path, listener in list(self._listeners.items()):
+                if listener.idle_since is not None and now - listener.idle_since >= self.idle_seconds:
+                    self._stop(path, listener)
+
+    def _stop(self, path, listener):
+        del self._listeners[path]
+        for document_path in [p for p in self._documents if self._covered_by(p, path)]:
+            if not self._watcher(document_path):
+                del self._documents[document_path]
+
+        try:
+            listener.watch.unsubscribe()
+        except Exception as error:
+            logger.error(f"error unsubscribing from {path}: {error}")
+
+        self._stats["listeners_stopped"] += 1
+        logger.info(f"stopped listening to {path}")
+
+    def reset(self):
+        """
+        stop all listeners and forget everything, e.g., between tests
+        """
+        with self._lock:
+            for path, listener in list(self._listeners.items()):
+                self._stop(path, listener)
+            self._documents.clear()
+
+    def _on_snapshot(self, path, listener, snapshots):
+        """
+        runs on the listener's thread. For a collection, snapshots is every document in it, so anything missing was deleted
+        """
+        with self._lock:
+            if self._listeners.get(path) is not listener:
+                # stopped already
+                return
+
+            now = self.clock()
+            seen = set()
+            for snapshot in snapshots:
+                document_path = snapshot.reference.path
+                seen.add(document_path)
+                self._documents[document_path] = {
+                    "data": snapshot.to_dict() if snapshot.exists else None,
+                    "update_time": snapshot.update_time,
+                    "received_at": now,
+                }
+
+            if _is_document_path(path):
+                if not snapshots:
+                    self._documents[path] = {"data": None, "update_time": None, "received_at": now}
+            else:
+                for document_path in [p for p in self._documents if self._covered_by(p, path) and p not in seen]:
+                    self._documents[document_path] = {"data": None, "update_time": None, "received_at": now}
+
+    #########################################
+    # the local copies
+    ################################
+
+    @staticmethod
+    def _covered_by(document_path, watched_path):
+        return document_path == watched_path or document_path.rpartition("/")[0] == watched_path
+
+    def _watcher(self, document_path):
+        if document_path in self._listeners:
+            return self._listeners[document_path]
+
+        return self._listeners.get(document_path.rpartition("/")[0])
+
+    def get(self, document_path):
+        """
+        copy of the document's data if a listener has it and it's fresh, otherwise None (so read it from firestore)
+        - also None if the document doesn't exist, so the caller's own read decides what to do about that
+        """
+        with self._lock:
+            document = self._documents.get(document_path)
+            if not self._watcher(document_path) or document is None or document["data"] is None or self.clock() - document["received_at"] > self.max_age:
+                self._stats["misses"] += 1
+                return None
+
+            self._stats["hits"] += 1
+            return deepcopy(document["data"])
+
+    def put(self, document_path, data, update_time=None):
+        """
+        after reading it directly, so the copy is fresh again. Ignored if not watched, or if the listener already has something newer
+        """
+        with self._lock:
+            if not self._watcher(document_path):
+                return
+
+            current = self._documents.get(document_path)
+            if current and update_time is not None and current["update_time"] is not None and current["update_time"] > update_time:
+                return
+
+            self._documents[document_path] = {"data": deepcopy(data), "update_time": update_time, "received_at": self.clock()}
+
+    def invalidate(self, document_path):
+        """
+        we just wrote it, so the copy is out of date until the listener sends the new version
+        """
+        with self._lock:
+            self._documents.pop(document_path, None)
+
+    def stats(self):
+        with self._lock:
+            return {
+                **self._stats,
+                "listeners": len(self._listeners),
+                "active": sum(1 for listener in self._listeners.values() if listener.idle_since is None),
+                "documents": len(self._documents),
+            }
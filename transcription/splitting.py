@@ -0,0 +1,152 @@
+"""
+Split mode: cutting long recordings into segments at silences, so each segment can be transcribed as its own operation at the same time
+
+- One long_running_recognize takes about as long as the audio, so a two hour sermon takes hours. N segments at once should take about 1/N of that
+- Cuts are made in the middle of a silence (found with ffmpeg's silencedetect) near where an even split would be, so we don't cut a word in half
+- ffmpeg reads the file from a signed url, so it can seek straight to each segment instead of us streaming the whole file for every segment
+- Runs in the transcoding process pool (see split_job). The results get put back together in stitching.py
+"""
+import re
+import subprocess
+import logging
+import math
+from datetime import timedelta
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+
+from .helpers import services
+from .transcoding import stream_to_blob, SAMPLE_RATE_HERTZ, CHUNK_SIZE, TranscodingError
+
+logger = logging.getLogger('testlogger')
+
+# quieter than this (in dB) for at least SILENCE_MIN_SECONDS counts as silence
+SILENCE_NOISE_DB = -30
+SILENCE_MIN_SECONDS = 0.5
+
+_SILENCE_START = re.compile(r"silence_start: (-?[\d.]+)")
+_SILENCE_END = re.compile(r"silence_end: (-?[\d.]+)")
+_DURATION = re.compile(r"Duration: (\d+):(\d+):([\d.]+)")
+
+
+def parse_silencedetect(output):
+    """
+    ffmpeg's stderr from silencedetect > (list of (start, end) silences, total duration in seconds or None)
+    """
+    silences = []
+    start = None
+    duration = None
+    for line in output.splitlines():
+        duration_match = _DURATION.search(line)
+        if duration_match and duration is None:
+            hours, minutes, seconds = duration_match.groups()
+            duration = int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+
+        start_match = _SILENCE_START.search(line)
+        if start_match:
+            start = max(float(start_match.group(1)), 0.0)
+
+        end_match = _SILENCE_END.search(line)
+        if end_match and start is not None:
+            silences.append((start, float(end_match.group(1))))
+            start = None
+
+    return silences, duration
+
+
+def plan_segments(silences, duration, segment_seconds, max_segments):
+    """
+    returns list of (start, end) in seconds, covering the whole file
+    - aims for segments of about segment_seconds (but no more than max_segments of them)
+    - each cut goes in the middle of the silence closest to where an even split would cut, if there's one within half a segment. Otherwise just cuts there
+    """
+    if not duration or duration <= segment_seconds:
+        return [(0.0, duration)]
+
+    count = min(math.ceil(duration / segment_seconds), max_segments)
+    length = duration / count
+    midpoints = [(start + end) / 2 for start, end in silences]
+
+    cuts = []
+    for i in range(1, count):
+        ideal = length * i
+        previous = cuts[-1] if cuts else 0.0
+        candidates = [point for point in midpoints if previous < point < duration and abs(point - ideal) <= length / 2]
+        cut = min(candidates, key=lambda point: abs(point - ideal)) if candidates else ideal
+        if cut > previous:
+            cuts.append(cut)
+
+    bounds = [0.0] + cuts + [duration]
+    return [(round(start, 3), round(end, 3)) for start, end in zip(bounds, bounds[1:])]
+
+
+def segment_path(path, index):
+    return f"{path}.segment-{index:03d}.flac"
+
+
+#########################################
+# ffmpeg
+################################
+
+def signed_url(path, bucket=None):
+    """
+    so ffmpeg can read straight from storage (with range requests), and only the parts it needs
+    """
+    bucket = bucket or services.bucket
+    return bucket.blob(path).generate_signed_url(expiration=timedelta(hours=1), version="v4")
+
+
+def detect_silences(url):
+    command = [
+        settings.FFMPEG_PATH, "-hide_banner", "-nostats",
+        "-i", url,
+        "-vn", "-af", f"silencedetect=noise={SILENCE_NOISE_DB}dB:d={SILENCE_MIN_SECONDS}",
+        "-f", "null", "-",
+    ]
+    process = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    output = process.stderr.decode("utf-8", "replace")
+    if process.returncode != 0:
+        raise TranscodingError(f"ffmpeg silencedetect exited with {process.returncode}: " + " | ".join(output.splitlines()[-5:]))
+
+    return parse_silencedetect(output)
+
+
+def cut_segment(url, start, end, destination_path, bucket=None):
+    bucket = bucket or services.bucket
+    destination = bucket.blob(destination_path)
+    destination.chunk_size = CHUNK_SIZE
+    command = [
+        settings.FFMPEG_PATH, "-hide_banner", "-loglevel", "error",
+        # before -i, so ffmpeg seeks instead of decoding everything before start
+        "-ss", str(start),
+        "-i", url,
+        "-t", str(round(end - start, 3)),
+        "-vn", "-ac", "1", "-ar", str(SAMPLE_RATE_HERTZ),
+        "-c:a", "flac", "-f", "flac", "pipe:1",
+    ]
+    stream_to_blob(command, destination)
+
+
+def split_job(source_path, segment_seconds, max_segments):
+    """
+    what runs in the pool process. Returns list of {"path", "offset_seconds", "duration_seconds"}, one per segment
+    """
+    url = signed_url(source_path)
+    silences, duration = detect_silences(url)
+    segments = plan_segments(silences, duration, segment_seconds, max_segments)
+    if len(segments) < 2:
+        # short enough (or couldn't tell how long it is), so not worth splitting
+        return []
+
+    logger.info(f"splitting {source_path} ({duration} seconds, {len(silences)} silences) into {len(segments)} segments")
+
+    planned = [{
+        "path": segment_path(source_path, index),
+        "offset_seconds": start,
+        "duration_seconds": round(end - start, 3),
+    } for index, (start, end) in enumerate(segments)]
+
+    with ThreadPoolExecutor(max_workers=len(planned)) as executor:
+        list(executor.map(lambda segment: cut_segment(url, segment["offset_seconds"], segment["offset_seconds"] + segment["duration_seconds"], segment["path"]), planned))
+
+    return planned
@@ -0,0 +1,207 @@
+"""
+Pushing status updates to clients (see async_views.status_stream), instead of them polling check-status on a timer
+
+- An event source gives the updates for one transcribe request, as check-status response data (see views._check_status_response_data)
+- StatusBroadcaster runs one event source per transcribe request, no matter how many clients are listening, and fans each update out to all of them. Once the last one leaves, it stops
+- PollingEventSource checks on the request the same way check-status does (and through the same cache), backing off while nothing changes
+- FakeEventSource is for tests: updates are pushed in by hand
+- All of this runs on the event loop, so only for the async (ASGI) server
+"""
+import asyncio
+import logging
+import traceback
+
+from .helpers import TRANSCRIPTION_STATUSES
+
+logger = logging.getLogger('testlogger')
+
+# once a request gets to one of these, it won't change anymore (without the client doing something)
+FINAL_STATUSES = [
+    TRANSCRIPTION_STATUSES[5], # transcription-processed
+    TRANSCRIPTION_STATUSES[6], # server-error
+    TRANSCRIPTION_STATUSES[7], # transcribing-error
+]
+
+# put in a subscriber's queue when there won't be any more updates
+_CLOSED = object()
+
+
+def is_final(data):
+    return data["current_request_data"].get("status") in FINAL_STATUSES
+
+
+#########################################
+# Event sources
+################################
+
+class PollingEventSource:
+    """
+    - load is an async function that takes file_data and returns check-status response data
+    - polls every interval seconds, doubling up to max_interval while nothing changes
+    - stops after the request gets to a final status
+    """
+
+    def __init__(self, load, interval=5, max_interval=60, sleep=asyncio.sleep):
+        self.load = load
+        self.interval = interval
+        self.max_interval = max_interval
+        self.sleep = sleep
+        self.polls = 0
+
+    async def events(self, key, file_data):
+        file_data = dict(file_data)
+        interval = self.interval
+        previous = None
+
+        while True:
+            data = await self.load(file_data)
+            self.polls += 1
+            yield data
+
+            if is_final(data):
+                return
+
+            # might have a new operation now (e.g., after a retry), so check on that one next time
+            transaction_id = data["current_request_data"].get("transaction_id")
+            if transaction_id:
+                file_data["transaction_id"] = transaction_id
+
+            interval = self.interval if data != previous else min(interval * 2, self.max_interval)
+            previous = data
+            await self.sleep(interval)
+
+
+class FakeEventSource:
+    """
+    for tests. push() updates for a key, and finish() when there won't be any more
+    """
+
+    def __init__(self):
+        self.queues = {}
+        # key > how many times events() was started for it
+        self.calls = {}
+
+    def _queue(self, key):
+        if key not in self.queues:
+            self.queues[key] = asyncio.Queue()
+
+        return self.queues[key]
+
+    def push(self, key, data):
+        self._queue(key).put_nowait(data)
+
+    def finish(self, key):
+        self._queue(key).put_nowait(_CLOSED)
+
+    async def events(self, key, file_data):
+        self.calls[key] = self.calls.get(key, 0) + 1
+        queue = self._queue(key)
+        while True:
+            data = await queue.get()
+            if data is _CLOSED:
+                return
+            yield data
+
+
+#########################################
+# Fan out
+################################
+
+class _Channel:
+    def __init__(self):
+        self.subscribers = set()
+        self.latest = None
+        self.task = None
+
+
+class Subscription:
+    """
+    one client's view of a channel. Use as an async context manager, so it always unsubscribes
+    """
+
+    def __init__(self, broadcaster, key, channel):
+        self.broadcaster = broadcaster
+        self.key = key
+        self.channel = channel
+        self.queue = asyncio.Queue()
+        # so whoever joins late starts with where things are now
+        if channel.latest is not None:
+            self.queue.put_nowait(channel.latest)
+
+    async def get(self, timeout=None):
+        """
+        next update, or None once there won't be any more. Raises asyncio.TimeoutError if nothing comes within timeout seconds
+        """
+        data = await asyncio.wait_for(self.queue.get(), timeout)
+        return None if data is _CLOSED else data
+
+    def close(self):
+        self.broadcaster._unsubscribe(self)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.close()
+
+
+class StatusBroadcaster:
+    def __init__(self, source=None):
+        self.source = source
+        # key > _Channel, for each transcribe request someone is listening to
+        self._channels = {}
+
+    def subscribe(self, key, file_data):
+        """
+        - key identifies the transcribe request, file_data is what to check it with (only used if no one is listening to it yet)
+        - needs to be called from the event loop
+        """
+        channel = self._channels.get(key)
+        if channel is None:
+            channel = self._channels[key] = _Channel()
+            channel.task = asyncio.ensure_future(self._run(key, channel, file_data))
+
+        subscription = Subscription(self, key, channel)
+        channel.subscribers.add(subscription)
+        return subscription
+
+    def _unsubscribe(self, subscription):
+        channel = subscription.channel
+        channel.subscribers.discard(subscription)
+        if not channel.subscribers:
+            # no one left to send updates to
+            self._close_channel(subscription.key, channel)
+            channel.task.cancel()
+
+    def _close_channel(self, key, channel):
+        if self._channels.get(key) is channel:
+            del self._channels[key]
+
+    async def _run(self, key, channel, file_data):
+        try:
+            async for data in self.source.events(key, file_data):
+                if data == channel.latest:
+                    continue
+
+                channel.latest = data
+                for subscription in list(channel.subscribers):
+                    subscription.queue.put_nowait(data)
+
+        except asyncio.CancelledError:
+            raise
+
+        except Exception:
+            # subscribers get closed, and clients reconnect (EventSource does that by itself)
+            logger.error(f"error getting status updates for {key}")
+            logger.error(traceback.format_exc())
+
+        finally:
+            self._close_channel(key, channel)
+            for subscription in list(channel.subscribers):
+                subscription.queue.put_nowait(_CLOSED)
+
+    def stats(self):
+        return {
+            "channels": len(self._channels),
+            "subscribers": sum(len(channel.subscribers) for channel in self._channels.values()),
+        }
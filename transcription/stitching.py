@@ -0,0 +1,150 @@
+"""
+Putting the results of split mode's child operations (see splitting.py) back together, as if they were one operation
+
+- Each segment was transcribed on its own, so its word time offsets start at 0. They get shifted by where the segment starts in the whole file
+- combine_operations makes an operation dict in the same shape that get_operation returns, so TranscribeRequest.apply_operation (and the poller) don't need to know about split mode
+- While some are still going, partial_results has the results from the segments at the start that are done, so they can be appended to the transcript early (see transcript_store.py)
+- No google or firestore in here, so it can all be tested with made up results
+"""
+from copy import deepcopy
+
+# operations from the discovery api use camelCase, from grpc (MessageToDict) too, but leaving room for snake_case just in case
+_TIME_FIELDS = ["startTime", "endTime", "start_time", "end_time"]
+_RESULT_TIME_FIELDS = ["resultEndTime", "result_end_time"]
+
+
+def parse_duration_nanos(value):
+    """
+    "1.400s" (how durations come back in operation dicts) > 1400000000. Also takes numbers (seconds) and {"seconds", "nanos"}
+    - integer nanoseconds, so nothing gets lost to float rounding
+    """
+    if value is None:
+        return 0
+    if isinstance(value, (int, float)):
+        return round(value * 1e9)
+    if isinstance(value, dict):
+        return int(value.get("seconds", 0)) * 10 ** 9 + int(value.get("nanos", 0))
+
+    seconds, _, fraction = value.rstrip("s").partition(".")
+    sign = -1 if seconds.startswith("-") else 1
+    return sign * (abs(int(seconds or 0)) * 10 ** 9 + int((fraction + "000000000")[:9]))
+
+
+def format_duration_nanos(nanos):
+    """
+    1400000000 > "1.400s". Same format protobuf uses for Durations in JSON: no fraction if whole seconds, otherwise 3, 6 or 9 digits
+    """
+    sign = "-" if nanos < 0 else ""
+    seconds, fraction = divmod(abs(nanos), 10 ** 9)
+    if fraction == 0:
+        return f"{sign}{seconds}s"
+    if fraction % 10 ** 6 == 0:
+        return f"{sign}{seconds}.{fraction // 10 ** 6:03d}s"
+    if fraction % 10 ** 3 == 0:
+        return f"{sign}{seconds}.{fraction // 10 ** 3:06d}s"
+
+    return f"{sign}{seconds}.{fraction:09d}s"
+
+
+def parse_duration(value):
+    """
+    "1.400s" > 1.4
+    """
+    return parse_duration_nanos(value) / 1e9
+
+
+def format_duration(seconds):
+    """
+    1.4 > "1.400s"
+    """
+    return format_duration_nanos(round(seconds * 1e9))
+
+
+def _shift(data, fields, offset_seconds):
+    for field in fields:
+        if field in data:
+            data[field] = format_duration_nanos(parse_duration_nanos(data[field]) + round(offset_seconds * 1e9))
+
+
+def shift_result(result, offset_seconds):
+    """
+    returns a copy of a single result (as in operation_dict["response"]["results"]) with every time offset moved by offset_seconds
+    """
+    result = deepcopy(result)
+    if not offset_seconds:
+        return result
+
+    _shift(result, _RESULT_TIME_FIELDS, offset_seconds)
+    for alternative in result.get("alternatives", []):
+        for word in alternative.get("words", []):
+            _shift(word, _TIME_FIELDS, offset_seconds)
+
+    return result
+
+
+def stitch_results(segment_results):
+    """
+    segment_results is list of (offset_seconds, results) for each segment, in any order
+    returns one list of results, in order, with corrected time offsets
+    """
+    stitched = []
+    for offset_seconds, results in sorted(segment_results, key=lambda segment: segment[0]):
+        stitched.extend(shift_result(result, offset_seconds) for result in results or [])
+
+    return stitched
+
+
+def combine_operations(child_operations, operation_dicts):
+    """
+    - child_operations is what's persisted on the transcribe request: list of {"name", "offset_seconds", ...}, one per segment
+    - operation_dicts are the operations from Google for those, in the same order
+    - returns one operation dict: done once all are done, errored if any errored, progress is the average
+    """
+    metadatas = [operation.get("metadata") or {} for operation in operation_dicts]
+    start_times = [metadata["startTime"] for metadata in metadatas if metadata.get("startTime")]
+    last_update_times = [metadata["lastUpdateTime"] for metadata in metadatas if metadata.get("lastUpdateTime")]
+
+    metadata = {
+        "progressPercent": sum(metadata.get("progressPercent", 0) for metadata in metadatas) // max(len(metadatas), 1),
+    }
+    # timestamps are all ISO format in UTC, so comparing the strings works
+    if start_times:
+        metadata["startTime"] = min(start_times)
+    if last_update_times:
+        metadata["lastUpdateTime"] = max(last_update_times)
+
+    combined = {
+        "name": child_operations[0]["name"] if child_operations else None,
+        "metadata": metadata,
+    }
+
+    errors = [operation["error"] for operation in operation_dicts if operation.get("error")]
+    if errors:
+        combined["error"] = errors[0]
+        combined["done"] = True
+
+    elif operation_dicts and all(operation.get("done") for operation in operation_dicts):
+        combined["done"] = True
+        combined["response"] = {
+            "results": _stitch_children(child_operations, operation_dicts),
+        }
+
+    else:
+        # results from the segments at the start that are done already, so they can be saved while the rest finish
+        finished = []
+        for child, operation in zip(child_operations, operation_dicts):
+            if not operation.get("done"):
+                break
+            finished.append((child, operation))
+
+        if finished:
+            combined["partial_results"] = _stitch_children(*zip(*finished))
+
+    return combined
+
+
+def _stitch_children(child_operations, operation_dicts):
+    return stitch_results([
+        (child["offset_seconds"], (operation.get("response") or {}).get("results", []))
+        for child, operation in zip(child_operations, operation_dicts)
+    ])
@@ -0,0 +1,101 @@
+"""
+Deleting uploaded audio from cloud storage once we're done with it
+
+- Deletes directly, without checking exists() first (that was an extra round trip per file). Already deleted (NotFound) counts as success
+- Deletes several files at once
+- Runs in a background thread by default (see schedule_cleanup), so the request doesn't wait on it, and retries with backoff
+- Anything that still fails gets recorded in the storageCleanupFailures collection, so the sweeper (see sweep_orphaned_uploads) can try again later
+"""
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from google.api_core import exceptions
+
+from .helpers import services, timestamp, reset_retry, storage_doc_id
+from .metrics import timed
+
+logger = logging.getLogger('testlogger')
+
+FAILURES_COLLECTION = "storageCleanupFailures"
+
+# shared by all cleanup jobs in this process
+_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="storage-cleanup")
+
+
+def _delete_blob(bucket, path):
+    try:
+        with timed("storage", "delete"):
+            reset_retry(bucket.blob(path).delete)()
+        logger.info("deleted file from " + path)
+    except exceptions.NotFound:
+        logger.info("file already deleted from " + path)
+
+
+def delete_blobs(paths, bucket=None, max_workers=4):
+    """
+    deletes all of paths at once. Returns dict of path > error for the ones that failed
+    """
+    bucket = bucket or services.bucket
+    paths = [path for path in paths if path]
+    failures = {}
+    if not paths:
+        return failures
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(paths))) as executor:
+        futures = {path: executor.submit(_delete_blob, bucket, path) for path in paths}
+
+    for path, future in futures.items():
+        error = future.exception()
+        if error is not None:
+            # typically something like: "ConnectionResetError: [Errno 104] Connection reset by peer"
+            # tracked here: https://github.com/googleapis/google-cloud-python/issues/5879#issuecomment-535135348
+            logger.error("error deleting file " + path)
+            logger.error(error)
+            failures[path] = error
+
+    return failures
+
+
+def record_failure(path, error, source=None, db=None):
+    """
+    source is the path of the transcribe request doc that the file belonged to, if we know it
+    """
+    db = db or services.db
+    db.collection(FAILURES_COLLECTION).document(storage_doc_id(path)).set({
+        "path": path,
+        "error": str(error),
+        "source": source,
+        "failed_at": timestamp(),
+    }, merge=True)
+
+
+def run_cleanup(paths, source=None, attempts=3, backoff=2, sleep=time.sleep, bucket=None, db=None):
+    """
+    deletes paths, retrying whatever failed. Returns list of paths that still failed after all attempts (and were recorded for the sweeper)
+    """
+    remaining = [path for path in paths if path]
+    for attempt in range(attempts):
+        failures = delete_blobs(remaining, bucket=bucket)
+        remaining = list(failures)
+        if not remaining:
+            return []
+
+        if attempt < attempts - 1:
+            sleep(backoff * 2 ** attempt)
+
+    for path in remaining:
+        try:
+            record_failure(path, failures[path], source=source, db=db)
+        except Exception as error:
+            logger.error("error recording failure to delete " + path)
+            logger.error(error)
+
+    return remaining
+
+
+def schedule_cleanup(paths, source=None):
+    """
+    run_cleanup in the background, so whoever called this doesn't have to wait. Returns a future
+    """
+    return _executor.submit(run_cleanup, list(paths), source)
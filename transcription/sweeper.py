@@ -0,0 +1,184 @@
+"""
+Sweeper for orphaned uploads, ie audio files in cloud storage that no transcribe request still needs
+
+Files get orphaned if a request errors out before handle_transcript_results deletes them, if the cleanup itself failed, or if the client uploaded and never asked us to transcribe. We pay to store them forever otherwise.
+
+- Pages through the bucket listing
+- Only looks under the prefix it's given (e.g., where the client uploads audio), never the whole bucket
+- For each page, looks up the uploadRefs index (written in mark_as_received) and then the transcribe requests with bulk get_all calls, rather than one read per file
+- Requests from before uploadRefs existed aren't in it until backfill_upload_refs has run (`python manage.py backfill_upload_refs`). Until then, files that aren't in the index are left alone
+- Deletes orphans in batches (see storage_cleanup.delete_blobs), unless dry_run
+- Run with `python manage.py sweep_orphaned_uploads` (e.g., from Heroku Scheduler)
+"""
+import time
+import logging
+from datetime import datetime, timedelta, timezone
+
+from .helpers import TRANSCRIPTION_STATUSES, UPLOAD_REFS_COLLECTION, UPLOAD_REFS_BACKFILL_DOC, storage_doc_id, storage_paths, timestamp
+from .storage_cleanup import delete_blobs, FAILURES_COLLECTION
+from .unit_of_work import UnitOfWork
+
+logger = logging.getLogger('testlogger')
+
+# requests in these statuses aren't going to use their files anymore, unless the user resumes them (so give them a while first)
+ERROR_STATUSES = [TRANSCRIPTION_STATUSES[6], TRANSCRIPTION_STATUSES[7]] # server-error, transcribing-error
+
+
+class OrphanSweeper:
+    def __init__(self, bucket, db, prefix, page_size=500, min_age=timedelta(hours=24), error_retention=timedelta(days=7), dry_run=False, now=None):
+        """
+        - prefix: only files under this get looked at. Required, so a sweep never covers the whole bucket by accident
+        - min_age: files newer than this are skipped, since the client might still be about to send the transcribe request
+        - error_retention: files for errored requests are kept this long after the error, in case the user resumes
+        """
+        if not prefix:
+            raise ValueError("OrphanSweeper needs a prefix, e.g., the folder uploads go in")
+
+        self.bucket = bucket
+        self.db = db
+        self.prefix = prefix
+        self.page_size = page_size
+        self.min_age = min_age
+        self.error_retention = error_retention
+        self.dry_run = dry_run
+        self.now = now or datetime.now(timezone.utc)
+        # whether uploadRefs has every request's files in it, checked in run()
+        self.index_complete = False
+        self.stats = {
+            "scanned": 0,
+            "skipped_too_new": 0,
+            "skipped_unindexed": 0,
+            "orphaned": 0,
+            "orphaned_bytes": 0,
+            "deleted": 0,
+            "failed": 0,
+            "pages": 0,
+            "reasons": {},
+        }
+
+    def _is_too_new(self, blob):
+        created = blob.time_created
+        return created is not None and self.now - created < self.min_age
+
+    def _is_stale_error(self, request_data):
+        updated_at = request_data.get("updated_at")
+        if not updated_at:
+            return True
+
+        updated = datetime.strptime(updated_at, "%Y%m%dT%H%M%SZ").replace(tzinfo=timezone.utc)
+        return self.now - updated > self.error_retention
+
+    def orphan_reasons(self, blobs):
+        """
+        returns dict of blob name > why it's orphaned, for the blobs that are. Two get_all calls for the whole page
+        """
+        upload_refs = [self.db.collection(UPLOAD_REFS_COLLECTION).document(storage_doc_id(blob.name)) for blob in blobs]
+        index = {}
+        for snapshot in self.db.get_all(upload_refs):
+            if snapshot.exists:
+                index[snapshot.get("path")] = snapshot.get("transcribe_request")
+
+        request_paths = sorted(set(path for path in index.values() if path))
+        requests = {}
+        if request_paths:
+            for snapshot in self.db.get_all([self.db.document(path) for path in request_paths]):
+                requests[snapshot.reference.path] = snapshot.to_dict() if snapshot.exists else None
+
+        reasons = {}
+        for blob in blobs:
+            request_path = index.get(blob.name)
+            if request_path is None:
+                if self.index_complete:
+                    reasons[blob.name] = "unreferenced"
+                else:
+                    self.stats["skipped_unindexed"] += 1
+                continue
+
+            request_data = requests.get(request_path)
+            if request_data is None:
+                reasons[blob.name] = "request-deleted"
+            elif request_data.get("status") == TRANSCRIPTION_STATUSES[5]: # transcription-processed
+                # we're done with it, cleanup must have failed
+                reasons[blob.name] = "already-processed"
+            elif request_data.get("status") in ERROR_STATUSES and self._is_stale_error(request_data):
+                reasons[blob.name] = "abandoned-after-error"
+
+        return reasons
+
+    def sweep_page(self, blobs):
+        self.stats["pages"] += 1
+        self.stats["scanned"] += len(blobs)
+
+        candidates = []
+        for blob in blobs:
+            if self._is_too_new(blob):
+                self.stats["skipped_too_new"] += 1
+            else:
+                candidates.append(blob)
+
+        if not candidates:
+            return
+
+        reasons = self.orphan_reasons(candidates)
+        orphans = [blob for blob in candidates if blob.name in reasons]
+        for blob in orphans:
+            reason = reasons[blob.name]
+            self.stats["orphaned"] += 1
+            self.stats["orphaned_bytes"] += blob.size or 0
+            self.stats["reasons"][reason] = self.stats["reasons"].get(reason, 0) + 1
+            logger.info(f"{'would delete' if self.dry_run else 'deleting'} orphaned upload {blob.name} ({reason})")
+
+        if self.dry_run or not orphans:
+            return
+
+        failures = delete_blobs([blob.name for blob in orphans], bucket=self.bucket)
+        deleted = [blob.name for blob in orphans if blob.name not in failures]
+        self.stats["deleted"] += len(deleted)
+        self.stats["failed"] += len(failures)
+
+        # don't need the index entries (or any failure records from earlier cleanups) for these anymore
+        unit_of_work = UnitOfWork(self.db)
+        for name in deleted:
+            unit_of_work.delete(self.db.collection(UPLOAD_REFS_COLLECTION).document(storage_doc_id(name)))
+            unit_of_work.delete(self.db.collection(FAILURES_COLLECTION).document(storage_doc_id(name)))
+        unit_of_work.flush()
+
+    def run(self):
+        start = time.perf_counter()
+        self.index_complete = self.db.document(UPLOAD_REFS_BACKFILL_DOC).get().exists
+        if not self.index_complete:
+            logger.info("uploadRefs hasn't been backfilled yet, so not deleting files that aren't in it. Run `python manage.py backfill_upload_refs` first")
+
+        for page in self.bucket.list_blobs(prefix=self.prefix, page_size=self.page_size).pages:
+            self.sweep_page(list(page))
+
+        elapsed = time.perf_counter() - start
+        self.stats["seconds"] = round(elapsed, 3)
+        self.stats["scanned_per_second"] = round(self.stats["scanned"] / elapsed, 2) if elapsed else None
+        self.stats["dry_run"] = self.dry_run
+        return self.stats
+
+
+def backfill_upload_refs(db, page_size=500):
+    """
+    adds every transcribe request's files to uploadRefs, for requests from before mark_as_received wrote them. Returns how many refs were written
+    - fine to run again, it just writes the same refs
+    - marks the backfill as done at the end (see UPLOAD_REFS_BACKFILL_DOC), which is what lets the sweeper delete files that aren't in uploadRefs
+    """
+    unit_of_work = UnitOfWork(db)
+    written = 0
+    for snapshot in db.collection_group("transcribeRequests").stream():
+        for path in storage_paths(snapshot.to_dict() or {}):
+            unit_of_work.set(db.collection(UPLOAD_REFS_COLLECTION).document(storage_doc_id(path)), {
+                "path": path,
+                "transcribe_request": snapshot.reference.path,
+            })
+            written += 1
+
+        if len(unit_of_work) >= page_size:
+            unit_of_work.flush()
+
+    unit_of_work.set(db.document(UPLOAD_REFS_BACKFILL_DOC), {"backfilled_at": timestamp(), "refs": written})
+    unit_of_work.flush()
+    logger.info(f"backfilled {written} upload refs")
+    return written
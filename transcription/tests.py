@@ -1,19 +1,1442 @@
-from django.contrib.auth.models import AnonymousUser, User
-from django.test import TestCase, RequestFactory
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import sys
+import threading
+import unittest
+from concurrent.futures import Future
+from datetime import datetime, timedelta, timezone
+from unittest import mock
 
-from .views import index
+from django.test import TestCase, SimpleTestCase, TransactionTestCase, RequestFactory
+from google.api_core import exceptions
+from prometheus_client import REGISTRY
 
+from . import async_views, job_queue, metrics, responses, serialization, storage_cleanup, views
+from .admission import AdmissionController, MemoryStore, DatabaseStore, Throttled
+from .asgi import ASGIHandler, AsyncStreamingHttpResponse
+from .audio_probe import probe_blob, AudioInfo
+from .benchmarks import synthetic_results
+from .cache import TTLCache, NO_EXPIRY
+from .compact_transcript import CompactTranscript
+from .fakes import FakeFirestore, FakeBucket
+from .helpers import services, operations_lookup, snapshot_hub, storage_doc_id, UPLOAD_REFS_BACKFILL_DOC
+from .models import Job, AdmissionCounter
+from .operations import OperationsLookup, FakeOperationsBackend
+from .poller import TranscriptionPoller
+from .retries import RetryPolicy, Backoff, CircuitBreaker, CircuitOpenError, classify, TRANSIENT, INVALID, FATAL
+from .services import ServiceRegistry
+from .snapshot_hub import SnapshotHub
+from .splitting import parse_silencedetect, plan_segments
+from .status_stream import StatusBroadcaster, PollingEventSource, FakeEventSource
+from .stitching import stitch_results, combine_operations
+from .sweeper import OrphanSweeper, backfill_upload_refs
+from .transcoding import transcode_to_flac, transcoded_path, TranscodingError
+from .transcribe_class import TranscribeRequest
+from .transcript_cache import TranscriptCache, MaxAgeRetention, content_hash, transcript_cache, CACHE_COLLECTION
+from .transcript_store import ChunkedTranscript, PAGES_COLLECTION
+from .unit_of_work import UnitOfWork
+
+
+class OperationsLookupTest(SimpleTestCase):
+    def test_backend_built_once_across_threads(self):
+        built = []
+        backend = FakeOperationsBackend({"op-1": {"name": "op-1", "done": True}})
+
+        def factory():
+            built.append(1)
+            return backend
+
+        lookup = OperationsLookup(factory)
+        threads = [threading.Thread(target=lookup.get, args=("op-1",)) for _ in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(built), 1)
+        self.assertEqual(backend.calls, 10)
+        self.assertEqual(lookup.get("op-1")["done"], True)
+
+    def test_set_backend(self):
+        lookup = OperationsLookup(lambda: FakeOperationsBackend())
+        lookup.set_backend(FakeOperationsBackend({"op-2": {"name": "op-2"}}))
+        self.assertEqual(lookup.get("op-2")["name"], "op-2")
+
+
+def _operation(progress, done=False, results=None):
+    operation_dict = {
+        "name": "op-1",
+        "metadata": {
+            "progressPercent": progress,
+            "startTime": "2020-04-25T21:22:07.436054Z",
+            "lastUpdateTime": "2020-04-25T21:22:14.434078Z",
+        },
+    }
+    if done:
+        operation_dict["done"] = True
+        operation_dict["response"] = {"results": results or []}
+
+    return operation_dict
+
+
+class TranscriptionPollerTest(SimpleTestCase):
+    request_path = "users/user-1/transcribeRequests/request-1"
+
+    def setUp(self):
+        self.db = FakeFirestore()
+        self.db.document(self.request_path).set({
+            "filename": "sermon.flac",
+            "file_last_modified": "1587849000",
+            "id": "request-1",
+            "user_id": "user-1",
+            "file_type": "audio/flac",
+            "status": "transcribing",
+            "transaction_id": "op-1",
+        })
+        self.backend = FakeOperationsBackend({"op-1": _operation(10)})
+        self.now = 0
+        self.poller = TranscriptionPoller(self.db, OperationsLookup(lambda: self.backend), interval=5, max_interval=20, clock=lambda: self.now)
+
+        override = services.override(db=self.db)
+        override.__enter__()
+        self.addCleanup(override.__exit__, None, None, None)
+
+    def test_persists_progress(self):
+        self.assertEqual(self.poller.poll_once(), 1)
+        data = self.db.documents[self.request_path]
+        self.assertEqual(data["transcript_metadata"]["progress_percent"], 10)
+
+    def test_only_writes_what_changed(self):
+        from .transcribe_class import TranscribeRequest
+
+        snapshot = self.db.document(self.request_path).get()
+        transcribe_request = TranscribeRequest.from_firestore(snapshot.to_dict())
+        transcribe_request.apply_operation(_operation(10))
+        self.assertEqual(transcribe_request.write_stats()["documents"], 1)
+        self.assertEqual(transcribe_request.dirty_fields(), set())
+
+        writes = self.db.writes
+        transcribe_request.apply_operation(_operation(10))
+        self.assertEqual(self.db.writes, writes)
+        self.assertEqual(transcribe_request.write_stats()["documents"], 1)
+
+    def test_finished_poll_round_trips(self):
+        results = [{"alternatives": [{"transcript": "sua s'dei", "confidence": 0.9}]}]
+        self.backend.set_operation("op-1", _operation(100, done=True, results=results))
+        # not counting the set in setUp
+        round_trips = self.db.round_trips
+        self.poller.poll_once()
+
+        # scan is 1, then claim (get + commit), and everything else in one commit
+        self.assertEqual(self.db.round_trips - round_trips, 4)
+        self.assertEqual(self.db.documents[self.request_path]["status"], "transcription-processed")
+        # the request doc gets the final manifest, so the transcript can be loaded from it
+        self.assertEqual(self.db.documents[self.request_path]["transcript_pages"]["utterance_count"], 1)
+        event_logs = [path for path in self.db.documents if path.startswith(self.request_path + "/eventLogs/")]
+        self.assertEqual(len(event_logs), 2)
+        summary = self.db.documents[self.request_path]["event_summary"]
+        self.assertEqual(summary["events"], ["processing-transcription", "transcription-processed"])
+        self.assertEqual(summary["error_count"], 0)
+
+    def test_server_has_received_uses_summary(self):
+        from .transcribe_class import TranscribeRequest
+
+        snapshot = self.db.document(self.request_path).get()
+        transcribe_request = TranscribeRequest.from_firestore(snapshot.to_dict())
+        transcribe_request.mark_as_received()
+        round_trips = self.db.round_trips
+
+        transcribe_request.refresh_from_db()
+        self.assertTrue(transcribe_request.server_has_received())
+        # just the refresh, no event log reads
+        self.assertEqual(self.db.round_trips, round_trips + 1)
+
+    def test_backs_off_while_progress_is_not_moving(self):
+        self.poller.poll_once()
+        self.assertEqual(self.poller.poll_once(), 0) # not due yet
+
+        self.now = 5
+        self.poller.poll_once()
+        self.assertEqual(self.poller.schedule["op-1"]["interval"], 10)
+
+        self.now = 15
+        self.backend.set_operation("op-1", _operation(50))
+        self.poller.poll_once()
+        self.assertEqual(self.poller.schedule["op-1"]["interval"], 5)
+
+    def test_combines_child_operations(self):
+        self.db.document(self.request_path).update({"child_operations": [
+            {"name": "op-1", "offset_seconds": 0, "path": "audio/sermon.flac.segment-000.flac"},
+            {"name": "op-2", "offset_seconds": 600, "path": "audio/sermon.flac.segment-001.flac"},
+        ]})
+        self.backend.set_operation("op-2", {**_operation(30), "name": "op-2"})
+
+        self.poller.poll_once()
+        self.assertEqual(self.db.documents[self.request_path]["transcript_metadata"]["progress_percent"], 20)
+
+    def test_appends_finished_segments(self):
+        self.db.document(self.request_path).update({"child_operations": [
+            {"name": "op-1", "offset_seconds": 0, "path": "audio/sermon.flac.segment-000.flac"},
+            {"name": "op-2", "offset_seconds": 600, "path": "audio/sermon.flac.segment-001.flac"},
+        ]})
+        results = [{"alternatives": [{"transcript": "sua s'dei", "confidence": 0.9}]}]
+        self.backend.set_operation("op-1", _operation(100, done=True, results=results))
+        self.backend.set_operation("op-2", {**_operation(30), "name": "op-2"})
+
+        self.poller.poll_once()
+
+        manifest = self.db.documents[self.request_path]["transcript_pages"]
+        self.assertEqual(manifest["utterance_count"], 1)
+        self.assertFalse(manifest["complete"])
+        pages = [path for path in self.db.documents if f"/{PAGES_COLLECTION}/" in path]
+        self.assertEqual(len(pages), 1)
+
+        self.now = 100
+        self.backend.set_operation("op-2", {**_operation(100, done=True, results=results), "name": "op-2"})
+        with self.settings(STORAGE_CLEANUP_IN_BACKGROUND=False), services.override(bucket=FakeBucket()):
+            self.poller.poll_once()
+
+        manifest = self.db.documents[self.request_path]["transcript_pages"]
+        self.assertEqual(manifest["utterance_count"], 2)
+        self.assertTrue(manifest["complete"])
+        self.assertEqual(self.db.documents[self.request_path]["status"], "transcription-processed")
+        self.assertNotIn("utterances", self.db.documents[self.request_path])
+
+    def test_processes_results_once(self):
+        results = [{"alternatives": [{"transcript": "sua s'dei", "confidence": 0.9}]}]
+        self.backend.set_operation("op-1", _operation(100, done=True, results=results))
+
+        with mock.patch("transcription.transcribe_class.TranscribeRequest.handle_transcript_results", autospec=True) as handle:
+            self.poller.poll_once()
+            # check_status from the web process gets there too, but shouldn't process it again
+            self.poller.apply(self.db.document(self.request_path).get(), self.backend.get_operation("op-1"))
+
+        self.assertEqual(handle.call_count, 1)
+        self.assertEqual(self.db.documents[self.request_path]["status"], "processing-transcription")
+
+
+class TTLCacheTest(SimpleTestCase):
+    def test_expires_and_evicts(self):
+        now = [0]
+        cache = TTLCache(maxsize=2, ttl=5, clock=lambda: now[0])
+        cache.set("a", 1)
+        cache.set("done", 2, ttl=NO_EXPIRY)
+
+        now[0] = 10
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(cache.get("done"), 2)
+
+        cache.set("b", 3)
+        cache.set("c", 4)
+        self.assertIsNone(cache.get("done"))
+        self.assertEqual(cache.stats()["evictions"], 1)
+        self.assertEqual(cache.stats()["expirations"], 1)
+
+    def test_concurrent_loads_are_coalesced(self):
+        cache = TTLCache()
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def loader():
+            calls.append(1)
+            started.set()
+            release.wait()
+            return "checked"
+
+        results = []
+        leader = threading.Thread(target=lambda: results.append(cache.get_or_load("op-1", loader)))
+        leader.start()
+        started.wait()
+        followers = [threading.Thread(target=lambda: results.append(cache.get_or_load("op-1", loader))) for _ in range(5)]
+        for follower in followers:
+            follower.start()
+
+        # wait until all the followers are waiting on the leader
+        while cache.stats()["coalesced"] < 5:
+            pass
+        release.set()
+        for thread in [leader] + followers:
+            thread.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, ["checked"] * 6)
+        self.assertEqual(cache.get_or_load("op-1", loader), "checked")
+        self.assertEqual(cache.stats()["hits"], 1)
+
+    async def test_concurrent_async_loads_are_coalesced(self):
+        cache = TTLCache()
+        release = asyncio.Event()
+        calls = []
+
+        async def loader():
+            calls.append(1)
+            await release.wait()
+            return "checked"
+
+        loads = [asyncio.ensure_future(cache.get_or_load_async("op-1", loader)) for _ in range(6)]
+        while cache.stats()["coalesced"] < 5:
+            await asyncio.sleep(0)
+        release.set()
+
+        self.assertEqual(await asyncio.gather(*loads), ["checked"] * 6)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(await cache.get_or_load_async("op-1", loader), "checked")
+        self.assertEqual(cache.stats()["hits"], 1)
+
+
+class UnitOfWorkTest(SimpleTestCase):
+    def test_one_round_trip_per_flush(self):
+        db = FakeFirestore()
+        unit_of_work = UnitOfWork(db)
+        ref = db.document("users/user-1/transcribeRequests/request-1")
+        unit_of_work.set(ref, {"status": "processing-file"}, merge=True)
+        unit_of_work.add(ref.collection("eventLogs"), {"event": "processing-file"})
+        self.assertEqual(db.round_trips, 0)
+
+        self.assertEqual(unit_of_work.flush(), 2)
+        self.assertEqual(db.round_trips, 1)
+        self.assertEqual(len(db.documents), 2)
+
+    def test_commit_is_atomic(self):
+        db = FakeFirestore()
+        ref = db.document("users/user-1/transcribeRequests/request-1")
+        ref.set({"status": "transcribing"})
+        stale = ref.get().update_time
+        ref.set({"progress": 50}, merge=True)
+
+        unit_of_work = UnitOfWork(db)
+        unit_of_work.update(ref, {"status": "processing-transcription"}, option=db.write_option(last_update_time=stale))
+        unit_of_work.add(ref.collection("eventLogs"), {"event": "processing-transcription"})
+        with self.assertRaises(exceptions.FailedPrecondition):
+            unit_of_work.flush()
+
+        self.assertEqual(len(db.documents), 1)
+        self.assertEqual(db.documents[ref.path]["status"], "transcribing")
+
+
+class ServiceRegistryTest(SimpleTestCase):
+    def test_lazy_and_shared(self):
+        created = []
+        registry = ServiceRegistry()
+        registry.register("db", lambda registry: created.append(1) or object())
+        self.assertEqual(registry.initialized(), [])
+
+        self.assertIs(registry.db, registry.db)
+        self.assertEqual(len(created), 1)
+
+    def test_override(self):
+        registry = ServiceRegistry()
+        registry.register("db", lambda registry: "real")
+        with registry.override(db="fake"):
+            self.assertEqual(registry.db, "fake")
+        self.assertEqual(registry.db, "real")
+
+    def test_factory_errors_propagate(self):
+        registry = ServiceRegistry()
+        registry.register("db", lambda registry: {}["service_account"])
+
+        with self.assertRaises(KeyError):
+            registry.db
+        with self.assertRaises(AttributeError):
+            registry.speech_client
+
+    def test_importing_helpers_creates_nothing(self):
+        # other tests override some services, but nothing should have created the real ones
+        self.assertNotIn("firebase_app", services.initialized())
+        # or import the libs for them (the factories do that)
+        self.assertNotIn("firebase_admin", sys.modules)
+        self.assertNotIn("google.cloud.speech_v1p1beta1", sys.modules)
+
+
+class AsyncViewsTest(SimpleTestCase):
+    def setUp(self):
+        self.db = FakeFirestore()
+        self.doc = {
+            "filename": "sermon.flac",
+            "file_last_modified": "1587849000",
+            "id": "request-1",
+            "user_id": "user-1",
+            "file_type": "audio/flac",
+            "status": "transcribing",
+            "transaction_id": "op-async",
+        }
+        self.db.document("users/user-1/transcribeRequests/request-1").set(self.doc)
+        operations_lookup.set_backend(FakeOperationsBackend({"op-async": _operation(42)}))
+        self.addCleanup(operations_lookup.reset)
+
+        override = services.override(db=self.db)
+        override.__enter__()
+        self.addCleanup(override.__exit__, None, None, None)
+
+    async def test_check_status(self):
+        request = RequestFactory().post("/check-status/", data=json.dumps(self.doc), content_type="application/json")
+        response = await async_views.check_status(request)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content)["progress_percent"], 42)
+
+
+class ResponseFieldsTest(AsyncViewsTest):
+    def setUp(self):
+        super().setUp()
+        views.check_status_cache.clear()
+        self.addCleanup(views.check_status_cache.clear)
+
+    def check_status(self, query="", **headers):
+        request = RequestFactory().post("/check-status/" + query, data=json.dumps(self.doc), content_type="application/json", **headers)
+        return views.check_status(request)
+
+    def test_default_fields(self):
+        response = self.check_status()
+
+        data = json.loads(response.content)
+        self.assertEqual(data["progress_percent"], 42)
+        self.assertEqual(sorted(data["current_request_data"]), ["progress_percent", "status", "updated_at"])
+
+    def test_requested_fields(self):
+        data = json.loads(self.check_status("?fields=status,filename").content)
+        self.assertEqual(data["current_request_data"], {"status": "transcribing", "filename": "sermon.flac"})
+
+        data = json.loads(self.check_status("?fields=all").content)
+        self.assertIn("transcript_pages", data["current_request_data"])
+        # not finished, so no transcript yet
+        self.assertIsNone(data["current_request_data"]["utterances"])
+
+    def test_shared_transaction_id(self):
+        first = json.loads(self.check_status("?fields=id,filename").content)
+        self.doc = dict(self.doc, id="request-2", filename="other.flac")
+        self.db.document("users/user-1/transcribeRequests/request-2").set(self.doc)
+        second = json.loads(self.check_status("?fields=id,filename").content)
+
+        self.assertEqual(first["current_request_data"], {"id": "request-1", "filename": "sermon.flac"})
+        self.assertEqual(second["current_request_data"], {"id": "request-2", "filename": "other.flac"})
+
+    def test_unknown_field(self):
+        response = self.check_status("?fields=status,event_logs")
+
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("event_logs", json.loads(response.content)["error"])
+
+    def test_not_modified(self):
+        first = self.check_status()
+        second = self.check_status(HTTP_IF_NONE_MATCH=first["ETag"])
+
+        self.assertEqual(second.status_code, 304)
+        self.assertEqual(second.content, b"")
+
+        operations_lookup.set_backend(FakeOperationsBackend({"op-async": _operation(43)}))
+        views.check_status_cache.clear()
+        self.assertEqual(self.check_status(HTTP_IF_NONE_MATCH=first["ETag"]).status_code, 200)
+
+
+class CheckStatusBulkTest(SimpleTestCase):
+    def setUp(self):
+        self.db = FakeFirestore()
+        statuses = {"request-1": ("transcribing", "op-1"), "request-2": ("transcription-processed", "op-2"), "request-3": ("transcribing", "op-gone")}
+        for id, (status, transaction_id) in statuses.items():
+            self.db.document(f"users/user-1/transcribeRequests/{id}").set({
+                "filename": f"{id}.flac",
+                "file_last_modified": "1587849000",
+                "id": id,
+                "user_id": "user-1",
+                "file_type": "audio/flac",
+                "status": status,
+                "transaction_id": transaction_id,
+            })
+
+        self.backend = FakeOperationsBackend({"op-1": _operation(42)})
+        operations_lookup.set_backend(self.backend)
+        self.addCleanup(operations_lookup.reset)
+        views.check_status_cache.clear()
+        self.addCleanup(views.check_status_cache.clear)
+
+        override = services.override(db=self.db)
+        override.__enter__()
+        self.addCleanup(override.__exit__, None, None, None)
+
+    def check_status_bulk(self, body):
+        return views.check_status_bulk(RequestFactory().post("/check-status-bulk/", data=json.dumps(body), content_type="application/json"))
+
+    def test_one_read_for_all(self):
+        with mock.patch.object(self.db, "get_all", wraps=self.db.get_all) as get_all:
+            response = self.check_status_bulk({"user_id": "user-1", "ids": ["request-1", "request-2", "request-3", "request-4"], "fields": "status,progress_percent"})
+
+        data = json.loads(response.content)
+        self.assertEqual(get_all.call_count, 1)
+        self.assertEqual(data["results"]["request-1"], {"status": "transcribing", "progress_percent": 42})
+        self.assertEqual(data["results"]["request-2"]["status"], "transcription-processed")
+        self.assertEqual(data["missing"], ["request-4"])
+        # only the ones transcribing get looked up, and one failing doesn't fail the rest
+        self.assertEqual(self.backend.calls, 2)
+        self.assertEqual(list(data["errors"]), ["request-3"])
+
+    def test_too_many_ids(self):
+        with self.settings(CHECK_STATUS_BULK_MAX=2):
+            response = self.check_status_bulk({"user_id": "user-1", "ids": ["request-1", "request-2", "request-3"]})
+
+        self.assertEqual(response.status_code, 400)
+
+
+def _status_data(status, progress_percent=0):
+    return {
+        "message": "finished checking status",
+        "progress_percent": progress_percent,
+        "current_request_data": {"status": status, "progress_percent": progress_percent, "updated_at": f"2020-05-01T00:00:{progress_percent:02d}Z"},
+    }
+
+
+class StatusStreamTest(SimpleTestCase):
+    def setUp(self):
+        self.source = FakeEventSource()
+
+    async def test_one_source_per_request(self):
+        broadcaster = StatusBroadcaster(self.source)
+        first = broadcaster.subscribe("user-1/request-1", {})
+        second = broadcaster.subscribe("user-1/request-1", {})
+
+        self.source.push("user-1/request-1", _status_data("transcribing", 10))
+        self.source.push("user-1/request-1", _status_data("transcribing", 10))
+        self.source.push("user-1/request-1", _status_data("transcribing", 20))
+        self.source.finish("user-1/request-1")
+
+        for subscription in [first, second]:
+            # the repeat isn't sent again
+            self.assertEqual((await subscription.get(1))["progress_percent"], 10)
+            self.assertEqual((await subscription.get(1))["progress_percent"], 20)
+            self.assertIsNone(await subscription.get(1))
+
+        self.assertEqual(self.source.calls, {"user-1/request-1": 1})
+        self.assertEqual(broadcaster.stats()["channels"], 0)
+
+    async def test_stops_when_everyone_leaves(self):
+        broadcaster = StatusBroadcaster(self.source)
+        async with broadcaster.subscribe("user-1/request-1", {}) as subscription:
+            self.source.push("user-1/request-1", _status_data("transcribing", 10))
+            await subscription.get(1)
+            task = subscription.channel.task
+
+        with self.assertRaises(asyncio.CancelledError):
+            await task
+        self.assertEqual(broadcaster.stats(), {"channels": 0, "subscribers": 0})
+
+    async def test_polling_backs_off_until_final(self):
+        statuses = [_status_data("transcribing", 10), _status_data("transcribing", 10), _status_data("transcribing", 10), _status_data("transcription-processed", 100)]
+        sleeps = []
+
+        async def load(file_data):
+            return statuses.pop(0)
+
+        async def sleep(seconds):
+            sleeps.append(seconds)
+
+        source = PollingEventSource(load, interval=5, max_interval=15, sleep=sleep)
+        events = [data async for data in source.events("user-1/request-1", {})]
+
+        self.assertEqual(len(events), 4)
+        self.assertEqual(sleeps, [5, 10, 15])
+
+    async def test_view_streams_events(self):
+        original = async_views.status_broadcaster.source
+        async_views.status_broadcaster.source = self.source
+        self.addCleanup(setattr, async_views.status_broadcaster, "source", original)
+
+        self.source.push("user-1/request-1", _status_data("transcribing", 42))
+        self.source.push("user-1/request-1", _status_data("transcription-processed", 100))
+
+        params = {"id": "request-1", "user_id": "user-1", "filename": "sermon.flac", "file_last_modified": "1587849000", "file_type": "audio/flac", "fields": "status"}
+        response = await async_views.status_stream(RequestFactory().get("/status-stream/", params))
+        body = b"".join([chunk async for chunk in response.streaming_content]).decode("utf-8")
+
+        self.assertEqual(response["Content-Type"], "text/event-stream")
+        events = [block.splitlines() for block in body.split("\n\n") if block.startswith("event:")]
+        self.assertEqual([lines[0] for lines in events], ["event: status", "event: status", "event: done"])
+        self.assertEqual(json.loads(events[1][1][len("data: "):])["current_request_data"], {"status": "transcription-processed"})
+
+    async def test_asgi_handler_sends_async_content(self):
+        async def events():
+            yield "event: status\n\n"
+            yield "event: done\n\n"
+
+        messages = []
+
+        async def send(message):
+            messages.append(message)
+
+        await ASGIHandler().send_response(AsyncStreamingHttpResponse(events(), content_type="text/event-stream"), send)
+
+        self.assertEqual(messages[0]["type"], "http.response.start")
+        self.assertEqual(b"".join(message.get("body", b"") for message in messages[1:]), b"event: status\n\nevent: done\n\n")
+        self.assertFalse(messages[-1].get("more_body"))
+
+    async def test_view_needs_request_params(self):
+        response = await async_views.status_stream(RequestFactory().get("/status-stream/", {"id": "request-1"}))
+
+        self.assertEqual(response.status_code, 400)
+
+
+class SnapshotHubTest(SimpleTestCase):
+    def setUp(self):
+        self.now = 0
+        self.db = FakeFirestore()
+        self.path = "users/user-1/transcribeRequests/request-1"
+        self.db.document(self.path).set({"filename": "sermon.flac", "file_last_modified": "1587849000", "id": "request-1", "user_id": "user-1", "file_type": "audio/flac", "status": "transcribing"})
+        self.hub = SnapshotHub(lambda: self.db, idle_seconds=60, max_age=300, clock=lambda: self.now)
+        self.addCleanup(self.hub.reset)
+
+    def test_listeners_are_shared_and_evicted_when_idle(self):
+        self.hub.acquire(self.path)
+        self.hub.acquire(self.path)
+        self.hub.release(self.path)
+        self.assertEqual(len(self.db.watches), 1)
+
+        self.hub.release(self.path)
+        self.now = 59
+        self.hub.evict_idle()
+        self.assertEqual(self.hub.get(self.path)["status"], "transcribing")
+
+        self.now = 60
+        self.hub.evict_idle()
+        self.assertEqual(self.db.watches, [])
+        self.assertIsNone(self.hub.get(self.path))
+
+    def test_collection_listener(self):
+        with self.hub.watching("users/user-1/transcribeRequests"):
+            self.db.document("users/user-1/transcribeRequests/request-2").set({"status": "uploaded"})
+            self.assertEqual(self.hub.get("users/user-1/transcribeRequests/request-2"), {"status": "uploaded"})
+
+            self.db.document(self.path).delete()
+            self.assertIsNone(self.hub.get(self.path))
+
+    def test_stale_and_written_copies_are_not_used(self):
+        self.hub.acquire(self.path)
+        self.now = 301
+        self.assertIsNone(self.hub.get(self.path))
+
+        self.hub.put(self.path, {"status": "transcribing"})
+        self.assertIsNotNone(self.hub.get(self.path))
+
+        self.hub.invalidate(self.path)
+        self.assertIsNone(self.hub.get(self.path))
+
+    def test_refresh_from_db_reads_local_copy(self):
+        self.addCleanup(snapshot_hub.reset)
+        with self.settings(SNAPSHOT_HUB=True), services.override(db=self.db):
+            round_trips = self.db.round_trips
+            first = TranscribeRequest({"filename": "sermon.flac", "file_last_modified": "1587849000", "id": "request-1", "user_id": "user-1", "file_type": "audio/flac"})
+            first.refresh_from_db()
+
+            # someone else (e.g., the poller) writes
+            self.db.document(self.path).set({"status": "processing-transcription"}, merge=True)
+            second = TranscribeRequest({"filename": "sermon.flac", "file_last_modified": "1587849000", "id": "request-1", "user_id": "user-1", "file_type": "audio/flac"})
+            second.refresh_from_db()
+
+            self.assertEqual(first.status, "transcribing")
+            self.assertEqual(second.status, "processing-transcription")
+            # just the write, no reads
+            self.assertEqual(self.db.round_trips - round_trips, 1)
+
+
+class SerializationTest(SimpleTestCase):
+    def setUp(self):
+        self.addCleanup(serialization.set_backend, serialization.get_backend().name)
+
+    def test_stdlib(self):
+        serialization.set_backend("json")
+        data = {"b": "ពាក្យ", "a": [1, 0.5, None, True]}
+
+        self.assertEqual(serialization.dumps(data, sort_keys=True), '{"a":[1,0.5,null,true],"b":"ពាក្យ"}'.encode("utf-8"))
+        self.assertEqual(serialization.loads(serialization.dumps(data)), data)
+
+    @unittest.skipIf(serialization.orjson is None, "orjson not installed")
+    def test_backends_write_the_same(self):
+        data = synthetic_results(minutes=1)
+        serialization.set_backend("json")
+        stdlib = serialization.dumps(data, sort_keys=True)
+        serialization.set_backend("orjson")
+
+        self.assertEqual(serialization.dumps(data, sort_keys=True), stdlib)
+
+    def test_lazy_only_serializes_when_logged(self):
+        with mock.patch.object(serialization, "dumps_str", return_value="{}") as dumps_str:
+            logger = logging.getLogger("serialization-test")
+            logger.setLevel(logging.WARNING)
+            logger.info("config %s", serialization.lazy({"a": 1}))
+            self.assertFalse(dumps_str.called)
+
+            self.assertEqual(str(serialization.lazy({"a": 1})), "{}")
+
+    def test_unknown_backend(self):
+        with self.assertRaises(ValueError):
+            serialization.set_backend("simplejson")
+
+
+class StorageCleanupTest(SimpleTestCase):
+    def setUp(self):
+        self.db = FakeFirestore()
+        self.bucket = FakeBucket()
+        self.bucket.blobs = {"audio/a.flac": b"a", "audio/a.mp3": b"b"}
+
+    def test_deletes_without_exists_check(self):
+        failures = storage_cleanup.delete_blobs(["audio/a.flac", "audio/a.mp3", "audio/already-gone.flac"], bucket=self.bucket)
+
+        self.assertEqual(failures, {})
+        self.assertEqual(self.bucket.blobs, {})
+        # one delete per file, no exists() calls
+        self.assertEqual(self.bucket.round_trips, 3)
+
+    def test_records_failures_after_retrying(self):
+        sleeps = []
+        with mock.patch.object(storage_cleanup, "_delete_blob", side_effect=ConnectionResetError("Connection reset by peer")):
+            remaining = storage_cleanup.run_cleanup(["audio/a.flac"], source="users/u/transcribeRequests/r", attempts=3, sleep=sleeps.append, bucket=self.bucket, db=self.db)
+
+        self.assertEqual(remaining, ["audio/a.flac"])
+        self.assertEqual(sleeps, [2, 4])
+        failure = self.db.documents[f"storageCleanupFailures/{storage_doc_id('audio/a.flac')}"]
+        self.assertEqual(failure["source"], "users/u/transcribeRequests/r")
+
+
+class OrphanSweeperTest(SimpleTestCase):
+    def setUp(self):
+        self.now = datetime(2020, 5, 1, tzinfo=timezone.utc)
+        self.db = FakeFirestore()
+        self.bucket = FakeBucket()
+        for name in ["audio/processed.flac", "audio/transcribing.flac", "audio/unreferenced.flac", "audio/just-uploaded.flac"]:
+            self.bucket.blobs[name] = b"audio"
+            self.bucket.created[name] = self.now - timedelta(days=2)
+        self.bucket.created["audio/just-uploaded.flac"] = self.now - timedelta(minutes=5)
+
+        for status in ["processed", "transcribing"]:
+            request_path = f"users/user-1/transcribeRequests/{status}"
+            self.db.document(request_path).set({"status": {"processed": "transcription-processed"}.get(status, status)})
+            self.db.document(f"uploadRefs/{storage_doc_id(f'audio/{status}.flac')}").set({"path": f"audio/{status}.flac", "transcribe_request": request_path})
+        self.db.document(UPLOAD_REFS_BACKFILL_DOC).set({"backfilled_at": "20200501T000000Z"})
+
+    def sweeper(self, **kwargs):
+        return OrphanSweeper(self.bucket, self.db, "audio/", page_size=2, now=self.now, **kwargs)
+
+    def test_dry_run(self):
+        stats = self.sweeper(dry_run=True).run()
+
+        self.assertEqual(stats["scanned"], 4)
+        self.assertEqual(stats["orphaned"], 2)
+        self.assertEqual(stats["reasons"], {"already-processed": 1, "unreferenced": 1})
+        self.assertEqual(len(self.bucket.blobs), 4)
+
+    def test_deletes_orphans(self):
+        stats = self.sweeper().run()
+
+        self.assertEqual(stats["deleted"], 2)
+        self.assertEqual(sorted(self.bucket.blobs), ["audio/just-uploaded.flac", "audio/transcribing.flac"])
+        self.assertNotIn(f"uploadRefs/{storage_doc_id('audio/processed.flac')}", self.db.documents)
+
+    def test_leaves_unindexed_files_until_backfilled(self):
+        self.db.document(UPLOAD_REFS_BACKFILL_DOC).delete()
+        stats = self.sweeper().run()
+
+        self.assertEqual(stats["reasons"], {"already-processed": 1})
+        self.assertEqual(stats["skipped_unindexed"], 1)
+        self.assertIn("audio/unreferenced.flac", self.bucket.blobs)
+
+    def test_backfill_indexes_existing_requests(self):
+        self.db.document("users/user-1/transcribeRequests/old").set({"status": "transcribing", "file_path": "audio/unreferenced.flac"})
+        self.db.document(UPLOAD_REFS_BACKFILL_DOC).delete()
+
+        self.assertEqual(backfill_upload_refs(self.db), 1)
+        stats = self.sweeper().run()
+        self.assertEqual(stats["reasons"], {"already-processed": 1})
+        self.assertIn("audio/unreferenced.flac", self.bucket.blobs)
+
+    def test_needs_prefix(self):
+        with self.assertRaises(ValueError):
+            OrphanSweeper(self.bucket, self.db, None)
+
+    def test_doc_ids_dont_collide(self):
+        self.assertNotEqual(storage_doc_id("audio/a__b.flac"), storage_doc_id("audio__a/b.flac"))
+        self.assertNotIn("/", storage_doc_id("audio/a/b.flac"))
+
+
+class AudioProbeTest(SimpleTestCase):
+    fixtures_dir = os.path.join(os.path.dirname(__file__), "fixtures", "audio")
+
+    def setUp(self):
+        self.bucket = FakeBucket()
+        for name in os.listdir(self.fixtures_dir):
+            with open(os.path.join(self.fixtures_dir, name), "rb") as f:
+                self.bucket.blobs[f"audio/{name}"] = f.read()
+
+        override = services.override(bucket=self.bucket)
+        override.__enter__()
+        self.addCleanup(override.__exit__, None, None, None)
+
+    def test_fixtures(self):
+        expected = {
+            "mono_16000.wav": AudioInfo("LINEAR16", 16000, 1, 16),
+            "stereo_44100.wav": AudioInfo("LINEAR16", 44100, 2, 16),
+            "mono_8000_mulaw.wav": AudioInfo("MULAW", 8000, 1, 8),
+            "mono_16000.flac": AudioInfo("FLAC", 16000, 1, 16),
+            "stereo_48000.flac": AudioInfo("FLAC", 48000, 2, 24),
+            "mono_22050.mp3": AudioInfo("MP3", 22050, 1, None),
+            "stereo_44100_id3.mp3": AudioInfo("MP3", 44100, 2, None),
+            "not_audio.txt": None,
+        }
+        for name, info in expected.items():
+            with self.subTest(name):
+                self.assertEqual(probe_blob(self.bucket.blob(f"audio/{name}")), info)
+
+    def test_only_reads_the_header(self):
+        self.bucket.blobs["audio/long.wav"] = self.bucket.blobs["audio/mono_16000.wav"] + b"\x00" * 10 ** 6
+        reads = []
+        blob = self.bucket.blob("audio/long.wav")
+        download = blob.download_as_string
+        blob.download_as_string = lambda start=None, end=None: reads.append((start, end)) or download(start, end)
+
+        probe_blob(blob)
+
+        self.assertEqual(reads, [(0, 16 * 1024 - 1)])
+
+    def test_setup_request_uses_header(self):
+        transcribe_request = TranscribeRequest({
+            "filename": "stereo_44100_id3.mp3",
+            "file_last_modified": "1587849000",
+            "id": "request-1",
+            "user_id": "user-1",
+            "file_type": "audio/mp3",
+            "file_path": "audio/stereo_44100_id3.mp3",
+        })
+        transcribe_request.setup_request()
+        config = transcribe_request.request_params["config"]
+
+        self.assertEqual(config["sample_rate_hertz"], 44100)
+        self.assertEqual(config["audio_channel_count"], 2)
+        self.assertTrue(config["enable_separate_recognition_per_channel"])
+        # didn't change the defaults for the next request
+        self.assertEqual(TranscribeRequest._mp3_config["sample_rate_hertz"], 16000)
+
+
+class RetriesTest(SimpleTestCase):
+    def setUp(self):
+        self.now = 0
+        self.sleeps = []
+        self.breaker = CircuitBreaker(threshold=4, reset_seconds=30, clock=lambda: self.now)
+        self.policy = RetryPolicy(max_attempts=4, deadline=60, backoff=Backoff(initial=1, maximum=5, random=lambda: 1), breaker=self.breaker, clock=lambda: self.now, sleep=self.sleep)
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+    def failing(self, *errors):
+        errors = list(errors)
+
+        def call():
+            if errors:
+                raise errors.pop(0)
+            return "op"
+
+        return call
+
+    def test_classify(self):
+        self.assertEqual(classify(exceptions.ServiceUnavailable("down")), TRANSIENT)
+        self.assertEqual(classify(exceptions.InternalServerError("13 INTERNAL")), TRANSIENT)
+        self.assertEqual(classify(ConnectionResetError("Connection reset by peer")), TRANSIENT)
+        self.assertEqual(classify(exceptions.InvalidArgument("bad sample rate hertz.")), INVALID)
+        self.assertEqual(classify(exceptions.PermissionDenied("no")), FATAL)
+        # used to be retried, since "13" is in the message
+        self.assertEqual(classify(exceptions.NotFound("No such object: audio/2013.flac")), FATAL)
+
+    def test_backoff_until_success(self):
+        result = self.policy.call(self.failing(exceptions.ServiceUnavailable("down"), exceptions.ServiceUnavailable("down"), exceptions.GatewayTimeout("slow")))
+
+        self.assertEqual(result, "op")
+        self.assertEqual(self.sleeps, [1, 2, 4])
+        self.assertEqual(self.breaker.stats()["consecutive_failures"], 0)
+
+    def test_gives_up(self):
+        with self.assertRaises(exceptions.InvalidArgument):
+            self.policy.call(self.failing(exceptions.InvalidArgument("bad sample rate hertz.")))
+        self.assertEqual(self.sleeps, [])
+
+        # would be past the deadline before the next try
+        self.policy.deadline = 2
+        with self.assertRaises(exceptions.ServiceUnavailable):
+            self.policy.call(self.failing(*[exceptions.ServiceUnavailable("down")] * 3))
+        self.assertEqual(self.sleeps, [1])
+
+    def test_circuit_breaker(self):
+        for _ in range(4):
+            with self.assertRaises(exceptions.ServiceUnavailable):
+                RetryPolicy(max_attempts=1, breaker=self.breaker, clock=lambda: self.now).call(self.failing(exceptions.ServiceUnavailable("down")))
+
+        calls = []
+        with self.assertRaises(CircuitOpenError):
+            self.policy.call(lambda: calls.append(1))
+        self.assertEqual((calls, self.breaker.state), ([], CircuitBreaker.OPEN))
+
+        # one call gets through to try, and it working closes the breaker again
+        self.now = 30
+        self.assertEqual(self.breaker.state, CircuitBreaker.HALF_OPEN)
+        self.assertEqual(self.policy.call(self.failing()), "op")
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+
+    def test_stereo_gets_multiple_channels(self):
+        db = FakeFirestore()
+        bucket = FakeBucket()
+        with open(os.path.join(AudioProbeTest.fixtures_dir, "mono_16000.flac"), "rb") as f:
+            bucket.blobs["audio/stereo.flac"] = f.read()
+        speech_client = mock.Mock()
+        speech_client.long_running_recognize.side_effect = [exceptions.InvalidArgument("Invalid audio channel count"), mock.Mock(**{"operation.name": "op-stereo"})]
+
+        file_data = {"filename": "stereo.flac", "file_last_modified": "1587849000", "id": "request-1", "user_id": "user-1", "file_type": "audio/flac", "file_path": "audio/stereo.flac"}
+        db.document("users/user-1/transcribeRequests/request-1").set(file_data)
+
+        with services.override(db=db, bucket=bucket, speech_client=speech_client), mock.patch("transcription.transcribe_class.speech_retry", self.policy):
+            transcribe_request = TranscribeRequest(file_data)
+            transcribe_request.request_transcription()
+
+        self.assertEqual(transcribe_request.status, "transcribing")
+        self.assertEqual(transcribe_request.transaction_id, "op-stereo")
+        self.assertTrue(transcribe_request.request_options["multiple_channels"])
+        self.assertEqual(transcribe_request.failed_attempts, 1)
+        self.assertEqual(self.sleeps, [])
+
+
+class MetricsTest(SimpleTestCase):
+    def sample(self, name, **labels):
+        return REGISTRY.get_sample_value(name, labels) or 0
+
+    def test_timed(self):
+        before = self.sample("transcription_external_call_duration_seconds_count", service="test", call="get")
+
+        with metrics.timed("test", "get"):
+            pass
+        with self.assertRaises(exceptions.ServiceUnavailable), metrics.timed("test", "get"):
+            raise exceptions.ServiceUnavailable("down")
+        with self.settings(METRICS=False), metrics.timed("test", "get"):
+            pass
+
+        self.assertEqual(self.sample("transcription_external_call_duration_seconds_count", service="test", call="get"), before + 2)
+        self.assertEqual(self.sample("transcription_external_call_errors_total", service="test", call="get"), 1)
+
+    def test_status_transitions(self):
+        db = FakeFirestore()
+        file_data = {"filename": "sermon.flac", "file_last_modified": "1587849000", "id": "request-1", "user_id": "user-1", "file_type": "audio/flac", "status": "uploaded", "updated_at": "20200501T000000Z"}
+        db.document("users/user-1/transcribeRequests/request-1").set(file_data)
+        transitions = self.sample("transcription_status_transitions_total", from_status="uploaded", to_status="processing-file")
+        durations = self.sample("transcription_status_duration_seconds_count", status="uploaded")
+
+        with services.override(db=db):
+            TranscribeRequest(file_data).mark_as_received()
+
+        self.assertEqual(self.sample("transcription_status_transitions_total", from_status="uploaded", to_status="processing-file"), transitions + 1)
+        self.assertEqual(self.sample("transcription_status_duration_seconds_count", status="uploaded"), durations + 1)
+
+    def test_firestore_reads_timed(self):
+        db = FakeFirestore()
+        file_data = {"filename": "sermon.flac", "file_last_modified": "1587849000", "id": "request-1", "user_id": "user-1", "file_type": "audio/flac", "status": "transcribing"}
+        db.document("users/user-1/transcribeRequests/request-1").set(file_data)
+        gets = self.sample("transcription_external_call_duration_seconds_count", service="firestore", call="get")
+        streams = self.sample("transcription_external_call_duration_seconds_count", service="firestore", call="stream")
+
+        with services.override(db=db):
+            transcribe_request = TranscribeRequest(file_data)
+            transcribe_request.event_logs
+            self.assertTrue(transcribe_request.claim_for_processing())
+
+        self.assertEqual(self.sample("transcription_external_call_duration_seconds_count", service="firestore", call="stream"), streams + 1)
+        self.assertGreaterEqual(self.sample("transcription_external_call_duration_seconds_count", service="firestore", call="get"), gets + 1)
+
+    def test_metrics_endpoint(self):
+        self.client.get("/wake-up/")
+        with self.settings(STATS_TOKEN="scrape-token"):
+            response = self.client.get("/metrics", HTTP_AUTHORIZATION="Bearer scrape-token")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('transcription_view_duration_seconds_count{method="GET",status="200",view="wake-up"}', response.content.decode())
+
+    def test_stats_need_staff_or_token(self):
+        with self.settings(STATS_TOKEN="scrape-token"):
+            for path in ["/metrics", "/cache-stats/", "/queue-stats/", "/admission-stats/"]:
+                self.assertEqual(self.client.get(path).status_code, 401)
+                self.assertEqual(self.client.get(path, HTTP_AUTHORIZATION="Bearer wrong").status_code, 401)
+
+            self.assertEqual(self.client.get("/admission-stats/", HTTP_AUTHORIZATION="Bearer scrape-token").status_code, 200)
+
+        with self.settings(STATS_TOKEN=None):
+            # no token set means no token works
+            self.assertEqual(self.client.get("/metrics", HTTP_AUTHORIZATION="Bearer ").status_code, 401)
+
+
+class AdmissionTest(SimpleTestCase):
+    def setUp(self):
+        self.now = 1000
+        self.store = MemoryStore()
+
+    def controller(self, **limits):
+        return AdmissionController(self.store, busy_retry_seconds=30, slot_seconds=3600, clock=lambda: self.now, **limits)
+
+    def test_token_bucket(self):
+        admission = self.controller(user_rate=1 / 60, user_burst=2)
+        admission.admit("user-1", "request-1")
+        admission.admit("user-1", "request-2")
+        # same request again (e.g., a resume) isn't charged
+        admission.admit("user-1", "request-1")
+
+        with self.assertRaises(Throttled) as context:
+            admission.admit("user-1", "request-3")
+        self.assertEqual(context.exception.retry_after_header(), "60")
+        # someone else still can
+        admission.admit("user-2", "request-4")
+
+        # turned away without going to the store
+        with mock.patch.object(self.store, "get", wraps=self.store.get) as get, self.assertRaises(Throttled):
+            admission.admit("user-1", "request-3")
+        get.assert_not_called()
+
+        self.now += 60
+        admission.admit("user-1", "request-3")
+        self.assertEqual(admission.stats()["throttled_locally"], 1)
+
+    def test_operations_cap(self):
+        admission = self.controller(max_operations_per_user=1, max_operations=2)
+        admission.admit("user-1", "request-1")
+        with self.assertRaises(Throttled) as context:
+            admission.admit("user-1", "request-2")
+        self.assertEqual(context.exception.retry_after, 30)
+
+        admission.release("request-1")
+        admission.release("request-1")
+        admission.admit("user-1", "request-2")
+        admission.admit("user-2", "request-3")
+        with self.assertRaises(Throttled):
+            admission.admit("user-3", "request-4")
+
+        # never heard back about these, so once they expire they stop counting
+        self.now += 3600
+        admission.admit("user-3", "request-4")
+        self.assertEqual(self.store.counters["operations:global"]["value"], 1)
+        self.assertEqual(admission.stats()["expired"], 2)
+
+    def test_throttled_gives_back_what_it_took(self):
+        admission = self.controller(user_rate=1 / 60, user_burst=5, global_rate=1 / 60, global_burst=1, max_operations_per_user=5)
+        admission.admit("user-1", "request-1")
+        with self.assertRaises(Throttled):
+            admission.admit("user-1", "request-2")
+
+        self.assertEqual(self.store.counters["tokens:user:user-1"]["value"], 4)
+        self.assertEqual(self.store.counters["operations:user:user-1"]["value"], 1)
+
+    def race(self, admission, count):
+        barrier = threading.Barrier(count)
+        results = []
+
+        def admit(n):
+            barrier.wait()
+            try:
+                admission.admit(f"user-{n % 4}", f"request-{n}")
+                results.append(True)
+            except Throttled:
+                results.append(False)
+
+        threads = [threading.Thread(target=admit, args=(n,)) for n in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        return results.count(True)
+
+    def test_concurrent_tokens(self):
+        admission = self.controller(global_rate=1 / 60, global_burst=5)
+
+        self.assertEqual(self.race(admission, 16), 5)
+        self.assertEqual(self.store.counters["tokens:global"]["value"], 0)
+        self.assertEqual(len(self.store.slots), 5)
+
+    def test_concurrent_operations(self):
+        admission = self.controller(max_operations=3)
+
+        self.assertEqual(self.race(admission, 16), 3)
+        self.assertEqual(self.store.counters["operations:global"]["value"], 3)
+
+
+class AdmissionViewTest(TestCase):
+    def setUp(self):
+        self.admission = AdmissionController(DatabaseStore(), user_rate=1 / 60, user_burst=1)
+        patch = mock.patch.object(views, "admission_control", self.admission)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+        self.db = FakeFirestore()
+        override = services.override(db=self.db)
+        override.__enter__()
+        self.addCleanup(override.__exit__, None, None, None)
+
+    def test_rejected_with_retry_after(self):
+        self.admission.admit("user-1", "users/user-1/transcribeRequests/request-0")
+        file_data = {"filename": "sermon.flac", "file_last_modified": "1587849000", "id": "request-1", "user_id": "user-1", "file_type": "audio/flac", "file_path": "audio/sermon.flac"}
+
+        with self.settings(ADMISSION_CONTROL=True):
+            response = views.transcribe(RequestFactory().post("/request-transcribe/", data=json.dumps(file_data), content_type="application/json"))
+
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response["Retry-After"], "60")
+        self.assertNotIn("users/user-1/transcribeRequests/request-1", self.db.documents)
+        self.assertEqual(AdmissionCounter.objects.get(key="tokens:user:user-1").version, 1)
+
+
+class JobQueueTest(TransactionTestCase):
+    """
+    TransactionTestCase, since the worker runs jobs on its own threads (and db connections)
+    """
 
-class SimpleTest(TestCase):
     def setUp(self):
-        # Every test needs access to the request factory.
-        self.factory = RequestFactory()
+        self.db = FakeFirestore()
+        self.bucket = FakeBucket()
+        with open(os.path.join(AudioProbeTest.fixtures_dir, "mono_16000.flac"), "rb") as f:
+            self.bucket.blobs["audio/sermon.flac"] = f.read()
+
+        self.speech_client = mock.Mock()
+        self.speech_client.long_running_recognize.return_value.operation.name = "op-queued"
 
-    def test_details(self):
-        # Create an instance of a GET request.
-        request = self.factory.get("/")
-        request.user = AnonymousUser()
+        override = services.override(db=self.db, bucket=self.bucket, speech_client=self.speech_client)
+        override.__enter__()
+        self.addCleanup(override.__exit__, None, None, None)
+
+        self.file_data = {
+            "filename": "sermon.flac",
+            "file_last_modified": "1587849000",
+            "id": "request-1",
+            "user_id": "user-1",
+            "file_type": "audio/flac",
+            "file_path": "audio/sermon.flac",
+        }
+        self.db.document("users/user-1/transcribeRequests/request-1").set(self.file_data)
+
+        self.worker = job_queue.JobWorker(worker_id="worker-1", concurrency=2)
+        self.addCleanup(self.worker.stop)
+
+    def test_transcribe_enqueues(self):
+        with self.settings(JOB_QUEUE=True):
+            request = RequestFactory().post("/request-transcribe/", data=json.dumps(self.file_data), content_type="application/json")
+            response = views.transcribe(request)
+            # asking again while it's queued doesn't queue it twice
+            views.transcribe(RequestFactory().post("/request-transcribe/", data=json.dumps(self.file_data), content_type="application/json"))
 
-        # Test my_view() as if it were deployed at /customer/details
-        response = index(request)
         self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content)["current_request_data"]["status"], "processing-file")
+        self.speech_client.long_running_recognize.assert_not_called()
+        self.assertEqual(Job.objects.filter(status=Job.QUEUED).count(), 1)
+
+        self.assertEqual(self.worker.run_once(), 1)
+
+        job = Job.objects.get()
+        self.assertEqual(job.status, Job.DONE)
+        self.assertEqual(job.attempts, 1)
+        self.assertTrue({"queued", "refresh_from_db", "request_transcription", "run"} <= set(job.timings))
+        self.assertEqual(self.db.documents["users/user-1/transcribeRequests/request-1"]["transaction_id"], "op-queued")
+        self.assertEqual(job_queue.stats()["depth"][Job.DONE], 1)
+        self.assertIn("request_transcription", job_queue.stats()["latency"])
+
+    def test_transcoded_file_gets_its_own_job(self):
+        self.file_data.update(file_type="audio/x-m4a", file_path="audio/sermon.m4a", filename="sermon.m4a")
+        self.db.document("users/user-1/transcribeRequests/request-1").set(self.file_data)
+        self.bucket.blobs["audio/sermon.transcoded.flac"] = self.bucket.blobs["audio/sermon.flac"]
+
+        def schedule_transcoding(transcribe_request, on_done):
+            # converts right away, while the job that started it is still running
+            future = Future()
+            future.set_result({"destination_path": "audio/sermon.transcoded.flac"})
+            on_done(future)
+            return future
+
+        with self.settings(JOB_QUEUE=True), mock.patch("transcription.transcribe_class.schedule_transcoding", schedule_transcoding):
+            job_queue.enqueue_transcription(TranscribeRequest(self.file_data))
+            self.assertEqual(self.worker.run_once(), 1)
+            self.speech_client.long_running_recognize.assert_not_called()
+            self.assertEqual(self.worker.run_once(), 1)
+
+        self.assertEqual([job.status for job in Job.objects.order_by("id")], [Job.DONE, Job.DONE])
+        self.assertEqual(Job.objects.order_by("id").last().payload["file_path"], "audio/sermon.transcoded.flac")
+        self.assertEqual(self.db.documents["users/user-1/transcribeRequests/request-1"]["transaction_id"], "op-queued")
+
+    def test_claim(self):
+        first = job_queue.enqueue("test", {}, key="a")
+        job_queue.enqueue("test", {}, key="b")
+
+        self.assertEqual([job.id for job in job_queue.claim("worker-1", limit=1)], [first.id])
+        # a worker can't take one that's leased to someone else, and max_running caps all workers together
+        self.assertEqual(len(job_queue.claim("worker-2", limit=5)), 1)
+        job_queue.enqueue("test", {}, key="c")
+        self.assertEqual(job_queue.claim("worker-3", limit=5, max_running=2), [])
+
+        # lease ran out (e.g., the worker died), so someone else gets it
+        Job.objects.filter(id=first.id).update(lease_expires_at=first.run_after - timedelta(seconds=1))
+        reclaimed = job_queue.claim("worker-3", limit=5)
+        self.assertEqual(sorted(job.key for job in reclaimed), ["a", "c"])
+        self.assertEqual(Job.objects.get(id=first.id).attempts, 2)
+
+    def test_retries_then_fails(self):
+        calls = []
+
+        @job_queue.job_handler("flaky")
+        def flaky(payload, stages):
+            calls.append(payload)
+            raise RuntimeError("Google said no")
+
+        self.addCleanup(job_queue.JOB_HANDLERS.pop, "flaky")
+        job = job_queue.enqueue("flaky", {"n": 1}, max_attempts=2)
+
+        self.worker.run_once()
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), (Job.QUEUED, 1))
+        self.assertIn("Google said no", job.error)
+
+        # backing off, so not claimed again yet
+        self.assertEqual(self.worker.run_once(), 0)
+        Job.objects.filter(id=job.id).update(run_after=job.created_at)
+        self.worker.run_once()
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts, len(calls)), (Job.FAILED, 2, 2))
+
+
+class TranscriptCacheTest(SimpleTestCase):
+    def setUp(self):
+        self.db = FakeFirestore()
+        self.bucket = FakeBucket()
+        with open(os.path.join(AudioProbeTest.fixtures_dir, "mono_16000.flac"), "rb") as f:
+            self.audio = f.read()
+
+        self.speech_client = mock.Mock()
+        self.speech_client.long_running_recognize.return_value.operation.name = "op-new"
+
+        override = services.override(db=self.db, bucket=self.bucket, speech_client=self.speech_client)
+        override.__enter__()
+        self.addCleanup(override.__exit__, None, None, None)
+
+    def upload(self, id, filename):
+        self.bucket.blobs[f"audio/{filename}"] = self.audio
+        file_data = {
+            "filename": filename,
+            "file_last_modified": "1587849000",
+            "id": id,
+            "user_id": "user-1",
+            "file_type": "audio/flac",
+            "file_path": f"audio/{filename}",
+        }
+        self.db.document(f"users/user-1/transcribeRequests/{id}").set(file_data)
+        return TranscribeRequest(file_data)
+
+    def test_content_hash(self):
+        self.bucket.blobs["audio/a.flac"] = self.audio
+        self.assertEqual(content_hash(self.bucket.get_blob("audio/a.flac")), "md5-" + hashlib.md5(self.audio).hexdigest())
+
+        self.bucket.composite.add("audio/a.flac")
+        self.assertIsNone(content_hash(self.bucket.get_blob("audio/a.flac"), download=False))
+        self.assertEqual(content_hash(self.bucket.get_blob("audio/a.flac")), "sha256-" + hashlib.sha256(self.audio).hexdigest())
+
+    def test_reupload_skips_google(self):
+        utterances = [{"alternatives": [{"transcript": "សួស្តី", "confidence": 0.9}]}]
+        hits = transcript_cache.stats()["hits"]
+
+        with self.settings(TRANSCRIPT_CACHE=True, STORAGE_CLEANUP_IN_BACKGROUND=False):
+            first = self.upload("request-1", "sermon.flac")
+            first.request_transcription()
+            first.apply_operation(_operation(100, done=True, results=utterances))
+
+            second = self.upload("request-2", "sermon (1).flac")
+            second.request_transcription()
+
+        self.assertEqual(self.speech_client.long_running_recognize.call_count, 1)
+        self.assertEqual(second.status, "transcription-processed")
+        self.assertEqual(second.cached_from, first.content_key)
+        self.assertIsNone(self.db.documents["users/user-1/transcribeRequests/request-2"].get("transaction_id"))
+        self.assertNotEqual(second.transcript_document_ref().path, first.transcript_document_ref().path)
+        self.assertEqual(ChunkedTranscript(second.transcript_document_ref(), second.transcript_pages).utterances(), utterances)
+        self.assertEqual(self.db.documents[f"{CACHE_COLLECTION}/{first.content_key}"]["hits"], 1)
+        self.assertEqual(transcript_cache.stats()["hits"], hits + 1)
+
+    def test_retention(self):
+        now = datetime(2020, 5, 1, tzinfo=timezone.utc)
+        cache = TranscriptCache(lambda: self.db, retention=MaxAgeRetention(timedelta(days=30)), now=lambda: now)
+        self.db.document(f"{CACHE_COLLECTION}/old").set({"created_at": "20200301T000000Z", "last_hit_at": None})
+        self.db.document(f"{CACHE_COLLECTION}/hit-recently").set({"created_at": "20200301T000000Z", "last_hit_at": "20200420T000000Z"})
+        self.db.document(f"{CACHE_COLLECTION}/new").set({"created_at": "20200425T000000Z"})
+
+        self.assertIsNone(cache.lookup("old"))
+        self.assertNotIn(f"{CACHE_COLLECTION}/old", self.db.documents)
+        self.db.document(f"{CACHE_COLLECTION}/old").set({"created_at": "20200301T000000Z"})
+
+        self.assertEqual(cache.prune(dry_run=True), {"scanned": 3, "expired": 1})
+        self.assertEqual(cache.prune(), {"scanned": 3, "expired": 1})
+        self.assertEqual(sorted(self.db.documents), [f"{CACHE_COLLECTION}/hit-recently", f"{CACHE_COLLECTION}/new"])
+        self.assertEqual(cache.stats()["expired"], 2)
+
+
+class TranscodingTest(SimpleTestCase):
+    # stands in for ffmpeg, just copies stdin to stdout
+    copy_command = [sys.executable, "-c", "import sys, shutil; shutil.copyfileobj(sys.stdin.buffer, sys.stdout.buffer)"]
+
+    def setUp(self):
+        self.bucket = FakeBucket()
+        self.data = bytes(range(256)) * 4096 # 1 MB
+        self.bucket.blobs["audio/sermon.m4a"] = self.data
+
+    def test_streams_through_command(self):
+        progress = []
+        result = transcode_to_flac("audio/sermon.m4a", transcoded_path("audio/sermon.m4a"), bucket=self.bucket, chunk_size=256 * 1024,
+                                   on_progress=lambda done, total: progress.append((done, total)), command=self.copy_command)
+
+        self.assertEqual(self.bucket.blobs["audio/sermon.transcoded.flac"], self.data)
+        self.assertEqual(result["bytes_in"], len(self.data))
+        self.assertEqual([done for done, _ in progress], [256 * 1024 * i for i in range(1, 5)])
+
+    def test_failed_command(self):
+        command = [sys.executable, "-c", "import sys; sys.stderr.write('Invalid data found when processing input'); sys.exit(1)"]
+
+        with self.assertRaisesRegex(TranscodingError, "Invalid data"):
+            transcode_to_flac("audio/sermon.m4a", "audio/sermon.transcoded.flac", bucket=self.bucket, command=command)
+        self.assertNotIn("audio/sermon.transcoded.flac", self.bucket.blobs)
+
+    def test_needs_transcoding(self):
+        data = {"filename": "sermon", "file_last_modified": "1587849000", "id": "request-1", "file_path": "audio/sermon"}
+
+        self.assertTrue(TranscribeRequest({**data, "file_type": "audio/x-m4a"}).needs_transcoding())
+        self.assertTrue(TranscribeRequest({**data, "file_type": "video/mp4"}).needs_transcoding())
+        self.assertFalse(TranscribeRequest({**data, "file_type": "audio/flac"}).needs_transcoding())
+        self.assertFalse(TranscribeRequest({**data, "file_type": "audio/x-m4a", "transcoded_from": "audio/sermon.m4a"}).needs_transcoding())
+
+
+def _word(word, start, end):
+    return {"word": word, "startTime": start, "endTime": end}
+
+
+class StitchingTest(SimpleTestCase):
+    def test_stitch_results(self):
+        first = [{"alternatives": [{"transcript": "sua", "words": [_word("sua", "0.500s", "0.900s")]}], "resultEndTime": "1s"}]
+        second = [{"alternatives": [{"transcript": "s'dei", "words": [_word("s'dei", "0s", "1.250s")]}], "resultEndTime": "2s"}]
+
+        # segments can finish in any order
+        stitched = stitch_results([(600.5, second), (0, first)])
+
+        self.assertEqual([result["alternatives"][0]["transcript"] for result in stitched], ["sua", "s'dei"])
+        self.assertEqual(stitched[0]["alternatives"][0]["words"][0], _word("sua", "0.500s", "0.900s"))
+        self.assertEqual(stitched[1]["alternatives"][0]["words"][0], _word("s'dei", "600.500s", "601.750s"))
+        self.assertEqual(stitched[1]["resultEndTime"], "602.500s")
+        # didn't change the originals
+        self.assertEqual(second[0]["alternatives"][0]["words"][0]["startTime"], "0s")
+
+    def test_combine_in_progress(self):
+        children = [{"name": "op-1", "offset_seconds": 0}, {"name": "op-2", "offset_seconds": 600}]
+        first = _operation(100, done=True)
+        second = {**_operation(50), "metadata": {"progressPercent": 50, "startTime": "2020-04-25T21:20:00.000000Z", "lastUpdateTime": "2020-04-25T21:30:00.000000Z"}}
+
+        combined = combine_operations(children, [first, second])
+
+        self.assertNotIn("done", combined)
+        self.assertEqual(combined["metadata"], {
+            "progressPercent": 75,
+            "startTime": "2020-04-25T21:20:00.000000Z",
+            "lastUpdateTime": "2020-04-25T21:30:00.000000Z",
+        })
+
+    def test_combine_done_and_errored(self):
+        children = [{"name": "op-1", "offset_seconds": 0}, {"name": "op-2", "offset_seconds": 10}]
+        results = [{"alternatives": [{"transcript": "sua s'dei", "words": [_word("sua", "1s", "2s")]}]}]
+
+        combined = combine_operations(children, [_operation(100, done=True, results=results), _operation(100, done=True, results=results)])
+        self.assertTrue(combined["done"])
+        self.assertEqual([result["alternatives"][0]["words"][0]["startTime"] for result in combined["response"]["results"]], ["1s", "11s"])
+
+        errored = combine_operations(children, [_operation(100, done=True), {**_operation(40), "error": {"code": 3}}])
+        self.assertEqual(errored["error"], {"code": 3})
+        self.assertNotIn("response", errored)
+
+
+class SplittingTest(SimpleTestCase):
+    def test_parse_silencedetect(self):
+        output = "\n".join([
+            "  Duration: 00:20:00.50, start: 0.000000, bitrate: 256 kb/s",
+            "[silencedetect @ 0x1] silence_start: -0.01",
+            "[silencedetect @ 0x1] silence_end: 1.2 | silence_duration: 1.21",
+            "[silencedetect @ 0x1] silence_start: 598",
+            "[silencedetect @ 0x1] silence_end: 599 | silence_duration: 1",
+        ])
+
+        self.assertEqual(parse_silencedetect(output), ([(0.0, 1.2), (598.0, 599.0)], 1200.5))
+
+    def test_cuts_at_nearest_silence(self):
+        segments = plan_segments([(10, 11), (580, 584), (1190, 1192)], 1800, segment_seconds=600, max_segments=8)
+
+        # 582 and 1191 are the silences closest to 600 and 1200
+        self.assertEqual(segments, [(0.0, 582.0), (582.0, 1191.0), (1191.0, 1800.0)])
+
+    def test_hard_cut_without_silence(self):
+        self.assertEqual(plan_segments([], 1200, segment_seconds=600, max_segments=8), [(0.0, 600.0), (600.0, 1200.0)])
+        self.assertEqual(len(plan_segments([], 10 * 3600, segment_seconds=600, max_segments=8)), 8)
+        self.assertEqual(plan_segments([], 300, segment_seconds=600, max_segments=8), [(0.0, 300)])
+
+
+class ChunkedTranscriptTest(SimpleTestCase):
+    def setUp(self):
+        self.db = FakeFirestore()
+        self.ref = self.db.document("users/user-1/transcripts/sermon")
+        self.utterances = [{"alternatives": [{"transcript": f"utterance {i} " + "x" * 40, "confidence": 0.9}]} for i in range(10)]
+
+    def append(self, store, utterances):
+        unit_of_work = UnitOfWork(self.db)
+        store.append(utterances, unit_of_work)
+        unit_of_work.flush()
+
+    def test_pages_are_bounded(self):
+        store = ChunkedTranscript(self.ref, max_page_bytes=250)
+        self.append(store, self.utterances)
+
+        pages = store.manifest["pages"]
+        self.assertEqual(store.utterance_count, 10)
+        self.assertTrue(all(page["bytes"] <= 250 for page in pages))
+        self.assertEqual(sum(page["count"] for page in pages), 10)
+        self.assertEqual([page["first_index"] for page in pages], [sum(p["count"] for p in pages[:i]) for i in range(len(pages))])
+        self.assertEqual(store.utterances(), self.utterances)
+
+    def test_append_from_another_instance(self):
+        store = ChunkedTranscript(self.ref, max_page_bytes=250)
+        self.append(store, self.utterances[:3])
+
+        # e.g., the next poll, in another process. Only has the manifest
+        store = ChunkedTranscript(self.ref, store.manifest, max_page_bytes=250)
+        self.append(store, self.utterances[3:])
+
+        self.assertEqual(store.utterances(), self.utterances)
+
+
+class CompactTranscriptTest(SimpleTestCase):
+    def test_round_trip(self):
+        results = synthetic_results(minutes=2) + [
+            {
+                "alternatives": [{"transcript": "sua", "words": [{"word": "sua", "startTime": "0s", "endTime": "1.000001s", "speakerTag": 2, "newField": 1}]}, {"transcript": "suor"}],
+                "channelTag": 1,
+                "resultEndTime": "1.500s",
+                "unknown": [1, 2],
+            },
+            {"alternatives": []},
+            {},
+        ]
+
+        compact = CompactTranscript.from_results(results)
+
+        self.assertEqual(compact.to_results(), results)
+        self.assertEqual(len(compact), len(results))
+        self.assertEqual(compact[-3:], results[-3:])
+        self.assertEqual(compact.word_count(), 2 * 150 + 1)
+
+    def test_not_in_request_doc(self):
+        transcribe_request = TranscribeRequest({"filename": "sermon.flac", "file_last_modified": "1587849000", "id": "request-1", "file_type": "audio/flac"})
+        transcribe_request.utterances = synthetic_results(minutes=1)
+
+        self.assertNotIn("utterances", transcribe_request.to_dict())
+        self.assertEqual(transcribe_request.utterances[0], synthetic_results(minutes=1)[0])
+        # but check-status still sends them back, in the same shape as before
+        self.assertEqual(responses.serialize(transcribe_request)["utterances"], synthetic_results(minutes=1))
@@ -0,0 +1,238 @@
+"""
+Converting uploads to mono 16 kHz flac with ffmpeg, for formats Google doesn't take (and optionally mp3s, see TRANSCODE_MP3)
+
+- Streams the whole way: storage > ffmpeg's stdin, ffmpeg's stdout > storage (resumable upload). Never has more than a couple chunks in memory, and nothing goes on the dyno's disk, no matter how big the file is
+- Runs in a process pool (see schedule_transcoding), so the web worker isn't tied up running ffmpeg
+- While it runs, processing_progress on the transcribe request doc says how many bytes of the upload have gone through
+
+NOTE formats that need to seek to read the file (e.g., mp4/m4a where the "moov" atom is at the end) can't be read from a pipe, so ffmpeg fails on those and the request gets marked as a server error
+"""
+import os
+import subprocess
+import threading
+import logging
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from django.conf import settings
+from google.api_core import exceptions
+
+from .helpers import services, timestamp
+
+logger = logging.getLogger('testlogger')
+
+SAMPLE_RATE_HERTZ = 16000
+# resumable uploads need chunks that are a multiple of 256 KB
+CHUNK_SIZE = 16 * 256 * 1024
+# only write progress to firestore every this many percent, so a big file isn't hundreds of writes
+PROGRESS_STEP_PERCENT = 5
+
+_pool = None
+_pool_lock = threading.Lock()
+# runs what happens after a pool job (e.g., sending to Google) back in this process
+_continuations = ThreadPoolExecutor(max_workers=2, thread_name_prefix="transcoding")
+
+
+class TranscodingError(Exception):
+    pass
+
+
+def ffmpeg_command(sample_rate_hertz=SAMPLE_RATE_HERTZ):
+    return [
+        settings.FFMPEG_PATH, "-hide_banner", "-loglevel", "error",
+        "-i", "pipe:0",
+        # drop video, if any (e.g., mp4 of a recorded sermon)
+        "-vn",
+        "-ac", "1",
+        "-ar", str(sample_rate_hertz),
+        "-c:a", "flac",
+        "-f", "flac", "pipe:1",
+    ]
+
+
+def transcoded_path(path):
+    """
+    where the flac version of path goes
+    """
+    root, _ = os.path.splitext(path)
+    return f"{root}.transcoded.flac"
+
+
+class _ProgressWriter:
+    """
+    file-like object that passes writes through to ffmpeg's stdin, counting bytes as it goes
+    """
+    def __init__(self, stream, total_bytes, on_progress=None):
+        self.stream = stream
+        self.total_bytes = total_bytes
+        self.on_progress = on_progress
+        self.bytes_written = 0
+
+    def write(self, data):
+        self.stream.write(data)
+        self.bytes_written += len(data)
+        if self.on_progress:
+            self.on_progress(self.bytes_written, self.total_bytes)
+
+        return len(data)
+
+
+def stream_to_blob(command, destination, source=None, on_progress=None):
+    """
+    runs command (e.g., ffmpeg), streaming its stdout into a resumable upload to the destination blob
+    - if source (a blob) is given, streams it into the command's stdin
+    - on_progress gets called with (bytes read so far, total bytes) after each chunk of the source
+    - returns how many bytes of the source went in
+    """
+    process = subprocess.Popen(command, stdin=subprocess.PIPE if source else subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    writer = _ProgressWriter(process.stdin, source.size, on_progress) if source else None
+    feed_errors = []
+    # just the end of stderr, in case ffmpeg is chatty
+    stderr_tail = deque(maxlen=20)
+
+    def feed():
+        # in its own thread, since ffmpeg won't read more until we read some of what it wrote
+        try:
+            source.download_to_file(writer)
+        except BrokenPipeError:
+            # ffmpeg quit early. It'll have said why on stderr
+            pass
+        except Exception as error:
+            feed_errors.append(error)
+            process.kill()
+        finally:
+            try:
+                process.stdin.close()
+            except BrokenPipeError:
+                pass
+
+    def drain_stderr():
+        for line in process.stderr:
+            stderr_tail.append(line.decode("utf-8", "replace").rstrip())
+
+    threads = [threading.Thread(target=drain_stderr, daemon=True)]
+    if source:
+        threads.append(threading.Thread(target=feed, daemon=True))
+    for thread in threads:
+        thread.start()
+
+    try:
+        destination.upload_from_file(process.stdout, content_type="audio/flac")
+    except Exception:
+        process.kill()
+        raise
+    finally:
+        return_code = process.wait()
+        for thread in threads:
+            thread.join()
+
+    if feed_errors or return_code != 0:
+        # don't leave a half-written file around
+        try:
+            destination.delete()
+        except exceptions.NotFound:
+            pass
+
+        if feed_errors:
+            raise feed_errors[0]
+
+        raise TranscodingError(f"ffmpeg exited with {return_code}: " + " | ".join(stderr_tail))
+
+    return writer.bytes_written if writer else 0
+
+
+def transcode_to_flac(source_path, destination_path, bucket=None, chunk_size=CHUNK_SIZE, on_progress=None, command=None):
+    """
+    streams source_path in the bucket through ffmpeg, to destination_path
+    - on_progress gets called with (bytes read so far, total bytes) after each chunk
+    - command is for swapping out ffmpeg (e.g., in tests)
+    - returns dict of stats
+    """
+    bucket = bucket or services.bucket
+    source = bucket.get_blob(source_path)
+    if source is None:
+        raise exceptions.NotFound(f"No such object: {source_path}")
+
+    source.chunk_size = chunk_size
+    destination = bucket.blob(destination_path)
+    destination.chunk_size = chunk_size
+
+    bytes_in = stream_to_blob(command or ffmpeg_command(), destination, source=source, on_progress=on_progress)
+
+    return {
+        "source_path": source_path,
+        "destination_path": destination_path,
+        "bytes_in": bytes_in,
+    }
+
+
+#########################################
+# Process pool
+################################
+
+def _init_worker():
+    # pool processes are spawned fresh (gRPC clients don't survive fork), so need django set up again
+    import django
+    django.setup()
+
+
+def _get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(
+                max_workers=settings.TRANSCODE_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_worker,
+            )
+
+    return _pool
+
+
+def transcode_job(request_path, source_path, destination_path):
+    """
+    what runs in the pool process. Reports progress on the transcribe request doc at request_path
+    """
+    last_reported = {"percent": -PROGRESS_STEP_PERCENT}
+    ref = services.db.document(request_path)
+
+    def report(bytes_processed, total_bytes):
+        percent = int(bytes_processed * 100 / total_bytes) if total_bytes else 0
+        if percent - last_reported["percent"] < PROGRESS_STEP_PERCENT and bytes_processed != total_bytes:
+            return
+
+        last_reported["percent"] = percent
+        try:
+            ref.update({
+                "processing_progress": {
+                    "bytes_processed": bytes_processed,
+                    "total_bytes": total_bytes,
+                    "percent": percent,
+                },
+                # so it doesn't look like the request stalled
+                "updated_at": timestamp(),
+            })
+        except Exception as error:
+            # not worth failing the transcode over
+            logger.error(f"Couldn't report transcoding progress for {request_path}: {error}")
+
+    return transcode_to_flac(source_path, destination_path, on_progress=report)
+
+
+def run_in_pool(func, args, on_done):
+    """
+    runs func(*args) in the process pool, then calls on_done(future) in a thread back in this process
+    - func and args have to be picklable, so pass paths and such, not TranscribeRequests
+    """
+    future = _get_pool().submit(func, *args)
+    future.add_done_callback(lambda done: _continuations.submit(on_done, done))
+    return future
+
+
+def schedule_transcoding(transcribe_request, on_done):
+    """
+    transcodes transcribe_request's file in the process pool, then calls on_done(future)
+    """
+    source_path = transcribe_request.file_path
+    return run_in_pool(transcode_job, (transcribe_request.transcribe_request_ref().path, source_path, transcoded_path(source_path)), on_done)
@@ -1,4 +1,25 @@
 from .helpers import * 
+from contextlib import contextmanager
+from .unit_of_work import UnitOfWork
+from .storage_cleanup import schedule_cleanup, run_cleanup
+from .audio_probe import probe_blob
+from .transcoding import schedule_transcoding, run_in_pool
+from .splitting import split_job
+from .stitching import combine_operations
+from concurrent.futures import ThreadPoolExecutor
+from .transcript_store import ChunkedTranscript
+from .compact_transcript import CompactTranscript
+from .transcript_cache import transcript_cache, content_hash, config_fingerprint
+from . import serialization, job_queue
+from .admission import admission_control
+from .metrics import timed, record_transition
+from .retries import MultipleChannelsFix
+
+
+def _long_running_recognize(config_dict, audio):
+    with timed("speech", "long_running_recognize"):
+        return services.speech_client.long_running_recognize(config_dict, audio)
+
 
 class TranscribeRequest:
     """
@@ -11,10 +32,40 @@ class TranscribeRequest:
 
     # TODO NOTE no longer file_data, so change var name
     def __init__(self, file_data):
+        # attributes that changed since last loaded from/written to the transcribe request doc, and the transcript doc
+        # (attributes that start with an underscore are not tracked or persisted)
+        self._dirty_fields = set()
+        self._transcript_dirty_fields = set()
+        self._transcript_persisted = False
+        # approximate, for seeing how much we write to firestore for a single request
+        self._write_stats = {"documents": 0, "bytes": 0, "commits": 0}
+        # when set, writes get queued here and committed together (see batched_writes)
+        self._unit_of_work = None
+        self._transcript_store = None
+        # the finished transcript's results, kept compact (see utterances)
+        self._utterances = None
+
         # necessary parts, or else can't retrieve from db
         # TODO if don't receive, throw error so that client knows
         self._set_attributes_from_dictionary(file_data)
 
+    @classmethod
+    def from_firestore(cls, data):
+        """
+        build from data that was just read from the transcribe request doc, so nothing is dirty yet
+        """
+        transcribe_request = cls(data)
+        transcribe_request.mark_clean()
+        return transcribe_request
+
+    def __setattr__(self, name, value):
+        # keep track of what changed, so we only write what changed
+        if not name.startswith("_") and (name not in self.__dict__ or self.__dict__[name] != value):
+            self._dirty_fields.add(name)
+            self._transcript_dirty_fields.add(name)
+
+        super().__setattr__(name, value)
+
     ########################
     # init helpers
     ########################
@@ -39,13 +90,32 @@ class TranscribeRequest:
         self.file_path = file_data.get("file_path")
         self.file_type = file_data.get("file_type")
         # NOTE some filetypes, such as some mp3s, are different from the file extension, e.g., mpeg instead of mp3
-        self.file_extension = self.file_type.replace("audio/", "")
+        self.file_extension = self.file_type.replace("audio/", "").replace("video/", "")
         self.file_size = file_data.get("file_size")
         self.original_file_path = file_data.get("original_file_path") 
         self.transaction_id = file_data.get("transaction_id")
-        self.event_logs = self.get_event_logs()
+        # full event logs are only loaded if something asks for them (see event_logs). Most things only need the summary
+        self._event_logs = None
+        self.event_summary = file_data.get("event_summary") or TranscribeRequest.empty_event_summary()
         self.status = file_data.get("status")
         self.updated_at = file_data.get("updated_at")
+        # set by check_transcription_progress, but want it when reading back from the db too (eg if the background poller is the one checking progress)
+        self.transcript_metadata = file_data.get("transcript_metadata")
+        # encoding, sample rate etc read from the file's header (see probe_audio), so we only probe once per file
+        self.audio_info = file_data.get("audio_info")
+        # set when we converted the upload to flac (see makeItFlac). file_path is then the flac version
+        self.transcoded_from = file_data.get("transcoded_from")
+        # written by the transcoding job while it runs
+        self.processing_progress = file_data.get("processing_progress")
+        # split mode (see splitting.py). None means go by the SPLIT_MODE settings
+        self.split_mode = file_data.get("split_mode")
+        # one per segment when in split mode: {"name" (operation name), "path", "offset_seconds", "duration_seconds"}
+        self.child_operations = file_data.get("child_operations")
+        # manifest for the utterance pages under the transcript doc (see transcript_store.py)
+        self.transcript_pages = file_data.get("transcript_pages")
+        # transcript cache key for this file and config (see transcript_cache.py), and the key we got the transcript from if it was a hit
+        self.content_key = file_data.get("content_key")
+        self.cached_from = file_data.get("cached_from")
 
         # only counting attempts in this current http request, so always set to 0
         self.failed_attempts = 0
@@ -53,17 +123,53 @@ class TranscribeRequest:
         self._set_request_options()
 
     def _set_request_options(self, **kwargs):
-        self.request_options = deepcopy(BASE_REQUEST_OPTIONS)
-        self.request_options[self.file_extension] = True
+        request_options = deepcopy(BASE_REQUEST_OPTIONS)
+        request_options[self.file_extension] = True
+        self.request_options = request_options
 
 
     #######################
     # getters/translators for getters
     ########################
 
+    @property
+    def utterances(self):
+        """
+        the transcript's results. Kept as a CompactTranscript, which can be indexed/sliced/iterated like the list of result dicts
+        - not in __dict__, so isn't sent back in every response (to_dict) or written to the request doc
+        """
+        return self._utterances
+
+    @utterances.setter
+    def utterances(self, results):
+        self._utterances = CompactTranscript.from_results(results)
+
     def attempt_count(self):
         return self.failed_attempts + 1
 
+    def to_dict(self):
+        """
+        public attributes only, ie what gets persisted and sent back to the client
+        """
+        return {k: v for k, v in self.__dict__.items() if not k.startswith("_")}
+
+    def dirty_fields(self):
+        return set(self._dirty_fields)
+
+    def mark_dirty(self, *names):
+        """
+        for changes __setattr__ can't see, e.g., setting a key in request_options
+        """
+        self._dirty_fields.update(names)
+        self._transcript_dirty_fields.update(names)
+
+    def mark_clean(self):
+        self._dirty_fields.clear()
+        self._transcript_dirty_fields.clear()
+
+    def write_stats(self):
+        return dict(self._write_stats)
+
     def transaction_complete(self):
         return self.status == TRANSCRIPTION_STATUSES[5]
 
@@ -77,10 +183,11 @@ class TranscribeRequest:
 
     # not really used by anything, so just make sure it's unique. I don't even think you can sort by it very easily
     def transcript_document_name(self):
-        return f"{self.filename}-at-{self.transaction_id}"
+        # copies from the transcript cache have no operation of their own
+        return f"{self.filename}-at-{self.transaction_id or 'cached-' + self.id}"
 
     def user_ref(self):
-        return db.collection('users').document(self.user_id)
+        return services.db.collection('users').document(self.user_id)
 
     def transcript_document_ref(self):
         doc_name = self.transcript_document_name()
@@ -110,22 +217,33 @@ class TranscribeRequest:
     ##################
 
     def server_has_received(self):
-        if any(log.get("event") == TRANSCRIPTION_STATUSES[2] for log in self.event_logs): 
-            return True
-        else:
-            return False
+        return self.has_event(TRANSCRIPTION_STATUSES[2]) # processing-file
 
-    # TODO might do a getter/setter function to extract the db logic out
-    def get_event_logs(self): 
-        if hasattr(self, "event_logs") == False:
-            self.event_logs = []
-            ref = self.transcribe_request_ref()
-            event_log_ref = ref.collection("event_logs")
-            docs = event_log_ref.stream()
-            for doc in docs:
-                self.event_logs.append(doc.to_dict())
+    def has_event(self, event):
+        """
+        uses the summary on the transcribe request doc, so doesn't need to read the event logs
+        (only records from before we kept the summary have to read them)
+        """
+        if self.event_summary.get("last_event_at"):
+            return event in self.event_summary.get("events", [])
+
+        return any(log.get("event") == event for log in self.event_logs)
 
+    @property
+    def event_logs(self):
+        """
+        full event logs, read from the eventLogs collection the first time they're needed, and then kept for the life of this instance (or until refresh_from_db)
+        """
+        if self._event_logs is None:
+            # stream() is lazy, so the round trips happen while reading it
+            with timed("firestore", "stream"):
+                logs = [doc.to_dict() for doc in self.transcribe_request_ref().collection("eventLogs").stream()]
+            self._event_logs = sorted(logs, key=lambda log: log.get("time") or "")
 
+        return self._event_logs
+
+    # TODO might do a getter/setter function to extract the db logic out
+    def get_event_logs(self): 
         return self.event_logs
 
     def last_request_has_stopped(self):
@@ -180,10 +298,35 @@ class TranscribeRequest:
         https://google-cloud-python.readthedocs.io/en/0.32.0/_modules/google/api_core/operation.html
         https://googleapis.dev/python/google-api-core/latest/operation.html
         """
-        operation_dict = get_operation(self.transaction_id)
+        operation_dict = self.get_operation_dict()
+        self.apply_operation(operation_dict)
+
+    def get_operation_dict(self):
+        """
+        the operation from Google. In split mode, that's all the child operations combined into one (see stitching.combine_operations)
+        """
+        if not self.child_operations:
+            return get_operation(self.transaction_id)
+
+        with ThreadPoolExecutor(max_workers=len(self.child_operations)) as executor:
+            operation_dicts = list(executor.map(lambda child: get_operation(child["name"]), self.child_operations))
+
+        return combine_operations(self.child_operations, operation_dicts)
+
+    def apply_operation(self, operation_dict):
+        """
+        - takes operation_dict (as returned by get_operation) and updates this request accordingly
+        - separate from check_transcription_progress so the background poller can get operations in batches and then apply them
+        - everything this writes (other than claiming the transcript) is committed in one batch
+        """
+        with self.batched_writes():
+            self._apply_operation(operation_dict)
+
+    def _apply_operation(self, operation_dict):
         metadata = operation_dict["metadata"]
         logger.info("metadata from check progress call")
         logger.info(metadata)
+        previous_metadata = self.transcript_metadata
         # 100 (int) if done
         self.transcript_metadata = {}
         # it seems that sometimes it doesn't return the progressPercent...maybe when it's still initializing or something? Seems strange, but I've only seen 100% return so far haha
@@ -204,14 +347,28 @@ class TranscribeRequest:
 
         # unfortunately, if not done, doesn't set this...so don't access directly
         elif operation_dict.get("done"):
+            # both the background poller and check_status can get here for the same operation, so make sure only one of them processes the results
+            if not self.claim_for_processing():
+                logger.info("transcript for this operation is already being processed, not processing again")
+                return
+
             results = operation_dict["response"]["results"]
-            self.mark_as_transcribed()
             self.handle_transcript_results(results)
 
+        elif len(operation_dict.get("partial_results") or []) > (self.transcript_pages or {}).get("utterance_count", 0):
+            # split mode, and the first segment(s) are done, so save what we have so far (see stitching.combine_operations)
+            self.append_utterances(operation_dict["partial_results"])
 
-        # persist progress whether or not we're done
-        self.persist()
+        elif self.transcript_metadata == previous_metadata:
+            # nothing has changed since last time anyone checked, so nothing to write
+            logger.info("no progress since last check, not persisting")
+            return
+
+        # persist progress whether or not we're done. Transcript first, since that updates transcript_pages, which the request doc needs too
         self.persist_transcript_data()
+        self.persist()
+        if operation_dict.get("done"):
+            self.remember_transcript()
         return
         
 
@@ -244,30 +401,41 @@ class TranscribeRequest:
                 }
 
             
+            # copy, so we don't change the config for every request after this one
             if (self.file_extension == "flac"):
-                config_dict = TranscribeRequest._flac_config
+                config_dict = dict(TranscribeRequest._flac_config)
             
             elif (self.file_extension == "wav"):
-                config_dict = TranscribeRequest._wav_config
+                config_dict = dict(TranscribeRequest._wav_config)
             
             elif (self.file_extension in ["mp3", "mpeg"]):
                 # strangely enough, if send base64 of mp3 file, but use flac_config, returns results like the flac file, but smaller file size. In part, possibly due ot the fact that there is multiple speakers set for flacConfig currently
-                config_dict = TranscribeRequest._mp3_config
+                config_dict = dict(TranscribeRequest._mp3_config)
             
             else:
                 # This is for other audio files...but not sure if we should support anything else
-                config_dict = TranscribeRequest._base_config
+                config_dict = dict(TranscribeRequest._base_config)
+
+            if (self.file_path and not self.audio_info):
+                self.probe_audio()
+
+            channels = 2 # might try more later, but I think there's normally just two
+            if (self.audio_info):
+                # Google needs sample rate to match the file for mp3s, and channel count to match for wav and flac
+                config_dict["sample_rate_hertz"] = self.audio_info["sample_rate_hertz"]
+                channels = self.audio_info["channels"]
+                if (channels > 1):
+                    self.request_options["multiple_channels"] = True
+                    self.mark_dirty("request_options")
 
-            
-            # TODO dynamically test audio for channels
             if (self.request_options.get("multiple_channels")):
                 logger.info("Sending with multiple channels")
-                config_dict["audio_channel_count"] = 2 # might try more later, but I think there's normally just two
+                config_dict["audio_channel_count"] = channels
                 config_dict["enable_separate_recognition_per_channel"] = True
             
             logger.info("sending file: " + self.filename)
             # TODO consider sending their config object...though maybe has same results. But either way, check out the options in beta https://googleapis.dev/python/speech/latest/gapic/v1p1beta1/types.html#google.cloud.speech_v1p1beta1.types.RecognitionConfig
-            logger.info("sending with config" + json.dumps(config_dict))
+            logger.info("sending with config %s", serialization.lazy(config_dict))
             
             request_params = {
                 "audio": audio,
@@ -283,79 +451,211 @@ class TranscribeRequest:
             raise error
 
 
+    def probe_audio(self):
+        """
+        reads the header from the start of the file in storage, so we know the sample rate and channels before sending to Google
+        - sets audio_info, or leaves it as None if can't tell (then we fall back to the defaults, and the channels retry in request_long_running_recognize)
+        """
+        try:
+            with timed("storage", "read_header"):
+                info = probe_blob(services.bucket.blob(self.file_path))
+        except Exception as error:
+            logger.error(f"Couldn't probe audio for {self.file_path}: {error}")
+            info = None
+
+        if info is None:
+            logger.info(f"Couldn't tell audio format for {self.file_path} from its header")
+            return None
+
+        logger.info(f"Audio header: {info}")
+        if (info.encoding is None):
+            # e.g., float or a-law WAVs. Google will reject it, but might as well let them tell the user
+            logger.info(f"File has an encoding Google doesn't support: {self.file_path}")
+
+        self.audio_info = info._asdict()
+        return info
+
+    def request_transcription(self):
+        """
+        asks Google to transcribe, converting to flac first if it needs it (in which case Google gets asked once that's done, in the background)
+        """
+        if (self.needs_transcoding()):
+            self.makeItFlac()
+            return
+
+        self.setup_request()
+        if (self.use_cached_transcript()):
+            return
+
+        if (self.use_split_mode()):
+            self.split_and_transcribe()
+            return
+
+        self.request_long_running_recognize()
+
+    def use_cached_transcript(self):
+        """
+        if this same audio was transcribed with the same config before, copies that transcript instead of asking Google again (see transcript_cache.py)
+        - returns True if it did
+        - assumes setup_request was called already (for the config)
+        """
+        if (not settings.TRANSCRIPT_CACHE or not self.file_path):
+            return False
+
+        try:
+            with timed("storage", "get_blob"):
+                blob = services.bucket.get_blob(self.file_path)
+            file_hash = content_hash(blob, download=settings.TRANSCRIPT_CACHE_HASH_DOWNLOAD) if blob else None
+            if file_hash is None:
+                return False
+
+            key = transcript_cache.key_for(file_hash, config_fingerprint(self.request_params["config"]), self.user_id)
+            entry = transcript_cache.lookup(key)
+        except Exception as error:
+            logger.error(f"Couldn't check the transcript cache for {self.file_path}: {error}")
+            return False
+
+        self.content_key = key
+        if entry is None:
+            # so whoever finishes this request (maybe the poller) can add it to the cache
+            self.persist()
+            return False
+
+        pages = entry["transcript_pages"]
+        utterances = ChunkedTranscript(services.db.document(entry["transcript_path"]), pages).utterances()
+        if len(utterances) != pages["utterance_count"]:
+            # the transcript it points to was deleted
+            transcript_cache.evict(key, reason="broken")
+            self.persist()
+            return False
+
+        logger.info(f"same audio was transcribed before, using transcript from {entry['transcript_path']}")
+        transcript_cache.record_hit(key)
+        # not the original's transaction_id, that operation belongs to another request. cached_from is the link back
+        self.cached_from = key
+        with self.batched_writes():
+            self.handle_transcript_results(utterances)
+            self.persist_transcript_data()
+            self.persist()
+
+        return True
+
+    def remember_transcript(self):
+        """
+        adds the finished transcript to the transcript cache, so the same audio doesn't need to be transcribed again
+        """
+        if (not settings.TRANSCRIPT_CACHE or not self.content_key or self.cached_from or not self.transcript_pages):
+            return
+
+        with self.batched_writes() as unit_of_work:
+            transcript_cache.store(self.content_key, {
+                "transcript_path": self.transcript_document_ref().path,
+                "transcript_pages": self.transcript_pages,
+                "transaction_id": self.transaction_id,
+                "user_id": self.user_id,
+                "filename": self.filename,
+            }, unit_of_work)
+
+    def use_split_mode(self):
+        if (not self.file_path or self.child_operations):
+            return False
+
+        if (self.split_mode is not None):
+            return bool(self.split_mode)
+
+        return settings.SPLIT_MODE and bool(self.file_size) and self.size_in_MB() >= settings.SPLIT_MODE_MIN_MB
+
+    def split_and_transcribe(self):
+        """
+        cuts the file into segments in the process pool, then (in _finish_splitting) asks Google to transcribe all of them at once
+        """
+        logger.info(f"splitting {self.file_path} into segments")
+        return run_in_pool(split_job, (self.file_path, settings.SPLIT_SEGMENT_SECONDS, settings.SPLIT_MAX_SEGMENTS), self._finish_splitting)
+
+    def _finish_splitting(self, future):
+        # runs in another thread, so work on a fresh copy (see _finish_transcoding)
+        transcribe_request = TranscribeRequest(self.to_dict())
+        try:
+            segments = future.result()
+            transcribe_request.refresh_from_db()
+        except Exception as error:
+            logger.error(f"Error splitting {self.file_path}, transcribing it in one piece instead: {error}")
+            segments = []
+
+        try:
+            transcribe_request.setup_request()
+            if segments:
+                transcribe_request.request_segments(segments)
+            else:
+                # too short to bother, or splitting failed
+                transcribe_request.split_mode = False
+                transcribe_request.request_long_running_recognize()
+        except Exception as error:
+            logger.error(f"Error requesting transcription after splitting: {error}")
+            if "error" not in transcribe_request.status:
+                transcribe_request.mark_as_server_error(error)
+
+        return transcribe_request
+
+    def request_segments(self, segments):
+        """
+        asks Google to transcribe every segment at once. Assumes setup_request was called already (for the config)
+        """
+        # segments are mono 16 kHz flac whatever the original was, and flac has it in the header
+        config_dict = {
+            **self.request_params["config"],
+            "encoding": AudioEncoding.FLAC,
+            "sample_rate_hertz": None,
+        }
+        config_dict.pop("audio_channel_count", None)
+        config_dict.pop("enable_separate_recognition_per_channel", None)
+
+        def request(segment):
+            audio = {"uri": f"gs://khmer-speech-to-text.appspot.com/{segment['path']}"}
+            return speech_retry.call(lambda: _long_running_recognize(config_dict, audio))
+
+        with ThreadPoolExecutor(max_workers=len(segments)) as executor:
+            operation_futures = list(executor.map(request, segments))
+
+        child_operations = [{**segment, "name": operation_future.operation.name} for segment, operation_future in zip(segments, operation_futures)]
+        self.mark_as_transcribing_segments(child_operations)
+
     # for when status "processing-file" (aka received_by_server)
     # TODO if "server-error", have server check things and make sure it's a kind of error that we want to retry, or if not, make the necessary changes before trying again.
     def request_long_running_recognize(self):
+        """
+        asks Google to transcribe, retrying per speech_retry (see retries.py). Marks as transcribing-error if it still doesn't work
+        """
         logger.info("----------------------------------------------------------------")
-        try:
-            logger.info(f"Attempt # {self.attempt_count()}")
 
-            logger.info("options here is: " +  json.dumps(self.request_options))
+        def request():
+            logger.info(f"Attempt # {self.attempt_count()}")
+            logger.info("options here is: %s", serialization.lazy(self.request_options))
             # this is initial response, not complete transcript yet
             # TODO handle if there's no file there, ie it got deleted but they request again or something
-            operation_future = speech_client.long_running_recognize(self.request_params['config'], self.request_params['audio'], retry=reset_retry)
-            # NOTE for some reason operation_future.metadata returns None
-            self.mark_as_transcribing(operation_future)
+            return _long_running_recognize(self.request_params['config'], self.request_params['audio'])
+
+        def use_multiple_channels():
+            self.request_options["multiple_channels"] = True
+            self.mark_dirty("request_options")
+            self.setup_request()
+
+        def count_attempt(error, delay):
+            self.failed_attempts += 1
+
+        try:
+            operation_future = speech_retry.call(request, strategies=[MultipleChannelsFix(use_multiple_channels)], on_retry=count_attempt)
 
         except Exception as error:
             logger.error(traceback.format_exc())
-
-            # TODO or maybe try passing in details to the REtry arg?
             logger.error('Error while doing a long-running request:')
             logger.error(error)
-            # TODO add back in maybe, but for now keep things simple
-            if (self.failed_attempts < 2):
-                # need at least two, one for if internal error, and then if another is for channels 
-                self.failed_attempts += 1
-
-                # https://cloud.google.com/speech-to-text/docs/error-messages
-                if (str(error) in [
-                    # got with fileout.wav. code 3 
-                    "Must use single channel (mono) audio, but WAV header indicates 2 channels.",  
-                    # or is it this one?
-                    "400 Must use single channel (mono) audio, but WAV header indicates 2 channels.",
-                    # got with fileout.flac 
-                    "400 Invalid audio channel count",
-                ]):
-
-                    # try again with different channel configuration
-                    logger.info("trying again, but with multiple channel configuration.")
-                    self.request_options["multiple_channels"] = True
-                    self.setup_request()
-                    self.request_long_running_recognize()
-
-                elif ("Connection reset by peer" in str(error)):
-                    # NOTE should not get these anymore due to new retry strategy
-                    # NOTE I hate this error... just retry it
-                    # I think teh full str is: ('Connection aborted.', ConnectionResetError(104, 'Connection reset by peer'))
-                    # at least sometimes
-                    self.request_long_running_recognize()
-
-                elif ("13" in str(error)):
-                    # this is internal error Error while doing a long-running request: Error: 13 INTERNAL
-                    # not tested TODO
-
-                    logger.info("internal Google error, so just trying same thing again")
-                    self.request_long_running_recognize()
-
-                elif ("WAV header indicates an unsupported format." == str(error)):
-                    # TODO panic
-                    # not tested TODO
-                    # TODO don't let them retry too many times, it'll hit some quota or something probably
-                    # don't bother retrying...
-                    self.mark_as_transcribing_error(error)
-
-                elif "400 Invalid recognition 'config': bad sample rate hertz." == str(error):
-                    # TODO try again with different hertz? 
-                    pass
-
-                else:
-                    logger.error("well then what was our error??")
-                    logger.error(str(error))
-                    self.mark_as_transcribing_error(error)
-            else:
-                # note that it might be our fault for sending them something, but we are not the ones directly throwing the error, so it is a transcribing error
-                self.mark_as_transcribing_error(error)
+            # note that it might be our fault for sending them something, but we are not the ones directly throwing the error, so it is a transcribing error
+            self.mark_as_transcribing_error(error)
+
+        else:
+            # NOTE for some reason operation_future.metadata returns None
+            self.mark_as_transcribing(operation_future)
 
 
     # TODO remane "process transcript results"
@@ -418,51 +718,96 @@ class TranscribeRequest:
 
         logger.info("setting data to transcripts")
 
-        # cleanup storage and db records
-        # TODO add error handling if fail to delete, so that it is marked as not deleted. Perhaps a separate try/catch so we know this is what fails, and not something after.
-        # Or alternatively, something that tracks each ste_p and marks the last completed ste_p so we know where something stopped and can pick it up later/try again later
-        # TODO put in separate method
-        for path in [self.file_path, self.original_file_path]:
-            if (path):
-                # delete file from cloud storage (bucket assigned in the admin initializeApp call)
-
-                try:
-                    blob = bucket.blob(path)
-                    if reset_retry(blob.exists)():
-                        logger.info("deleting file from " + path)
-                        reset_retry(blob.delete)()
-                        logger.info("deleted file from " + path)
-
-                except Exception as error:
-                    # typically something like: "ConnectionResetError: [Errno 104] Connection reset by peer"
-                    # tracked here: https://github.com/googleapis/google-cloud-python/issues/5879#issuecomment-535135348
-                    # official temp solution is here: https://github.com/googleapis/google-cloud-python/issues/5879#issuecomment-535135348
-                    logger.error("error deleting file " + path)
-                    logger.error(error)
-                    if "Connection reset by peer" in str(error):
-                        # if the above decorator doesn't work, retry here
-                        pass
+        # cleanup storage (off the request path, unless configured otherwise)
+        self.cleanup_storage()
 
         # mark upload as finished transcribing
         self.mark_as_processed()
         return
 
 
+    def cleanup_storage(self):
+        """
+        delete the uploaded file(s) from cloud storage, since we have the transcript now
+        - runs in the background by default. If it still fails after retrying, it's recorded for the sweeper to pick up
+        """
+        paths = storage_paths(self.to_dict())
+        if not paths:
+            return
+
+        source = self.transcribe_request_ref().path
+        if settings.STORAGE_CLEANUP_IN_BACKGROUND:
+            return schedule_cleanup(paths, source=source)
+
+        run_cleanup(paths, source=source)
+
     ##############################
     # File manipulation methods
     ##########################
-    def makeItFlac(self, data, options = {}):
+    def needs_transcoding(self):
+        if (not self.file_path or self.transcoded_from):
+            return False
+
+        if (self.file_extension in ["mp3", "mpeg"]):
+            return settings.TRANSCODE_MP3
+
+        return self.file_extension in TRANSCODE_FILE_TYPES
+
+    def makeItFlac(self):
         """
-        converts file (eg mp3, wav, mp4) to flac file
-        based on ht_tps://github.com/firebase/functions-samples/blob/master/ffmpeg-convert-audio/functions/index.js
-        TODO might be bet_ter in the future, for more flexibility and ease of use, to just use ffmpeg-static and bash code rather than a wrapper, so can write exactly as it would be in the command line
+        converts file (eg mp3, wav, mp4) to mono 16 kHz flac file, with ffmpeg
+        - happens in the transcoding process pool (see transcoding.py), so this returns right away. Once it's done, _finish_transcoding sends the flac to Google (or queues a job to, if JOB_QUEUE is on)
+        - returns the future, mostly for tests
         """
-        pass
+        logger.info(f"converting {self.file_path} to flac")
+        return schedule_transcoding(self, self._finish_transcoding)
+
+    def _finish_transcoding(self, future):
+        # runs in another thread, maybe while the request that started it is still using this instance, so work on a fresh copy
+        transcribe_request = TranscribeRequest(self.to_dict())
+        try:
+            result = future.result()
+            transcribe_request.refresh_from_db()
+        except Exception as error:
+            logger.error(f"Error converting {self.file_path} to flac")
+            transcribe_request.mark_as_server_error(error)
+            return
+
+        logger.info(f"converted to flac: {result}")
+        with transcribe_request.batched_writes() as unit_of_work:
+            transcribe_request.transcoded_from = transcribe_request.file_path
+            transcribe_request.file_path = result["destination_path"]
+            transcribe_request.file_type = "audio/flac"
+            transcribe_request.file_extension = "flac"
+            # the flac won't have the same sample rate etc as what was uploaded
+            transcribe_request.audio_info = None
+            transcribe_request._set_request_options()
+
+            upload_ref = services.db.collection(UPLOAD_REFS_COLLECTION).document(storage_doc_id(transcribe_request.file_path))
+            unit_of_work.set(upload_ref, {
+                "path": transcribe_request.file_path,
+                "transcribe_request": transcribe_request.transcribe_request_ref().path,
+            })
+            transcribe_request.persist()
+
+        if settings.JOB_QUEUE:
+            # a worker asks Google, so it gets retried like any other job. Keyed on the flac too, since the job that started the transcoding might still be running
+            job_queue.enqueue_transcription(transcribe_request, key=f"{transcribe_request.transcribe_request_ref().path}:{transcribe_request.file_path}")
+            return transcribe_request
+
+        try:
+            # might split it next, if it's long
+            transcribe_request.request_transcription()
+        except Exception as error:
+            # setup_request has already marked it as errored
+            logger.error(f"Error requesting transcription after converting to flac: {error}")
+
+        return transcribe_request
 
 
     # maybe use later
     def download_file(self, source_filename): 
-        blob = bucket.blob(source_filename)
+        blob = services.bucket.blob(source_filename)
         # blob.download_to_filename(destination_filename)
 
         logger.info(
@@ -479,29 +824,64 @@ class TranscribeRequest:
     def refresh_from_db(self):
         """ 
         ultimately db should be source of truth, so occassionally need to pull directly from there
+        - if SNAPSHOT_HUB is on, comes from the copy a shared listener keeps up to date when it can (see snapshot_hub.py)
         """
         ref = self.transcribe_request_ref()
-        transcribe_request_doc = ref.get()
+        file_data = self._read_request_doc(ref)
 
-        if transcribe_request_doc.exists:
+        if file_data is not None:
             # TODO remove this later, just for now as we're actively developing this method
             logger.info("Transcribe Request record found: ")
-            file_data = transcribe_request_doc.to_dict()
             logger.info(file_data)
 
             # set to this class instance
             self._set_attributes_from_dictionary(file_data)
+            # whatever changed before refreshing is overwritten by what's in the db now
+            self.mark_clean()
 
         else:
             logger.info("Uh oh...no transcribe Request record found...")
             # TODO handle, this means we need to request transcript again
 
 
+    def _read_request_doc(self, ref):
+        """
+        the transcribe request doc's data, or None if it doesn't exist
+        """
+        if not settings.SNAPSHOT_HUB:
+            with timed("firestore", "get"):
+                transcribe_request_doc = ref.get()
+            return transcribe_request_doc.to_dict() if transcribe_request_doc.exists else None
+
+        # keeps the listener going for SNAPSHOT_HUB_IDLE_SECONDS after, so the next check on this request can use it
+        with snapshot_hub.watching(ref.path):
+            file_data = snapshot_hub.get(ref.path)
+            if file_data is None:
+                with timed("firestore", "get"):
+                    transcribe_request_doc = ref.get()
+                if not transcribe_request_doc.exists:
+                    return None
+
+                file_data = transcribe_request_doc.to_dict()
+                snapshot_hub.put(ref.path, file_data, transcribe_request_doc.update_time)
+
+        return file_data
+
     def persist(self):
-        data = self.__dict__
-        cleaned_data = TranscribeRequest.cleanup_dictionary(data)
-        transcribe_request_ref = self.transcribe_request_ref()
-        transcribe_request_ref.set(cleaned_data, merge=True)
+        """
+        only writes the fields that changed since we last loaded or persisted, and doesn't write at all if nothing did
+        """
+        data = self.to_dict()
+        fields = self._dirty_fields - TranscribeRequest._status_managed_fields - TranscribeRequest._paged_fields
+        cleaned_data = TranscribeRequest.cleanup_dictionary({k: data[k] for k in fields if k in data})
+        if cleaned_data:
+            transcribe_request_ref = self.transcribe_request_ref()
+            with self.batched_writes() as unit_of_work:
+                unit_of_work.set(transcribe_request_ref, cleaned_data, merge=True)
+            snapshot_hub.invalidate(transcribe_request_ref.path)
+            self._record_write(cleaned_data)
+
+        self._dirty_fields.clear()
 
 
     def persist_transcript_data(self):
@@ -513,20 +893,105 @@ class TranscribeRequest:
         - only for completed transcripts (incomplete should be at transcribeRequests ref)
         - doc_name is unique identifier for this transcription, different for each version of the transcript even for the same file
 
+        - first write sets the whole thing, after that only writes fields that changed
+        - doesn't write anything until the transcript is complete (ie has utterances)
+
         TODO only set attributes needed for the transcript, don't want everything on this thing!
         """
-        data = self.__dict__
-        cleaned_data = TranscribeRequest.cleanup_dictionary(data)
-        doc_ref = self.transcript_document_ref()
-        doc_ref.set(cleaned_data)
+        if self.utterances is None and not self.transcript_pages:
+            logger.info("transcript not complete yet, not persisting transcript data")
+            return
+
+        with self.batched_writes() as unit_of_work:
+            if self.utterances is not None:
+                # utterances go in pages (see transcript_store.py), the doc just gets the manifest
+                self.append_utterances(self.utterances, complete=True)
+
+            data = self.to_dict()
+            for field in TranscribeRequest._paged_fields:
+                data.pop(field, None)
+
+            doc_ref = self.transcript_document_ref()
+            if not self._transcript_persisted:
+                cleaned_data = TranscribeRequest.cleanup_dictionary(data)
+                unit_of_work.set(doc_ref, cleaned_data)
+                self._transcript_persisted = True
+            else:
+                cleaned_data = TranscribeRequest.cleanup_dictionary({k: data[k] for k in self._transcript_dirty_fields if k in data})
+                if cleaned_data:
+                    unit_of_work.set(doc_ref, cleaned_data, merge=True)
+
+        if cleaned_data:
+            self._record_write(cleaned_data)
+
+        self._transcript_dirty_fields.clear()
+
+    def append_utterances(self, utterances, complete=False):
+        """
+        writes whatever utterances haven't been written to the transcript's pages yet, and updates the manifest (transcript_pages)
+        - utterances is all of them so far, in order. Only the ones past what the manifest already has get written, so fine to call again with more
+        """
+        store = self._transcript_store or ChunkedTranscript(self.transcript_document_ref(), self.transcript_pages)
+        new_utterances = utterances[store.utterance_count:]
+        with self.batched_writes() as unit_of_work:
+            if new_utterances:
+                store.append(new_utterances, unit_of_work)
+                self._write_stats["documents"] += 1
+                self._write_stats["bytes"] += TranscribeRequest.approximate_size(new_utterances)
+
+        if complete:
+            store.mark_complete()
+
+        self._transcript_store = store
+        # a copy, so it counts as changed
+        self.transcript_pages = deepcopy(store.manifest)
+
+    def _record_write(self, data):
+        self._write_stats["documents"] += 1
+        self._write_stats["bytes"] += TranscribeRequest.approximate_size(data)
+
+    @contextmanager
+    def batched_writes(self):
+        """
+        - all firestore writes made inside this block get committed together in one batch when the block exits (even if it exits with an error, since the writes describe what actually happened)
+        - if already inside a batched_writes block, just uses that one
+        - use flush_writes() for flush points in the middle, e.g., so the client sees a status before we start something slow
+        """
+        if self._unit_of_work is not None:
+            yield self._unit_of_work
+            return
+
+        self._unit_of_work = UnitOfWork(services.db)
+        try:
+            yield self._unit_of_work
+        finally:
+            try:
+                self.flush_writes()
+            finally:
+                self._unit_of_work = None
+
+    def flush_writes(self):
+        if self._unit_of_work is not None and len(self._unit_of_work):
+            self._unit_of_work.flush()
+            self._write_stats["commits"] += 1
 
     #############################
     # status marking methods (for persisting in firestore)
     # TODO DRY this up. Can just persist the whole instance to firestore.
     #############################
     def mark_as_received(self):
-        self._update_status(TRANSCRIPTION_STATUSES[2], other={ # processing-file
-        }) 
+        with self.batched_writes() as unit_of_work:
+            self._update_status(TRANSCRIPTION_STATUSES[2], other={ # processing-file
+            }) 
+
+            # record which files this request uses, so the sweeper knows they're not orphaned
+            for path in [self.file_path, self.original_file_path]:
+                if path:
+                    upload_ref = services.db.collection(UPLOAD_REFS_COLLECTION).document(storage_doc_id(path))
+                    unit_of_work.set(upload_ref, {
+                        "path": path,
+                        "transcribe_request": self.transcribe_request_ref().path,
+                    })
 
     def mark_as_transcribing(self, operation_future):
         """
@@ -542,10 +1007,49 @@ class TranscribeRequest:
             "transaction_id": operation_name,
         }) 
 
+    def mark_as_transcribing_segments(self, child_operations):
+        """
+        split mode version of mark_as_transcribing. transaction_id is the first segment's operation, so everything that only looks for a transaction_id still works
+        """
+        logger.info(f"operation names are: {[child['name'] for child in child_operations]}")
+
+        with self.batched_writes() as unit_of_work:
+            self._update_status(TRANSCRIPTION_STATUSES[3], other={ # transcribing
+                "transaction_id": child_operations[0]["name"],
+                "child_operations": child_operations,
+            })
+
+            # so the sweeper knows the segments aren't orphaned
+            for child in child_operations:
+                upload_ref = services.db.collection(UPLOAD_REFS_COLLECTION).document(storage_doc_id(child["path"]))
+                unit_of_work.set(upload_ref, {
+                    "path": child["path"],
+                    "transcribe_request": self.transcribe_request_ref().path,
+                })
+
     def mark_as_transcribed(self):
 
         self._update_status(TRANSCRIPTION_STATUSES[4]) # processing-transcription
 
+    def claim_for_processing(self):
+        """
+        - marks as transcribed, but only if the record in firestore is still transcribing
+        - uses the last update_time as a precondition, so if two processes try at the same time, only one gets it
+        - returns True if we got it, so should process the transcript results
+        """
+        ref = self.transcribe_request_ref()
+        with timed("firestore", "get"):
+            snapshot = ref.get()
+        if not snapshot.exists or snapshot.get("status") != TRANSCRIPTION_STATUSES[3]: # transcribing
+            return False
+
+        try:
+            self._update_status(TRANSCRIPTION_STATUSES[4], option=services.db.write_option(last_update_time=snapshot.update_time)) # processing-transcription
+        except exceptions.FailedPrecondition:
+            return False
+
+        return True
+
     def mark_as_processed(self):
         # logger.info("deleting record of untranscribed upload: " + f"users/{self.user['uid']}/transcribeRequests/{identifier}")
 
@@ -572,46 +1076,98 @@ class TranscribeRequest:
     def _update_status(self, status, **kwargs):
         other = kwargs.get("other", {})
         other_in_event = kwargs.get("other_in_event", {})
+        option = kwargs.get("option")
         """
         set the status without overwriting anything else
         better to not merge but just update the whole thing to db
         if do so, set properties we don't want to persist as not properties but retrievable by method, like request options
+        option is a firestore write option (e.g., last_update_time precondition). If set, doc has to exist already
+        status and event log are always committed together, in the same batch
         """
 
         # update self in the current TranscribeRequest
+        now = timestamp()
+        record_transition(self.status, status, since=self.updated_at)
         event_log = {
             **other_in_event, 
             "event": status,
-            "time": timestamp()
+            "time": now,
         }
 
         self.status = status
+        for key, value in other.items():
+            setattr(self, key, value)
         if other_in_event.get("error"):
             error = other_in_event.get("error")
             # set error on obj for easy access
             self.error = str(error)
         else:
             self.error = ""
-        self.event_logs.append(event_log)
+        # don't want to load the event logs just to add to them, so only add if already loaded
+        if self._event_logs is not None:
+            self._event_logs.append(event_log)
+        self._add_to_event_summary(event_log)
 
         transcribe_request_ref = self.transcribe_request_ref()
 
+        self.updated_at = now
         updates = {
             **other,
             "status": status,
-            "updated_at": timestamp(),
+            "updated_at": self.updated_at,
             "error": self.error, # either sets as error or blank string
         }
+        # update the summary using transforms, so it's correct even if this instance's copy of it is out of date
+        # (imported here, since google.cloud.firestore is slow to import and nothing else needs it until a write)
+        from google.cloud.firestore import ArrayUnion, Increment
+        summary_updates = {
+            "events": ArrayUnion([status]),
+            "last_event_at": now,
+            "error_count": Increment(1 if self.error else 0),
+        }
 
 
-        # update status (and whatever is in other) to firestore 
-        transcribe_request_ref.set(updates, merge=True)
+        event_log_ref = transcribe_request_ref.collection("eventLogs")
+        if option:
+            # precondition has to be checked right now, so commit separately from anything else that is queued (so if it fails, only this fails)
+            unit_of_work = UnitOfWork(services.db)
+        else:
+            unit_of_work = self._unit_of_work if self._unit_of_work is not None else UnitOfWork(services.db)
+
+        # update status (and whatever is in other) to firestore, and log the new event
+        if option:
+            # update() takes field paths, set(merge=True) takes nested maps
+            summary_paths = {f"event_summary.{k}": v for k, v in summary_updates.items()}
+            unit_of_work.update(transcribe_request_ref, {**updates, **summary_paths}, option=option)
+        else:
+            unit_of_work.set(transcribe_request_ref, {**updates, "event_summary": summary_updates}, merge=True)
+        unit_of_work.add(event_log_ref, event_log)
+
+        if unit_of_work is not self._unit_of_work:
+            unit_of_work.flush()
+            self._write_stats["commits"] += 1
+        snapshot_hub.invalidate(transcribe_request_ref.path)
+
+        if settings.ADMISSION_CONTROL and status in [TRANSCRIPTION_STATUSES[5], TRANSCRIPTION_STATUSES[6], TRANSCRIPTION_STATUSES[7]]: # transcription-processed, server-error, transcribing-error
+            # its operation isn't running anymore, so someone else can start one
+            admission_control.release(transcribe_request_ref.path)
+
         logger.info("updated status")
         logger.info(updates)
+        # these are in firestore now (or will be when the batch is flushed), so no need to write them again on persist
+        self._dirty_fields.difference_update(updates)
 
-        # log the new event
-        event_log_ref = transcribe_request_ref.collection("eventLogs")
-        event_log_ref.add(event_log) 
+        self._record_write(updates)
+        self._record_write(event_log)
+
+    def _add_to_event_summary(self, event_log):
+        summary = self.event_summary
+        events = summary.setdefault("events", [])
+        if event_log["event"] not in events:
+            events.append(event_log["event"])
+        summary["last_event_at"] = event_log["time"]
+        if event_log.get("error"):
+            summary["error_count"] = summary.get("error_count", 0) + 1
 
 
     ################################    
@@ -623,13 +1179,13 @@ class TranscribeRequest:
     # sample rate hertz:  
     # - None lets google set it themselves. 
     # - For some mp3s, this returns no utterances or worse results though
-    # - Regarding MP3s, Google's docs say: "When using this encoding, sampleRateHertz has to match the sample rate of the file being used." TODO need to find a way to dynamically test the file to see its sample rate hertz
+    # - Regarding MP3s, Google's docs say: "When using this encoding, sampleRateHertz has to match the sample rate of the file being used." setup_request sets it from the file header (see probe_audio)
 
     # model:  
     # - Google: "Best for audio that is not one of the specific audio models. For example, long-form audio. Ideally the audio is high-fidelity, recorded at a 16khz or greater sampling rate."
 
     _base_config = {
-        "encoding": enums.RecognitionConfig.AudioEncoding.LINEAR16,
+        "encoding": AudioEncoding.LINEAR16,
         "language_code": 'km-KH',
         "sample_rate_hertz": None, 
         "enable_automatic_punctuation": True,
@@ -642,16 +1198,22 @@ class TranscribeRequest:
     _flac_config = {
         **_base_config, 
         # or maybe FLAC ?
-        "encoding": enums.RecognitionConfig.AudioEncoding.FLAC,
+        "encoding": AudioEncoding.FLAC,
         "sample_rate_hertz": None, 
     }
 
     _mp3_config = {
          **_base_config, 
-         "encoding": enums.RecognitionConfig.AudioEncoding.MP3,
+         "encoding": AudioEncoding.MP3,
          "sample_rate_hertz": 16000,  
     }
 
+    # written somewhere else (by _update_status using transforms, or by the transcoding job), so persist shouldn't overwrite them with whatever this instance has
+    _status_managed_fields = {"event_summary", "processing_progress"}
+
+    # too big to put on the docs themselves, so go in the transcript's utterance pages instead (see append_utterances)
+    _paged_fields = {"utterances"}
+
     _wav_config = {
          **_base_config, 
          "encoding": None, 
@@ -674,3 +1236,21 @@ class TranscribeRequest:
                 cleaned_data[k] = v
 
         return cleaned_data
+
+    @staticmethod
+    def empty_event_summary():
+        """
+        kept on the transcribe request doc, so we don't have to read the eventLogs collection just to know what happened
+        """
+        return {
+            "events": [],
+            "last_event_at": None,
+            "error_count": 0,
+        }
+
+    @staticmethod
+    def approximate_size(data):
+        """
+        rough size in bytes of what we send to firestore (firestore counts a little differently, but close enough for comparing)
+        """
+        return len(serialization.dumps(data, default=str))
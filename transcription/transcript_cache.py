@@ -0,0 +1,205 @@
+"""
+Transcripts keyed by what was in the audio file (and how we asked Google to transcribe it), so re-uploading the same recording doesn't get transcribed (and billed) again
+
+- People re-upload the same file under a new name, or after a failed attempt. transcripts_for_file_identifier goes by filename and last modified, so those all looked new
+- The content hash comes from the md5 (or crc32c) that cloud storage already keeps for every object, so nothing is downloaded. Only if neither is there do we stream the file through sha256
+- The config fingerprint is a hash of the config sent to Google. A different language, encoding, channel setup etc. is a different transcript
+- Entries live in the transcriptCache collection and point at the transcript's utterance pages (see transcript_store.py). A hit copies those into the new request's transcript and marks it processed, without calling Google
+- Entries are per user unless TRANSCRIPT_CACHE_SHARED is on
+- Retention is pluggable: a policy decides whether an entry is still good (checked on lookup, and by prune() for the ones never looked up again). MaxAgeRetention is the default
+- Hits, misses etc. are counted in stats(), per process (see views.cache_stats). Each entry also counts its own hits in firestore
+"""
+import base64
+import hashlib
+import logging
+import threading
+from datetime import datetime, timedelta, timezone
+
+from django.conf import settings
+
+from .helpers import services, timestamp
+from . import serialization
+
+logger = logging.getLogger('testlogger')
+
+CACHE_COLLECTION = "transcriptCache"
+# change this if something about how transcripts are made changes, so old entries stop matching
+CACHE_VERSION = 1
+_HASH_CHUNK_SIZE = 1024 * 1024
+
+
+#########################################
+# Keys
+################################
+
+class _HashWriter:
+    def __init__(self):
+        self.hash = hashlib.sha256()
+
+    def write(self, data):
+        self.hash.update(data)
+        return len(data)
+
+
+def content_hash(blob, download=True):
+    """
+    - blob should have its metadata loaded (e.g., from bucket.get_blob)
+    - returns something like "md5-<hex>", or None if there's no hash and download is False
+    """
+    if getattr(blob, "md5_hash", None):
+        return "md5-" + base64.b64decode(blob.md5_hash).hex()
+
+    if getattr(blob, "crc32c", None):
+        # only 32 bits, so include the size too
+        return f"crc32c-{base64.b64decode(blob.crc32c).hex()}-{blob.size}"
+
+    if not download:
+        return None
+
+    # e.g., composite objects don't have an md5. Streams, so the whole file is never in memory
+    writer = _HashWriter()
+    blob.chunk_size = _HASH_CHUNK_SIZE
+    blob.download_to_file(writer)
+    return "sha256-" + writer.hash.hexdigest()
+
+
+def config_fingerprint(config):
+    """
+    same config (in any key order) > same fingerprint
+    """
+    data = {"version": CACHE_VERSION, "config": config}
+    return hashlib.sha1(serialization.dumps(data, sort_keys=True, default=str)).hexdigest()[:16]
+
+
+def cache_key(content_hash, fingerprint, user_id=None):
+    key = f"{content_hash}--{fingerprint}"
+    return f"{user_id}--{key}" if user_id else key
+
+
+#########################################
+# Retention
+################################
+
+class MaxAgeRetention:
+    """
+    keeps entries that were made or last hit within max_age
+    """
+
+    def __init__(self, max_age=timedelta(days=90)):
+        self.max_age = max_age
+
+    def keep(self, entry, now):
+        last_used = entry.get("last_hit_at") or entry.get("created_at")
+        if not last_used:
+            return False
+
+        used_at = datetime.strptime(last_used, "%Y%m%dT%H%M%SZ").replace(tzinfo=timezone.utc)
+        return now - used_at <= self.max_age
+
+
+class KeepForever:
+    def keep(self, entry, now):
+        return True
+
+
+#########################################
+# Cache
+################################
+
+class TranscriptCache:
+    def __init__(self, get_db, retention=None, shared=False, now=None):
+        """
+        - get_db returns the firestore client (called each time, so services.override works)
+        - retention has keep(entry, now). now is a function returning an aware datetime (for tests)
+        """
+        self.get_db = get_db
+        self.retention = retention or MaxAgeRetention()
+        self.shared = shared
+        self.now = now or (lambda: datetime.now(timezone.utc))
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "stored": 0, "expired": 0, "broken": 0}
+
+    def _count(self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+    def _ref(self, key):
+        return self.get_db().collection(CACHE_COLLECTION).document(key)
+
+    def key_for(self, content_hash, fingerprint, user_id):
+        return cache_key(content_hash, fingerprint, None if self.shared else user_id)
+
+    def lookup(self, key):
+        """
+        the entry, if there's one that the retention policy still keeps. Counts as a miss otherwise
+        """
+        snapshot = self._ref(key).get()
+        entry = snapshot.to_dict() if snapshot.exists else None
+        if entry is not None and not self.retention.keep(entry, self.now()):
+            self.evict(key, reason="expired")
+            entry = None
+
+        if entry is None:
+            self._count("misses")
+            return None
+
+        return entry
+
+    def record_hit(self, key):
+        from google.cloud.firestore import Increment
+
+        self._count("hits")
+        self._ref(key).set({"hits": Increment(1), "last_hit_at": timestamp()}, merge=True)
+
+    def evict(self, key, reason="expired"):
+        """
+        reason is "expired" (retention policy) or "broken" (the transcript it points to is gone)
+        """
+        logger.info(f"evicting transcript cache entry {key} ({reason})")
+        self._count(reason)
+        if reason == "broken":
+            # lookup found it, but it can't be used, so for the hit rate it's a miss
+            self._count("misses")
+        self._ref(key).delete()
+
+    def store(self, key, entry, unit_of_work):
+        entry = {**entry, "created_at": timestamp(), "last_hit_at": None, "hits": 0}
+        unit_of_work.set(self._ref(key), entry)
+        self._count("stored")
+
+    def prune(self, dry_run=False, limit=None):
+        """
+        deletes entries the retention policy doesn't keep anymore. For entries that never get looked up again (e.g., from Heroku Scheduler, see the prune_transcript_cache command)
+        """
+        now = self.now()
+        query = self.get_db().collection(CACHE_COLLECTION)
+        if limit:
+            query = query.limit(limit)
+
+        stats = {"scanned": 0, "expired": 0}
+        for snapshot in query.stream():
+            stats["scanned"] += 1
+            if self.retention.keep(snapshot.to_dict(), now):
+                continue
+
+            stats["expired"] += 1
+            if not dry_run:
+                self.evict(snapshot.id, reason="expired")
+
+        return stats
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = round(stats["hits"] / lookups, 3) if lookups else None
+        return stats
+
+
+def _build_retention():
+    days = settings.TRANSCRIPT_CACHE_MAX_AGE_DAYS
+    return MaxAgeRetention(timedelta(days=days)) if days else KeepForever()
+
+
+transcript_cache = TranscriptCache(lambda: services.db, retention=_build_retention(), shared=settings.TRANSCRIPT_CACHE_SHARED)
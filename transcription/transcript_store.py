@@ -0,0 +1,130 @@
+"""
+Paged storage for transcript utterances, so a long transcript isn't one huge document
+
+- Firestore documents max out at 1 MiB, and an hour long transcript with word offsets and 3 alternatives gets close
+- Utterances go in pages (sub documents under the transcript doc's utterancePages collection), each kept under MAX_PAGE_BYTES
+- The manifest (which pages there are, how many utterances in each, and whether the transcript is complete) is kept on the parent doc, as transcript_pages
+- append() only ever adds to the end, so results can be written as they come in (e.g., as split mode's segments finish, in order), and a client can page through without loading everything
+
+Manifest shape:
+
+    {
+        "version": 1,
+        "utterance_count": 1234,
+        "bytes": 987654,
+        "complete": True,
+        "pages": [{"id": "00000", "first_index": 0, "count": 400, "bytes": 250000}, ...],
+    }
+"""
+import json
+import logging
+
+from . import serialization
+from .metrics import timed
+
+logger = logging.getLogger('testlogger')
+
+PAGES_COLLECTION = "utterancePages"
+# well under firestore's 1 MiB, since our size is only an estimate (JSON bytes)
+MAX_PAGE_BYTES = 256 * 1024
+MANIFEST_VERSION = 1
+
+
+def empty_manifest():
+    return {
+        "version": MANIFEST_VERSION,
+        "utterance_count": 0,
+        "bytes": 0,
+        "complete": False,
+        "pages": [],
+    }
+
+
+def _size(utterance):
+    return len(serialization.dumps(utterance))
+
+
+def page_id(index):
+    # zero padded, so pages sort in order by id
+    return f"{index:05d}"
+
+
+class ChunkedTranscript:
+    def __init__(self, transcript_ref, manifest=None, max_page_bytes=MAX_PAGE_BYTES):
+        self.transcript_ref = transcript_ref
+        self.manifest = json.loads(json.dumps(manifest)) if manifest else empty_manifest()
+        self.max_page_bytes = max_page_bytes
+        # utterances in the last page, if we have them, so appending doesn't need to read it back first
+        self._open_page = None
+
+    @property
+    def utterance_count(self):
+        return self.manifest["utterance_count"]
+
+    def page_ref(self, index):
+        return self.transcript_ref.collection(PAGES_COLLECTION).document(page_id(index))
+
+    def load_page(self, index):
+        with timed("firestore", "get"):
+            snapshot = self.page_ref(index).get()
+        return (snapshot.to_dict() or {}).get("utterances", []) if snapshot.exists else []
+
+    def _last_page_utterances(self):
+        if self._open_page is None:
+            self._open_page = self.load_page(len(self.manifest["pages"]) - 1)
+
+        return self._open_page
+
+    def append(self, utterances, unit_of_work):
+        """
+        adds utterances to the end, filling up the last page before starting new ones. Writes go in unit_of_work, one per page touched
+        - returns number of pages written
+        """
+        if not utterances:
+            return 0
+
+        pages = self.manifest["pages"]
+        # page index > all of its utterances, for the pages that changed
+        changed = {}
+
+        if pages and pages[-1]["bytes"] < self.max_page_bytes:
+            changed[len(pages) - 1] = list(self._last_page_utterances())
+
+        for utterance in utterances:
+            size = _size(utterance)
+            last = len(pages) - 1
+            if last not in changed or (pages[last]["bytes"] + size > self.max_page_bytes and changed[last]):
+                # start a new page. An utterance bigger than a page still gets a page to itself
+                pages.append({
+                    "id": page_id(len(pages)),
+                    "first_index": self.manifest["utterance_count"],
+                    "count": 0,
+                    "bytes": 0,
+                })
+                last = len(pages) - 1
+                changed[last] = []
+
+            changed[last].append(utterance)
+            pages[last]["count"] += 1
+            pages[last]["bytes"] += size
+            self.manifest["utterance_count"] += 1
+            self.manifest["bytes"] += size
+
+        for index, page_utterances in changed.items():
+            unit_of_work.set(self.page_ref(index), {"index": index, "utterances": page_utterances})
+
+        self._open_page = changed[len(pages) - 1]
+        return len(changed)
+
+    def mark_complete(self):
+        self.manifest["complete"] = True
+
+    def utterances(self):
+        """
+        all of them, one read per page
+        """
+        all_utterances = []
+        for index in range(len(self.manifest["pages"])):
+            all_utterances.extend(self.load_page(index))
+
+        return all_utterances
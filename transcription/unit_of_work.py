@@ -0,0 +1,73 @@
+"""
+Unit of work for firestore writes
+
+- Collects writes (set/update/create/add/delete) and commits them all in a single firestore batch, ie one round trip instead of one per write
+- Writes in the same commit are atomic, e.g., a status change and its event log either both happen or neither does
+- Nothing is sent until flush() is called, so callers decide where the flush points are
+"""
+import logging
+
+from .metrics import timed
+
+logger = logging.getLogger('testlogger')
+
+# firestore won't take more than this many writes in one batch
+MAX_BATCH_SIZE = 500
+
+
+class UnitOfWork:
+    def __init__(self, db):
+        self.db = db
+        # list of (method name, ref, data, kwargs)
+        self._writes = []
+        self.commits = 0
+
+    def __len__(self):
+        return len(self._writes)
+
+    def set(self, ref, data, merge=False):
+        self._writes.append(("set", ref, data, {"merge": merge}))
+
+    def update(self, ref, data, option=None):
+        self._writes.append(("update", ref, data, {"option": option} if option else {}))
+
+    def create(self, ref, data):
+        self._writes.append(("create", ref, data, {}))
+
+    def add(self, collection_ref, data):
+        """
+        like CollectionReference.add, but batched. Returns the new document's ref
+        """
+        ref = collection_ref.document()
+        self.set(ref, data)
+        return ref
+
+    def delete(self, ref):
+        self._writes.append(("delete", ref, None, {}))
+
+    def discard(self):
+        self._writes = []
+
+    def flush(self):
+        """
+        commits everything queued so far, returns the number of writes committed
+        - if there are more than MAX_BATCH_SIZE writes, they get split into several commits, and are only atomic within each commit
+        """
+        writes, self._writes = self._writes, []
+
+        for start in range(0, len(writes), MAX_BATCH_SIZE):
+            batch = self.db.batch()
+            for method, ref, data, kwargs in writes[start:start + MAX_BATCH_SIZE]:
+                if method == "delete":
+                    batch.delete(ref)
+                else:
+                    getattr(batch, method)(ref, data, **kwargs)
+
+            with timed("firestore", "commit"):
+                batch.commit()
+            self.commits += 1
+
+        if writes:
+            logger.info(f"committed {len(writes)} writes to firestore")
+
+        return len(writes)
@@ -2,19 +2,32 @@ from django.shortcuts import render
 from django.http import HttpResponse
 from django.http import HttpResponseServerError
 from django.views.decorators.csrf import csrf_exempt
+from django.conf import settings
 import os
-import json
-from firebase_admin import firestore
+import hmac
+from functools import wraps
 import traceback
-from .helpers import TRANSCRIPTION_STATUSES 
+from .helpers import TRANSCRIPTION_STATUSES, services
 
 # from .transcribe import request_long_running_recognize, setup_request
 from .transcribe_class import TranscribeRequest
+from .cache import TTLCache, NO_EXPIRY
+from . import responses, serialization, job_queue
+from .responses import InvalidFields
+from .admission import Throttled, admission_control
+from . import metrics
+from .transcript_cache import transcript_cache
 
 from copy import deepcopy
+from concurrent.futures import ThreadPoolExecutor
 import logging
 logger = logging.getLogger('testlogger')
 
+# responses from check_status, keyed by request and transaction_id (see _check_status_cache_key)
+check_status_cache = TTLCache(maxsize=settings.CHECK_STATUS_CACHE_SIZE, ttl=settings.CHECK_STATUS_CACHE_TTL)
+# operation lookups for check_status_bulk. Shared by all requests, so a few big dashboards can't start hundreds of calls to Google at once
+bulk_executor = ThreadPoolExecutor(max_workers=settings.CHECK_STATUS_BULK_WORKERS, thread_name_prefix="check-status-bulk")
+
 ###################################
 # Controllers 
 ###################################
@@ -35,23 +48,18 @@ def transcribe(req):
     try:
         if req.method == "POST":
             # data = deepcopy(req.POST)
-            file_data = json.loads(req.body)
+            file_data = serialization.loads(req.body)
+            fields = responses.requested_fields(req, file_data)
             transcribe_request = TranscribeRequest(file_data)
-
-            # mark request as received in firestore 
-            transcribe_request.mark_as_received()
-
-            transcribe_request.setup_request()
-             
-            transcribe_request.request_long_running_recognize()
+            _start_transcribing(transcribe_request)
             # an async func, should not stop returning the response
             # TODO later, optionally convert file
             # transcribe
 
             # if get here, either it is now transcribing or we handled the error (though that doesn't mean that we continued to retry)
-            response = HttpResponse(json.dumps({
-                "current_request_data": transcribe_request.__dict__
-            }), content_type='application/json')
+            response = responses.json_response(req, {
+                "current_request_data": responses.project(responses.serialize(transcribe_request), fields)
+            })
             
             logger.info(response)
 
@@ -63,6 +71,12 @@ def transcribe(req):
         return response
         logger.info("now returning response")
 
+    except InvalidFields as error:
+        return responses.invalid_fields_response(error)
+
+    except Throttled as error:
+        return responses.throttled_response(error)
+
     except Exception as error:
         logger.info("error transcribing file")
         error_response = _log_error(error, transcribe_request)
@@ -81,68 +95,20 @@ def resume_request(req):
     transcribe_request = False
 
     try:
-        file_data = json.loads(req.body)
+        file_data = serialization.loads(req.body)
         transcribe_request = TranscribeRequest(file_data)
 
         # check to see current status
         transcribe_request.refresh_from_db()
-        status = transcribe_request.status
-        logger.info(f"Status is now {status}")
-
-        if transcribe_request.last_request_has_stopped() == False:
-            logger.info("making them wait a little bit longer")
-            message = "Please wait a little longer before requesting, it's only been {} so far".format(transcribe_request.elapsed_since_last_event())
-
-        elif status == TRANSCRIPTION_STATUSES[0]: # uploading
-            # whoops...shouldn't be here!
-            # check if there is a file and storage, then restart if there is
-            # if there isn't, tell client to prompt reupload
-            # TODO use better python exception
-            transcribe_request.mark_as_server_error(Exception("404 No such object"))
-            
-            message = "they should try uploading again"
-
-        elif status == TRANSCRIPTION_STATUSES[1]: # uploaded
-            # should not allow client to request a resume if only uploaded, unless updated_at was long enough ago. But eventually will check server side as well
-            # check updated_at, then restart if too long ago
-            # TODO 
-            message = _resume_transcribing_or_processing(transcribe_request)
-
-        elif status == TRANSCRIPTION_STATUSES[2]: # processing-file (aka server has received)
-            # check updated_at, then restart if too long ago
-            # note that this stage often takes a while, since sometimes it means converting large files from one format to flac
-            # TODO 
-            message = _resume_transcribing_or_processing(transcribe_request)
-
-
-        elif status == TRANSCRIPTION_STATUSES[3]: # transcribing
-            # check with google via operation
-            # use transaction_id
-
-            # if status says our server is currently processing, then wait a couple seconds, check db again, and if still processing, then assume it errored out somewhere
-            # TODO 
-            message = "Not yet handling "
-
-        elif status == TRANSCRIPTION_STATUSES[4]: # "processing-transcription" (means that transcription is complete)
-            # TODO 
-            message = "Not yet handling "
+        message = _resume_message(transcribe_request)
 
-        elif status == TRANSCRIPTION_STATUSES[5]: # "transcription-processed"
-            # do nothing...tell client it's all done. 
-            message = "Not yet handling "
-
-        elif status == TRANSCRIPTION_STATUSES[6]: # server-error
-            message = _resume_transcribing_or_processing(transcribe_request)
-
-        elif status == TRANSCRIPTION_STATUSES[7]: # transcribing-error
-            # try transcribing again, unless error requires changing the file or options first
-            # TODO setup to handle different errors from Google. For now, just handling as any other error
-            message = _resume_transcribing_or_processing(transcribe_request)
-
-        return HttpResponse(json.dumps({
+        return HttpResponse(serialization.dumps({
             "message": message
         }), content_type='application/json')
 
+    except Throttled as error:
+        return responses.throttled_response(error)
+
     except Exception as error:
         logger.error("error resuming request")
         error_response = _log_error(error, transcribe_request)
@@ -156,9 +122,8 @@ def check_status(req):
     - Client will poll this endpoint periodically to check on how things are
     - Does stuff like resume_request but only checks, doesn't actually transcribe
     - If everything runs smoothly, will keep asking until Google is done transcribing and then will get the transcription
-
-    TODO 
-    - Maybe move to background worker, and just poll whether or not client asks
+    - If BACKGROUND_POLLING is on, the worker process does the checking, and this just returns what it persisted
+    - current_request_data only has the fields asked for (see responses.py). Send back the ETag in If-None-Match to get a 304 if nothing changed
     """
     # get operation from Google
     # https://cloud.google.com/resource-manager/reference/rest/v1/operations/get
@@ -166,30 +131,192 @@ def check_status(req):
     transcribe_request = False
 
     try:
-        file_data = json.loads(req.body)
-        transcribe_request = TranscribeRequest(file_data)
+        file_data = serialization.loads(req.body)
+        fields = responses.requested_fields(req, file_data)
 
-        # check to see current status
-        # TODO maybe only check Google depending on current status?
-        transcribe_request.refresh_from_db()
-        transcribe_request.check_transcription_progress() 
+        def check():
+            nonlocal transcribe_request
+            transcribe_request = TranscribeRequest(file_data)
 
-        return HttpResponse(json.dumps({
-            "message": "finished checking status",
-            "progress_percent": transcribe_request.transcript_metadata["progress_percent"],
-            "current_request_data": transcribe_request.__dict__
+            # check to see current status
+            # TODO maybe only check Google depending on current status?
+            transcribe_request.refresh_from_db()
+            if not settings.BACKGROUND_POLLING:
+                transcribe_request.check_transcription_progress() 
 
-        }), content_type='application/json')
+            return _check_status_response_data(transcribe_request)
 
+        transaction_id = file_data.get("transaction_id")
+        if transaction_id:
+            # several tabs/retries polling the same operation at once only cost one check
+            response_data = check_status_cache.get_or_load(_check_status_cache_key(file_data), check, ttl=_check_status_ttl)
+        else:
+            # not transcribing yet, nothing worth caching
+            response_data = check()
+
+        return responses.json_response(req, _project_response_data(response_data, fields))
+
+    except InvalidFields as error:
+        return responses.invalid_fields_response(error)
 
     except Exception as error:
         logger.error("error resuming request")
         error_response = _log_error(error, transcribe_request)
         return error_response
 
+@csrf_exempt
+def check_status_bulk(req):
+    """
+    - For the dashboard: status of all of a user's uploads in one call, instead of one check-status each
+    - Body is {"user_id", "ids": [transcribe request ids], "fields" (optional, same as for check-status)}
+    - Reads all the docs with one get_all, then the ones that are transcribing get their operations from Google at the same time (through the same cache as check-status)
+    - Returns {"results": {id: current_request_data}, "missing": [ids with no doc], "errors": {id: message}}. One failing doesn't fail the rest
+    """
+    try:
+        file_data = serialization.loads(req.body)
+        fields = responses.requested_fields(req, file_data)
+        ids = file_data.get("ids") or []
+        if not file_data.get("user_id") or not isinstance(ids, list):
+            return HttpResponse(serialization.dumps({"error": "Needs user_id and a list of ids"}), status=400, content_type='application/json')
+        if len(ids) > settings.CHECK_STATUS_BULK_MAX:
+            return HttpResponse(serialization.dumps({"error": f"No more than {settings.CHECK_STATUS_BULK_MAX} ids at a time"}), status=400, content_type='application/json')
+
+        return responses.json_response(req, _check_status_bulk_data(file_data["user_id"], ids, fields))
+
+    except InvalidFields as error:
+        return responses.invalid_fields_response(error)
+
+    except Exception as error:
+        logger.error("error checking statuses")
+        return _log_error(error, None)
+
+def _staff_or_token(view):
+    """
+    for the stats/metrics endpoints: staff users (e.g., logged in to the admin), or "Authorization: Bearer <STATS_TOKEN>"
+    """
+    @wraps(view)
+    def wrapper(req, *args, **kwargs):
+        user = getattr(req, "user", None)
+        if user is not None and user.is_active and user.is_staff:
+            return view(req, *args, **kwargs)
+
+        scheme, _, token = req.META.get("HTTP_AUTHORIZATION", "").partition(" ")
+        if settings.STATS_TOKEN and scheme.lower() == "bearer" and hmac.compare_digest(token.strip().encode(), settings.STATS_TOKEN.encode()):
+            return view(req, *args, **kwargs)
+
+        response = HttpResponse(serialization.dumps({"error": "Not allowed"}), status=401, content_type='application/json')
+        response["WWW-Authenticate"] = "Bearer"
+        return response
+
+    return wrapper
+
+@_staff_or_token
+def cache_stats(req):
+    """
+    hit/miss/eviction counters for the check_status cache in this process, to help with sizing it
+    - transcript_cache has the same for the transcript cache (see transcript_cache.py)
+    """
+    return HttpResponse(serialization.dumps({
+        **check_status_cache.stats(),
+        "transcript_cache": transcript_cache.stats(),
+    }), content_type='application/json')
+
+@_staff_or_token
+def queue_stats(req):
+    """
+    depth of the job queue and how long each stage of a job takes (see job_queue.py)
+    """
+    return HttpResponse(serialization.dumps(job_queue.stats()), content_type='application/json')
+
+@_staff_or_token
+def admission_stats(req):
+    """
+    how many requests this process let through or turned away (see admission.py)
+    """
+    return HttpResponse(serialization.dumps(admission_control.stats()), content_type='application/json')
+
+@_staff_or_token
+def metrics_view(req):
+    """
+    for Prometheus to scrape (see metrics.py)
+    """
+    body, content_type = metrics.render()
+    return HttpResponse(body, content_type=content_type)
+
 ##########################################
 # Controller Helpers
 #######################
+def _check_status_response_data(transcribe_request):
+    return {
+        "message": "finished checking status",
+        "progress_percent": (transcribe_request.transcript_metadata or {}).get("progress_percent", 0),
+        # every field, since it's shared between everyone who hits the cache. Each response projects out what it asked for
+        "current_request_data": responses.serialize(transcribe_request),
+    }
+
+def _project_response_data(response_data, fields):
+    return {
+        **response_data,
+        "current_request_data": responses.project(response_data["current_request_data"], fields),
+    }
+
+def _check_status_bulk_data(user_id, ids, fields):
+    ids = list(dict.fromkeys(ids))
+    requests_ref = services.db.collection("users").document(user_id).collection("transcribeRequests")
+    # one round trip for all of them. Comes back in any order
+    with metrics.timed("firestore", "get_all"):
+        snapshots = {snapshot.id: snapshot for snapshot in services.db.get_all([requests_ref.document(id) for id in ids])}
+
+    found = [id for id in ids if id in snapshots and snapshots[id].exists]
+    futures = {id: bulk_executor.submit(_check_snapshot_status, snapshots[id].to_dict()) for id in found}
+
+    results = {}
+    errors = {}
+    for id, future in futures.items():
+        try:
+            results[id] = responses.project(future.result()["current_request_data"], fields)
+        except Exception as error:
+            logger.error(f"error checking status of {id}")
+            logger.error(traceback.format_exc())
+            errors[id] = str(error)
+
+    return {
+        "results": results,
+        "missing": [id for id in ids if id not in found],
+        "errors": errors,
+    }
+
+def _check_snapshot_status(file_data):
+    """
+    like check_status's check, but the doc was already read
+    """
+    transcribe_request = TranscribeRequest(file_data)
+    transaction_id = transcribe_request.transaction_id
+    if settings.BACKGROUND_POLLING or not transaction_id or transcribe_request.status != TRANSCRIPTION_STATUSES[3]: # transcribing
+        # nothing to ask Google about, the doc is all there is
+        return _check_status_response_data(transcribe_request)
+
+    def check():
+        transcribe_request.check_transcription_progress()
+        return _check_status_response_data(transcribe_request)
+
+    return check_status_cache.get_or_load(_check_status_cache_key(file_data), check, ttl=_check_status_ttl)
+
+def _check_status_cache_key(file_data):
+    """
+    the request as well as its operation, so posting someone else's transaction_id only ever gets the request that was asked for
+    """
+    return (file_data.get("user_id"), file_data.get("id"), file_data.get("transaction_id"))
+
+def _check_status_ttl(response_data):
+    """
+    once the transcript is processed it won't change anymore, so can keep it until it gets evicted
+    """
+    if response_data["current_request_data"].get("status") == TRANSCRIPTION_STATUSES[5]: # transcription-processed
+        return NO_EXPIRY
+
+    return settings.CHECK_STATUS_CACHE_TTL
+
 def _log_error(error, transcribe_request):
     logger.error(traceback.format_exc())
     # TODO move this error handling to more granular handling so can handle better. Don't do it here.
@@ -204,6 +331,90 @@ def _log_error(error, transcribe_request):
 
     return HttpResponseServerError("Server errored out during transcription request")
 
+def _admit(transcribe_request):
+    """
+    raises Throttled if this user (or everyone) has asked for too many transcriptions (see admission.py). With the job queue on, the worker checks instead
+    """
+    if settings.ADMISSION_CONTROL and not settings.JOB_QUEUE:
+        admission_control.admit(transcribe_request.user_id, transcribe_request.transcribe_request_ref().path)
+
+def _start_transcribing(transcribe_request):
+    # before marking as received, so if it has to wait it's still just uploaded
+    _admit(transcribe_request)
+
+    with transcribe_request.batched_writes():
+        # mark request as received in firestore 
+        transcribe_request.mark_as_received()
+        # flush point, so client sees that we received it before we start talking to Google
+        transcribe_request.flush_writes()
+
+        if settings.JOB_QUEUE:
+            # a worker asks Google (see job_queue.py), so this returns right away
+            job_queue.enqueue_transcription(transcribe_request)
+            return
+
+        # if it needs converting to flac first, this returns before Google is asked, and the client sees it progress through processing-file
+        transcribe_request.request_transcription()
+
+def _resume_message(transcribe_request):
+    """
+    decides what to do about a resume request based on the current status (assumes already refreshed from db), does it, and returns message for the client
+    """
+    status = transcribe_request.status
+    logger.info(f"Status is now {status}")
+
+    if transcribe_request.last_request_has_stopped() == False:
+        logger.info("making them wait a little bit longer")
+        message = "Please wait a little longer before requesting, it's only been {} so far".format(transcribe_request.elapsed_since_last_event())
+
+    elif status == TRANSCRIPTION_STATUSES[0]: # uploading
+        # whoops...shouldn't be here!
+        # check if there is a file and storage, then restart if there is
+        # if there isn't, tell client to prompt reupload
+        # TODO use better python exception
+        transcribe_request.mark_as_server_error(Exception("404 No such object"))
+        
+        message = "they should try uploading again"
+
+    elif status == TRANSCRIPTION_STATUSES[1]: # uploaded
+        # should not allow client to request a resume if only uploaded, unless updated_at was long enough ago. But eventually will check server side as well
+        # check updated_at, then restart if too long ago
+        # TODO 
+        message = _resume_transcribing_or_processing(transcribe_request)
+
+    elif status == TRANSCRIPTION_STATUSES[2]: # processing-file (aka server has received)
+        # check updated_at, then restart if too long ago
+        # note that this stage often takes a while, since sometimes it means converting large files from one format to flac
+        # TODO 
+        message = _resume_transcribing_or_processing(transcribe_request)
+
+
+    elif status == TRANSCRIPTION_STATUSES[3]: # transcribing
+        # check with google via operation
+        # use transaction_id
+
+        # if status says our server is currently processing, then wait a couple seconds, check db again, and if still processing, then assume it errored out somewhere
+        # TODO 
+        message = "Not yet handling "
+
+    elif status == TRANSCRIPTION_STATUSES[4]: # "processing-transcription" (means that transcription is complete)
+        # TODO 
+        message = "Not yet handling "
+
+    elif status == TRANSCRIPTION_STATUSES[5]: # "transcription-processed"
+        # do nothing...tell client it's all done. 
+        message = "Not yet handling "
+
+    elif status == TRANSCRIPTION_STATUSES[6]: # server-error
+        message = _resume_transcribing_or_processing(transcribe_request)
+
+    elif status == TRANSCRIPTION_STATUSES[7]: # transcribing-error
+        # try transcribing again, unless error requires changing the file or options first
+        # TODO setup to handle different errors from Google. For now, just handling as any other error
+        message = _resume_transcribing_or_processing(transcribe_request)
+
+    return message
+
 def _resume_transcribing_or_processing(transcribe_request):
     # go through and make sure to mark as received if not already
     if transcribe_request.server_has_received() == False:
@@ -214,8 +425,11 @@ def _resume_transcribing_or_processing(transcribe_request):
     if transcribe_request.transaction_id == None: 
         # setup the request again
         logger.info("now setting up ")
-        transcribe_request.setup_request()
-        transcribe_request.request_long_running_recognize()
+        _admit(transcribe_request)
+        if settings.JOB_QUEUE:
+            job_queue.enqueue_transcription(transcribe_request)
+        else:
+            transcribe_request.request_transcription()
 
         message = "Starting to ask Google for transcription again"
 
@@ -242,7 +456,7 @@ class LogSuccessResponse(HttpResponse):
 
         # do whatever you want, this is the last codepoint in req handling
         all_of_it = self.getvalue()
-        my_json = json.loads(all_of_it)
+        my_json = serialization.loads(all_of_it)
         data = my_json["data"]
         request = my_json["request"]
         options_dict = my_json["options_dict"]